@@ -10,6 +10,10 @@ from consistent_sampler import sampler
 import hashlib
 import bptool
 import rcv
+from staged_posterior import StagedPosterior
+import comparison_audit
+from trial_pool import TrialPool
+from results_store import cell_params
 import numpy as np
 import time
 import pandas as pd
@@ -45,6 +49,10 @@ def rcv_wrapper(unique_ballots, tally_list, vote_for_n):
         tally[unique_ballots[index]] = count
     return rcv.rcv_winner(tally,tie_breaker, printing_wanted=False)
 
+# rcv.rcv_winner with an empty tie_breaker, so bptool may prune and merge
+# ballot types for it (see bptool.reduction_is_exact)
+rcv_wrapper.tabulates_like_rcv_winner = True
+
 
 
 def get_candidates(tally):
@@ -52,7 +60,9 @@ def get_candidates(tally):
     for names in tally.keys():
         for name in names:
             candidate_names.add(name)
-    return list(candidate_names)
+    # sorted, so the order (and win_prob_cache keys) is the same in every
+    # process, whatever PYTHONHASHSEED is
+    return sorted(candidate_names)
 
 def get_ballot_list():
     votes_dir = "../../maine-rcv-data/"
@@ -62,49 +72,232 @@ def get_ballot_list():
     L = rcv.convert_tally_to_ballots(tally)
     return n,L
 
-#TODO(zarap): refactor to make faster
-def get_sub_sample_tally(sample_size,sample_order):
-    sample = [L[sample_order[i]] for i in range(sample_size)]
-    sample_tally = rcv.convert_ballots_to_tally(sample)
-    return sample_tally
+def get_sample_order(n, seed, length=None, sample_order_cache=None):
+    """
+    Return the order in which the n ballots (numbered 0, ..., n-1) are
+    sampled for the given seed, as an array of ballot numbers: the first
+    length of them, or all if length is None.  If sample_order_cache (a
+    sample_order_cache.SampleOrderCache) is given, orders are read from
+    it when it has them, and added to it when not.
+    """
+
+    if sample_order_cache is not None:
+        return sample_order_cache.get(range(n), seed, length)
+    return np.array(list(sampler(range(n), with_replacement=False,
+                                 take=n if length is None else length,
+                                 output='id', seed=seed)))
+
+def get_ballot_type_index(L):
+    """
+    Return (election_ballots, ballot_types): the distinct ballot types of
+    the election, sorted, and the index into election_ballots of the type
+    of each ballot in L, as a numpy array.  Built once per election, so
+    every sample tally is indexed the same way.
+    """
+
+    election_ballots = sorted(set(L))
+    type_index = {ballot: i for i, ballot in enumerate(election_ballots)}
+    ballot_types = np.array([type_index[ballot] for ballot in L])
+    return election_ballots, ballot_types
+
+def get_prefix_tallies(ballot_types, sample_order, sample_sizes, num_types):
+    """
+    Return array (len(sample_sizes) x num_types) whose row k counts the
+    ballot types of the first sample_sizes[k] ballots of sample_order
+    (sample_sizes increasing).  One bincount per stretch between
+    consecutive sample sizes, then a cumulative sum, so all the sample
+    sizes together cost one pass over the largest sample.
+    """
 
-def audit(simulations = 1000):
+    sample_types = ballot_types[np.asarray(sample_order[:sample_sizes[-1]])]
+    bounds = [0] + list(sample_sizes)
+    increments = [np.bincount(sample_types[bounds[k]:bounds[k+1]],
+                              minlength=num_types)
+                  for k in range(len(sample_sizes))]
+    return np.cumsum(increments, axis=0)
+
+def get_sub_sample_tally(counts, election_ballots):
+    """
+    Return (unique_ballots, sample_tally) for the count vector counts
+    over election_ballots: the types in the sample, in the election's
+    order, and the dict mapping each to its count.
+    """
+
+    present = np.flatnonzero(counts)
+    unique_ballots = [election_ballots[i] for i in present]
+    sample_tally = dict(zip(unique_ballots, counts[present].tolist()))
+    return unique_ballots, sample_tally
+
+def audit(simulations = 1000, workers = None, risk_limit = None, cache = None,
+          staged = False, pool = False, comparison = False, store = None,
+          sample_order_cache = None):
+    """
+    Simulate audits of the Maine contest for seeds 1, ..., simulations
+    and sample sizes 100, 200, ..., 3000, writing one row per cell.
+
+    The mode is plain ballot polling (bptool.compute_win_probs_rcv), or
+    one of staged (staged_posterior), pool (trial_pool) and comparison
+    (comparison_audit, with error-free CVRs).  workers applies to plain
+    polling and pool; risk_limit (stop each cell early, see
+    bptool.compute_win_probs_rcv_sequential) and cache (a
+    win_prob_cache.WinProbCache) to plain polling only.  store (a
+    results_store.ResultsStore) applies to every mode, as does
+    sample_order_cache (a sample_order_cache.SampleOrderCache, to keep
+    the sample orders on disk).  Other combinations raise ValueError.
+    """
+
+    modes = [name for name, flag in (("staged", staged), ("pool", pool),
+                                     ("comparison", comparison)) if flag]
+    if len(modes) > 1:
+        raise ValueError("audit: {} are mutually exclusive."
+                         .format(" and ".join(modes)))
+    if modes and risk_limit is not None:
+        raise ValueError("audit: risk_limit does not apply to {}."
+                         .format(modes[0]))
+    if cache is not None and (modes or risk_limit is not None):
+        raise ValueError("audit: cache applies only to plain polling, "
+                         "without risk_limit.")
+    if workers is not None and modes and modes[0] != "pool":
+        raise ValueError("audit: workers do not apply to {}."
+                         .format(modes[0]))
     data = []
     n,L = get_ballot_list()
+    election_ballots, ballot_types = get_ballot_type_index(L)
+    sample_sizes = list(range(100, 3001, 100))
+    if comparison:
+        # the CVRs are taken to be the ballots themselves, so every
+        # sampled paper ballot agrees with its CVR: a demonstration of
+        # the method on error-free CVRs, labeled as such in the output
+        cvr_tally = rcv.convert_ballots_to_tally(L)
+        cvr_names = get_candidates(cvr_tally)
     vote_for_n = 1
     num_trials = 1000
     output_file = "audit_simulations_vs_2.csv" 
+    if comparison:
+        output_file = "audit_simulations_comparison_error_free.csv"
     print("simulations: %d n: %d " % (num_trials,n))
-    #sample size
-    for seed in range(1,simulations+1):
-        sample_order = list(sampler(range(n), with_replacement=False,
-                            output='id', seed=seed))
-        for sample_size in range(100, 3001, 100):
-            print("seed: %d"%seed)
-            start = time.time()
-            sample_tally = get_sub_sample_tally(sample_size,sample_order)
-            tie_breaker = [] 
-            real_names = get_candidates(sample_tally)
-            unique_ballots = list(sample_tally.keys())
-            time_delta = time.time() - start
-            sample_tallies = [[ sample_tally[name]  for name  in unique_ballots ],]
-            win_probs = bptool.compute_win_probs_rcv(sample_tallies,
-                              [n], 
-                              seed,
-                              num_trials,
-                              unique_ballots,
-                              real_names,
-                              vote_for_n, rcv_wrapper)
-            win_probs_with_simulation_data = {real_names[i]: prob for i , prob in win_probs }
-            win_probs_with_simulation_data['seed'] = seed
-            win_probs_with_simulation_data['time_delta'] = time_delta
-            win_probs_with_simulation_data['sample_size'] = sample_size
-            data.append(win_probs_with_simulation_data)
-
-        if  seed % 5 == 1:
-            print("At seed %d from 1 to %d"%(seed,simulations+1))
-            df = pd.DataFrame(data)
-            df.to_csv(output_file)
+    if store is not None:
+        # store is a results_store.ResultsStore: each seed's rows are
+        # appended to it as soon as they are done, and seeds already
+        # stored (e.g. before a crash) are skipped
+        if staged:
+            method = "staged"
+        elif comparison:
+            method = "comparison_error_free"
+        elif pool:
+            method = "pool"
+        else:
+            method = "polling" if risk_limit is None else "sequential"
+        # staged and polling tabulate by rcv_wrapper, the others by
+        # voting_models.IRVModel
+        voting_method = "rcv_wrapper" if method in ("staged", "polling",
+                                                    "sequential") \
+            else "IRVModel"
+        params = cell_params(num_trials, risk_limit, voting_method,
+                             vote_for_n)
+        done_cells = store.done_cells(method, params)
+    if pool:
+        # one set of worker processes for the whole sweep, sharing the
+        # election's ballot types; each call only sends a sample size
+        trial_pool = TrialPool(election_ballots, n, workers or 1)
+    try:
+        #sample size
+        for seed in range(1,simulations+1):
+            if store is not None and all((seed, sample_size) in done_cells
+                                         for sample_size in sample_sizes):
+                continue
+            seed_start = len(data)
+            sample_order = get_sample_order(n, seed, sample_sizes[-1],
+                                            sample_order_cache)
+            if staged:
+                # carry each trial's gamma variates from one sample size
+                # to the next, instead of starting afresh for each
+                staged_posterior = StagedPosterior(n, num_trials, seed)
+            if pool:
+                trial_pool.set_sample_order(ballot_types[sample_order])
+            prefix_tallies = get_prefix_tallies(ballot_types, sample_order,
+                                                sample_sizes,
+                                                len(election_ballots))
+            for sample_size, counts in zip(sample_sizes, prefix_tallies):
+                print("seed: %d"%seed)
+                start = time.time()
+                unique_ballots, sample_tally = \
+                    get_sub_sample_tally(counts, election_ballots)
+                tie_breaker = [] 
+                # every candidate on a CVR, whether sampled yet or not
+                real_names = cvr_names if comparison \
+                    else get_candidates(sample_tally)
+                time_delta = time.time() - start
+                sample_tallies = [[ sample_tally[name]  for name  in unique_ballots ],]
+                if staged:
+                    staged_posterior.add_ballots(sample_tally)
+                    win_probs = staged_posterior.win_probs(real_names,
+                                                           rcv_wrapper,
+                                                           vote_for_n)
+                    stats = {}
+                elif comparison:
+                    sample_pairs = {(ballot, ballot): count
+                                    for ballot, count in sample_tally.items()}
+                    win_probs = comparison_audit.compute_win_probs_comparison(
+                                      cvr_tally, sample_pairs, seed, num_trials,
+                                      real_names, vote_for_n)
+                    stats = {}
+                elif pool:
+                    win_probs = trial_pool.compute_win_probs_rcv(
+                                      n, seed, num_trials, real_names,
+                                      sample_size=sample_size)
+                    stats = {}
+                elif risk_limit is None:
+                    # cache, if given, is a win_prob_cache.WinProbCache
+                    compute_win_probs_rcv = bptool.compute_win_probs_rcv \
+                        if cache is None else cache.compute_win_probs_rcv
+                    win_probs = compute_win_probs_rcv(sample_tallies,
+                                      [n], 
+                                      seed,
+                                      num_trials,
+                                      unique_ballots,
+                                      real_names,
+                                      vote_for_n, rcv_wrapper,
+                                      workers=workers)
+                    stats = {}
+                else:
+                    # stop early once the leader is clearly above or below
+                    # 1 - risk_limit, with num_trials as the maximum
+                    win_probs, stats = bptool.compute_win_probs_rcv_sequential(
+                                      sample_tallies,
+                                      [n],
+                                      seed,
+                                      num_trials,
+                                      unique_ballots,
+                                      real_names,
+                                      vote_for_n, rcv_wrapper,
+                                      risk_limit=risk_limit,
+                                      workers=workers)
+                win_probs_with_simulation_data = {real_names[i]: prob for i , prob in win_probs }
+                if stats:
+                    win_probs_with_simulation_data['num_trials'] = stats['num_trials']
+                    win_probs_with_simulation_data['ci_low'] = stats['interval'][0]
+                    win_probs_with_simulation_data['ci_high'] = stats['interval'][1]
+                win_probs_with_simulation_data['seed'] = seed
+                win_probs_with_simulation_data['time_delta'] = time_delta
+                win_probs_with_simulation_data['sample_size'] = sample_size
+                data.append(win_probs_with_simulation_data)
+
+            if store is not None:
+                store.add_rows(data[seed_start:], method, params)
+                data = []
+            elif  seed % 5 == 1:
+                print("At seed %d from 1 to %d"%(seed,simulations+1))
+                df = pd.DataFrame(data)
+                df.to_csv(output_file)
+    finally:
+        # stop the workers and free the shared memory even if the sweep
+        # fails
+        if pool:
+            trial_pool.close()
+    if store is not None:
+        store.to_csv(output_file, method, params)
+        return
     df = pd.DataFrame(data)
     df.to_csv(output_file)  
 
@@ -0,0 +1,198 @@
+# audit_session.py
+# python3
+
+"""
+Stage-by-stage ballot-polling audits of an RCV contest.
+
+A real audit draws ballots in rounds and asks for the win probabilities
+after each round.  bptool.compute_win_probs_rcv starts from a complete
+sample tally every time: it rebuilds the list of ballot types, the
+tally, the reduced types and the voting method's setup at each stage.
+An AuditSession keeps all of that between stages:
+
+  - an index of ballot types, which only ever grows, so the count vector
+    of the sample is updated in place as ballots are added;
+  - the IRV model (voting_models.IRVModel) compiled for the indexed
+    types, recompiled only when new types turn up, and restricted to the
+    types present in the sample for each computation;
+  - optionally, a trial_pool.TrialPool of worker processes, started
+    once, if the election's ballot types are known in advance (e.g. from
+    the CVRs, or in a simulation).
+
+Each stage runs trials 0, ..., num_trials-1 with the session's seed, so
+consecutive stages reuse the same random streams and their estimates
+move smoothly.  The counts are exactly those of bptool.run_trials on the
+sample's ballot types, in the order of the index, without type merging,
+and with the certificate of the sample's elimination order.
+
+Example:
+    session = AuditSession(n, seed=1)
+    session.add_ballots(first_round_ballots)
+    session.win_probs(real_names)
+    session.add_ballots(second_round_ballots)
+    session.win_probs(real_names)
+"""
+
+import numpy as np
+
+import bptool
+import rcv_certificate
+import trial_pool
+import voting_models
+
+
+class AuditSession:
+    """
+    The state of a ballot-polling audit of one RCV contest (a single
+    county); see the module docstring.
+
+    Args:
+        total_num_votes (int): number of ballots cast in the contest
+        seed (int): seed of the simulations (see bptool.resolve_seed)
+        num_trials (int): number of trials per computation
+        ballot_types (list): the contest's ballot types, if known in
+            advance; other types may still be added
+        workers (int): number of worker processes (needs ballot_types);
+            None or 1 runs the trials in this process
+        vote_for_n (int): number of winners
+        tie_breaker (list): as for rcv.rcv_winner (None for empty)
+
+    Attributes:
+        ballot_types (list): the indexed ballot types
+        counts (numpy array): sample count of each indexed type
+
+    A session with workers should be closed when done with; it is a
+    context manager that does so.
+    """
+
+    def __init__(self, total_num_votes, seed, num_trials=1000,
+                 ballot_types=None, workers=None, vote_for_n=1,
+                 tie_breaker=None):
+        self.total_num_votes = total_num_votes
+        self.seed = bptool.resolve_seed(seed)
+        self.num_trials = num_trials
+        self.vote_for_n = vote_for_n
+        self.tie_breaker = tie_breaker
+        self.ballot_types = []
+        self.type_index = {}
+        self.counts = np.zeros(0, dtype=np.int64)
+        self._model = None
+        self.pool = None
+        if ballot_types is not None:
+            self._index(ballot_types)
+        if workers is not None and workers > 1:
+            if ballot_types is None:
+                raise ValueError("AuditSession: workers need ballot_types.")
+            self.pool = trial_pool.TrialPool(self.ballot_types, 0, workers,
+                                             vote_for_n, tie_breaker)
+
+    def _index(self, ballots):
+        for ballot in ballots:
+            if ballot not in self.type_index:
+                self.type_index[ballot] = len(self.ballot_types)
+                self.ballot_types.append(ballot)
+        if len(self.ballot_types) > len(self.counts):
+            self.counts = np.concatenate([
+                self.counts,
+                np.zeros(len(self.ballot_types) - len(self.counts),
+                         dtype=np.int64)])
+            self._model = None
+
+    @property
+    def sample_size(self):
+        """
+        The number of ballots in the sample.
+        """
+
+        return int(self.counts.sum())
+
+    def add_ballots(self, ballots):
+        """
+        Add the sampled ballots (a list of ballot types, one per ballot)
+        to the sample.
+        """
+
+        if self.pool is not None:
+            unknown = [b for b in ballots if b not in self.type_index]
+            if unknown:
+                raise ValueError("add_ballots: ballot type {} is not one of "
+                                 "the pool's.".format(unknown[0]))
+        if self.sample_size + len(ballots) > self.total_num_votes:
+            raise ValueError("add_ballots: sample of {} ballots exceeds "
+                             "total_num_votes {}."
+                             .format(self.sample_size + len(ballots),
+                                     self.total_num_votes))
+        self._index(ballots)
+        ids = np.array([self.type_index[ballot] for ballot in ballots],
+                       dtype=np.int64)
+        self.counts += np.bincount(ids, minlength=len(self.counts))
+
+    def sample_tally(self):
+        """
+        Return the sample tally as a dict, ballot type to count.
+        """
+
+        present = np.flatnonzero(self.counts)
+        return {self.ballot_types[i]: int(self.counts[i]) for i in present}
+
+    def model(self):
+        """
+        Return the IRVModel compiled for all the indexed ballot types.
+        """
+
+        if self._model is None:
+            self._model = voting_models.IRVModel(
+                self.ballot_types, self.vote_for_n, self.tie_breaker)
+        return self._model
+
+    def count_wins(self):
+        """
+        Run the trials for the current sample, and return the dict of
+        win counts, as bptool.run_trials does.
+        """
+
+        if self.sample_size == 0:
+            raise ValueError("count_wins: no ballots added yet.")
+        if self.pool is not None:
+            return self.pool.count_wins(self.total_num_votes, self.seed,
+                                        self.num_trials, counts=self.counts)
+        present = np.flatnonzero(self.counts)
+        model = self.model().restrict(present)
+        sample_counts = self.counts[present].tolist()
+        certificate = None
+        if bptool.certificate_is_exact(model, self.vote_for_n):
+            certificate = rcv_certificate.build_certificate(
+                model.candidate_names, sample_counts, self.tie_breaker)
+        return bptool.count_wins([sample_counts], [self.total_num_votes],
+                                 self.vote_for_n, self.seed,
+                                 model.candidate_names, model, 0,
+                                 self.num_trials, certificate=certificate)
+
+    def win_probs(self, real_names=None):
+        """
+        Return the win probabilities for the current sample, as pairs
+        (i, p) for the candidates real_names (by default, the candidates
+        ranked in the sample, sorted).
+        """
+
+        if real_names is None:
+            real_names = sorted(set(name for ballot in self.sample_tally()
+                                    for name in ballot))
+        win_count = self.count_wins()
+        return [(i, win_count.get(name, 0) / float(self.num_trials))
+                for i, name in enumerate(real_names)]
+
+    def close(self):
+        """
+        Stop the worker pool, if any.
+        """
+
+        if self.pool is not None:
+            self.pool.close()
+            self.pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
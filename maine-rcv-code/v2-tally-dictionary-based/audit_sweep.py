@@ -0,0 +1,244 @@
+# audit_sweep.py
+# python3
+
+"""
+Parallel sweeps of simulated audits over seeds and sample sizes.
+
+audit_me.audit runs its grid of 1000 seeds times 30 sample sizes one
+cell at a time.  run_sweep spreads the grid over a pool of worker
+processes instead:
+
+  - the work is split into tasks, each a seed with all of its sample
+    sizes (or, with chunks_per_seed > 1, a share of them);
+  - the tasks are submitted largest first (by the sum of their sample
+    sizes), so the longest ones do not straggle at the end;
+  - each worker receives the election's ballot-type index once, when it
+    starts, computes a seed's sample order once, and tallies all of the
+    task's sample sizes from one pass over it (audit_me.get_prefix_tallies);
+  - run_sweep is a generator, yielding each cell's row as soon as its
+    task finishes.
+
+Each cell is computed from its seed alone, so the rows do not depend on
+the number of workers, only their order does.
+
+Example:
+    n, L = audit_me.get_ballot_list()
+    for row in run_sweep(n, L, range(1, 1001), range(100, 3001, 100),
+                         workers=8):
+        print(row)
+"""
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import time
+
+import numpy as np
+
+import audit_me
+import bptool
+import comparison_audit
+import results_store
+import voting_models
+
+METHODS = ("polling", "comparison_error_free")
+
+# Number of seeds whose sample orders each worker keeps.
+SAMPLE_ORDER_CACHE_SIZE = 2
+
+
+def sweep_tasks(seeds, sample_sizes, chunks_per_seed=1):
+    """
+    Return the list of tasks (seed, sample sizes) of a sweep, largest
+    first.  Each seed's sample sizes are sorted, and dealt into
+    chunks_per_seed tasks.
+
+    Example:
+        >>> sweep_tasks([1, 2], [300, 100, 200], 2)
+        [(1, [100, 300]), (2, [100, 300]), (1, [200]), (2, [200])]
+    """
+
+    sample_sizes = sorted(sample_sizes)
+    chunks_per_seed = max(1, min(chunks_per_seed, len(sample_sizes)))
+    tasks = [(seed, sample_sizes[k::chunks_per_seed])
+             for seed in seeds for k in range(chunks_per_seed)]
+    return sorted(tasks, key=lambda task: -sum(task[1]))
+
+
+# Per-process state of a sweep worker, set up by _init_sweep_worker.
+_sweep_state = None
+
+
+def _init_sweep_worker(n, election_ballots, ballot_types, num_trials,
+                       method, max_sample_size, sample_order_cache):
+    global _sweep_state
+    # every candidate in the election (on some CVR), sampled yet or not
+    candidates = sorted(set(name for ballot in election_ballots
+                            for name in ballot))
+    _sweep_state = {
+        "n": n,
+        "election_ballots": election_ballots,
+        "ballot_types": ballot_types,
+        "candidates": candidates,
+        "num_trials": num_trials,
+        "method": method,
+        "max_sample_size": max_sample_size,
+        "sample_order_cache": sample_order_cache,
+        "sample_orders": {},
+    }
+    if method == "comparison_error_free":
+        # the CVRs are the ballots themselves, as in audit_me.audit
+        counts = np.bincount(ballot_types, minlength=len(election_ballots))
+        _sweep_state["cvr_tally"] = dict(zip(election_ballots,
+                                             counts.tolist()))
+
+
+def _sample_order(seed):
+    """
+    Return the sample order of seed, computing it only if it is not one
+    of the last few this worker used.
+    """
+
+    cache = _sweep_state["sample_orders"]
+    if seed not in cache:
+        if len(cache) >= SAMPLE_ORDER_CACHE_SIZE:
+            del cache[next(iter(cache))]
+        # the same prefix for every task, so the sample-order cache
+        # files all have the same length
+        cache[seed] = audit_me.get_sample_order(
+            _sweep_state["n"], seed, _sweep_state["max_sample_size"],
+            _sweep_state["sample_order_cache"])
+    return cache[seed]
+
+
+def _run_cell(seed, sample_size, counts):
+    """
+    Return the row of one cell: the win probability of every candidate,
+    and the cell's parameters.
+    """
+
+    state = _sweep_state
+    start = time.time()
+    unique_ballots, sample_tally = \
+        audit_me.get_sub_sample_tally(counts, state["election_ballots"])
+    if state["method"] == "comparison_error_free":
+        sample_pairs = {(ballot, ballot): count
+                        for ballot, count in sample_tally.items()}
+        win_probs = comparison_audit.compute_win_probs_comparison(
+            state["cvr_tally"], sample_pairs, seed, state["num_trials"],
+            state["candidates"])
+    else:
+        win_probs = bptool.compute_win_probs_rcv(
+            [[sample_tally[ballot] for ballot in unique_ballots]],
+            [state["n"]], seed, state["num_trials"], unique_ballots,
+            state["candidates"], 1, voting_models.IRVModel)
+    row = {state["candidates"][i]: p for i, p in win_probs}
+    row["sample_size"] = sample_size
+    row["seed"] = seed
+    row["method"] = state["method"]
+    row["num_trials"] = state["num_trials"]
+    row["time_delta"] = time.time() - start
+    return row
+
+
+def _run_task(seed, sample_sizes):
+    state = _sweep_state
+    prefix_tallies = audit_me.get_prefix_tallies(
+        state["ballot_types"], _sample_order(seed), sample_sizes,
+        len(state["election_ballots"]))
+    return [_run_cell(seed, sample_size, counts)
+            for sample_size, counts in zip(sample_sizes, prefix_tallies)]
+
+
+def run_sweep(n, L, seeds, sample_sizes, num_trials=1000, method="polling",
+              workers=None, chunks_per_seed=1, skip=None,
+              sample_order_cache=None):
+    """
+    Run the simulated audits of a grid of seeds and sample sizes, and
+    yield one row per cell, as each task finishes.
+
+    Args:
+        n (int): number of ballots in the election
+        L (list): the ballots, as from audit_me.get_ballot_list
+        seeds (iterable): the seeds of the sample orders
+        sample_sizes (iterable): the sample sizes of every seed
+        num_trials (int): trials per cell
+        method (str): "polling" (bptool.compute_win_probs_rcv) or
+            "comparison_error_free" (comparison_audit, with the ballots
+            themselves as CVRs, so no discrepancy can be found: a
+            demonstration, not a simulation of a real comparison audit)
+        workers (int): number of worker processes; None or 1 runs the
+            tasks in this process
+        chunks_per_seed (int): number of tasks each seed's sample sizes
+            are split into; 1 computes each sample order only once
+        skip (set): (seed, sample_size) cells not to run, e.g. those
+            already in a results store
+        sample_order_cache: None, or a sample_order_cache.SampleOrderCache
+            from which the workers read the sample orders (and to which
+            they add them)
+
+    Yields:
+        (dict): the row of a cell, mapping each candidate name to its win
+            probability, and "sample_size", "seed", "method",
+            "num_trials" and "time_delta" (seconds spent on the cell) to
+            their values
+    """
+
+    if method not in METHODS:
+        raise ValueError("run_sweep: unknown method {}.".format(method))
+    sample_sizes = sorted(sample_sizes)
+    election_ballots, ballot_types = audit_me.get_ballot_type_index(L)
+    tasks = []
+    for seed, task_sizes in sweep_tasks(seeds, sample_sizes,
+                                        chunks_per_seed):
+        if skip:
+            task_sizes = [size for size in task_sizes
+                          if (seed, size) not in skip]
+        if task_sizes:
+            tasks.append((seed, task_sizes))
+    initargs = (n, election_ballots, ballot_types, num_trials, method,
+                sample_sizes[-1], sample_order_cache)
+
+    if workers is None or workers <= 1:
+        _init_sweep_worker(*initargs)
+        for seed, task_sizes in tasks:
+            yield from _run_task(seed, task_sizes)
+        return
+
+    with ProcessPoolExecutor(max_workers=workers,
+                             initializer=_init_sweep_worker,
+                             initargs=initargs) as executor:
+        futures = [executor.submit(_run_task, seed, task_sizes)
+                   for seed, task_sizes in tasks]
+        for future in as_completed(futures):
+            yield from future.result()
+
+
+def sweep_to_store(store, n, L, seeds, sample_sizes, num_trials=1000,
+                   method="polling", workers=None, chunks_per_seed=1,
+                   sample_order_cache=None):
+    """
+    Run the cells of a sweep not yet in store (a
+    results_store.ResultsStore), adding each row to it as soon as it
+    arrives, so an interrupted sweep can simply be run again.
+
+    Args:
+        as for run_sweep
+
+    Returns:
+        (int): number of rows added
+    """
+
+    # the voting method of both methods, as in _run_cell
+    params = results_store.cell_params(num_trials,
+                                       voting_method="IRVModel")
+    added = 0
+    for row in run_sweep(n, L, seeds, sample_sizes, num_trials, method,
+                         workers, chunks_per_seed,
+                         skip=store.done_cells(method, params),
+                         sample_order_cache=sample_order_cache):
+        added += store.add_rows([row], method, params)
+    return added
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
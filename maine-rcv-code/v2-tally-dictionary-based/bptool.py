@@ -37,6 +37,18 @@ For command-line usage, there are really two modes:
     "county name" and "total votes" are required; the candidate names are
     the candidate names for the contest being audited.
 
+(3) For an RCV (instant-runoff) contest, give a command like
+        python bptool.py 296077 --rcv_ballots sample.csv
+    where
+        296077 is the total number of ballots cast in the contest
+        sample.csv has one sampled ballot per line, its choices in order
+        of preference (as in rcv.read_ME_data; overvotes and undervotes
+        are cleaned by the rcv.py rules)
+    Trials are run in batches (--batch_size) until the leading
+    candidate's win probability is known to within --half_width, or
+    --num_trials trials have been run, optionally spread over --workers
+    worker processes.
+
 There are optional parameters as well, to see the documentation of them, do
     python bptool.py --h
 
@@ -60,12 +72,21 @@ More description of Bayesian auditing methods can be found in:
 
 import argparse
 
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from copy import deepcopy
 import csv
+from statistics import NormalDist
 import sys
+import time
 
 import numpy as np
 
+import exact_win_probs
+import rcv
+import rcv_certificate
+import rcv_reduction
+import voting_models
+
 ##############################################################################
 ## Random number generation
 ##############################################################################
@@ -128,16 +149,89 @@ def create_rs(seed):
     return np.random.RandomState(seed)
 
 
+def resolve_seed(seed):
+    """
+    Return seed unchanged if it is an integer, or a fresh integer
+    drawn from operating-system entropy if seed is None.
+
+    Per-trial streams (see create_trial_rng) are all derived from one
+    integer seed, so a seed of None must be resolved once, up front,
+    rather than separately for each trial.
+
+    Input Parameters:
+
+    -seed is a nonnegative integer or None.
+
+    Returns:
+
+    -a nonnegative python integer.
+    """
+
+    if seed is None:
+        return np.random.SeedSequence().entropy
+    seed = int(seed)
+    if seed < 0:
+        raise ValueError("resolve_seed: {} is not a nonnegative integer."
+                         .format(seed))
+    return seed
+
+
+def create_trial_rng(seed, trial_index):
+    """
+    Create and return a numpy Generator giving the random stream for
+    trial number trial_index of an audit with the given seed.
+
+    The stream is seeded by SeedSequence(seed, spawn_key=(trial_index,)),
+    which is exactly the trial_index'th child of
+    SeedSequence(seed).spawn(...).  So the streams for different trials
+    are statistically independent, and the stream for any one trial can
+    be regenerated directly, without generating the streams of the trials
+    before it.  This is what lets a single trial be replayed, and a range
+    of trials be split across workers with bit-identical results.
+
+    Input Parameters:
+
+    -seed is a nonnegative integer (see resolve_seed for handling None).
+
+    -trial_index is a nonnegative integer, the number of the trial.
+
+    Returns:
+
+    -a numpy.random.Generator object (PCG64 bit generator) for that trial.
+    """
+
+    seed_seq = np.random.SeedSequence(seed, spawn_key=(trial_index,))
+    return np.random.Generator(np.random.PCG64(seed_seq))
+
+
 ##############################################################################
 ## Main computational routines
 ##############################################################################
 
-def dirichlet_multinomial(sample_tally, total_num_votes, rs):
+def dirichlet_multinomial(sample_tally, total_num_votes, rs, approx=None,
+                          prior=None):
     """
     Return a sample according to the Dirichlet multinomial distribution,
     given a sample tally, the number of votes in the election,
     and a random state. There is an additional pseudocount of
-    one vote per candidate in this simulation.
+    one vote per candidate in this simulation, unless another prior
+    is given.  (When several ballot types are merged into one, the merged
+    type's pseudocount is the number of types merged, which keeps the
+    posterior exactly the same.)
+
+    When the nonsample is much larger than the sample, the multinomial
+    step adds little variance compared to the Dirichlet step, and
+    one of two approximations may be requested with approx:
+        "scaled": skip the multinomial and return the Dirichlet
+            proportions times the nonsample size;
+        "gaussian": replace the multinomial by a normal vector with the
+            same mean and covariance, clipped at zero and then rescaled
+            to sum to the nonsample size again (clipping alone would
+            add votes; the rescaling moves the mean and covariance
+            slightly, by amounts that vanish with the chance of a
+            negative count).
+    Both return real-valued tallies.  See approximation_error_bound for
+    how far they are from the exact distribution.
 
     Input Parameters:
 
@@ -148,13 +242,19 @@ def dirichlet_multinomial(sample_tally, total_num_votes, rs):
     -total_num_votes is an integer representing the number of
     ballots that were cast in this election within the county.
 
-    -rs is a Numpy RandomState object that is used for any
+    -rs is a Numpy RandomState or Generator object that is used for any
     random functions in the simulation of the remaining votes. In particular,
     the gamma functions are made deterministic using this state.
 
+    -approx is None (exact), "scaled" or "gaussian".
+
+    -prior is None, or a list of positive pseudocounts, one per entry
+    of sample_tally.  None means a pseudocount of one for each entry.
+
     Returns:
 
-    -multinomial_sample is a list of integers, which sums up
+    -multinomial_sample is a list of integers (reals if approx is given),
+    which sums up
     to the total_num_votes - sample_size. The i'th index represents the
     simulated number of votes for candidate i in the remaining, unsampled
     votes.
@@ -167,21 +267,104 @@ def dirichlet_multinomial(sample_tally, total_num_votes, rs):
 
     nonsample_size = total_num_votes - sample_size
 
-    pseudocount_for_prior = 1
-    sample_with_prior = deepcopy(sample_tally)
-    sample_with_prior = [k + pseudocount_for_prior
-                         for k in sample_with_prior]
+    if prior is None:
+        pseudocount_for_prior = 1
+        sample_with_prior = deepcopy(sample_tally)
+        sample_with_prior = [k + pseudocount_for_prior
+                             for k in sample_with_prior]
+    else:
+        sample_with_prior = [k + pseudocount
+                             for k, pseudocount in zip(sample_tally, prior)]
 
     gamma_sample = [rs.gamma(k) for k in sample_with_prior]
     gamma_sample_sum = float(sum(gamma_sample))
     gamma_sample = [k / gamma_sample_sum for k in gamma_sample]
 
-    multinomial_sample = rs.multinomial(nonsample_size, gamma_sample)
+    if approx is None:
+        multinomial_sample = rs.multinomial(nonsample_size, gamma_sample)
+    elif approx == "scaled":
+        multinomial_sample = nonsample_size * np.array(gamma_sample)
+    elif approx == "gaussian":
+        # x = n p + sqrt(n) (y - p sum(y)) with y = sqrt(p) z has
+        # covariance n (diag(p) - p p^T), as a multinomial does.
+        p = np.array(gamma_sample)
+        y = np.sqrt(p) * rs.standard_normal(len(p))
+        multinomial_sample = nonsample_size * p \
+            + np.sqrt(nonsample_size) * (y - p * y.sum())
+        multinomial_sample = np.maximum(multinomial_sample, 0.0)
+        clipped_sum = multinomial_sample.sum()
+        if clipped_sum > 0:
+            multinomial_sample *= nonsample_size / clipped_sum
+    else:
+        raise ValueError("dirichlet_multinomial: unknown approx {}."
+                         .format(approx))
 
     return multinomial_sample
 
 
-def generate_nonsample_tally(sample_tally, total_num_votes, seed):
+def approximation_error_bound(sample_tallies, total_num_votes, approx,
+                              priors=None):
+    """
+    Return a bound on how far the approximate nonsample tallies of
+    dirichlet_multinomial are from the exact ones, for these sample tallies.
+
+    For "scaled", the bound is the relative error in the standard deviation
+    of every simulated count.  The exact (Dirichlet-multinomial) variance of
+    a count is n p (1-p) (n + A) / (1 + A), where n is the nonsample size
+    and A the sum of the sample tally and prior; dropping the multinomial
+    leaves n^2 p (1-p) / (1 + A).  So the standard deviation is too small by
+    the factor sqrt(n / (n + A)), whatever p is.
+
+    For "gaussian", mean and covariance are exact (up to the clipping of
+    negative counts, see dirichlet_multinomial), and the bound is the
+    Berry-Esseen bound 0.4748 (p^2 + q^2) / sqrt(n p q) on the Kolmogorov
+    distance between each count's normal approximation and its binomial
+    distribution, taken at the posterior mean p of each ballot type.
+
+    In both cases the largest value over all counties (and ballot types)
+    is returned.  compare_approximation measures the resulting difference
+    in estimated win probabilities directly.
+
+    Input Parameters:
+
+    -sample_tallies and total_num_votes are as for compute_winner.
+
+    -approx is "scaled" or "gaussian".
+
+    -priors is None or a list of priors, one per county, as for
+    compute_winner.
+
+    Returns:
+
+    -a float bound, as described above.
+    """
+
+    bound = 0.0
+    for i, (sample_tally, total) in enumerate(zip(sample_tallies,
+                                                  total_num_votes)):
+        prior = 1 if priors is None else np.array(priors[i], dtype=float)
+        sample_with_prior = np.array(sample_tally, dtype=float) + prior
+        prior_size = sample_with_prior.sum()
+        nonsample_size = total - sum(sample_tally)
+        if nonsample_size <= 0:
+            continue
+        if approx == "scaled":
+            county_bound = \
+                1 - np.sqrt(nonsample_size / (nonsample_size + prior_size))
+        elif approx == "gaussian":
+            p = sample_with_prior / prior_size
+            q = 1 - p
+            county_bound = np.max(0.4748 * (p * p + q * q)
+                                  / np.sqrt(nonsample_size * p * q))
+        else:
+            raise ValueError("approximation_error_bound: unknown approx {}."
+                             .format(approx))
+        bound = max(bound, float(county_bound))
+    return bound
+
+
+def generate_nonsample_tally(sample_tally, total_num_votes, seed,
+                             approx=None, prior=None):
     """
     Given a sample_tally, the total number of votes in an election, and a seed,
     generate the nonsample tally in the election using the Dirichlet multinomial
@@ -199,6 +382,10 @@ def generate_nonsample_tally(sample_tally, total_num_votes, seed):
     -seed is an integer or None. Assuming that it isn't None, we
     use it to seed the random state for the audit.
 
+    -approx is None, "scaled" or "gaussian" (see dirichlet_multinomial).
+
+    -prior is None or a list of pseudocounts (see dirichlet_multinomial).
+
     Returns:
 
     -nonsample_tally is list of integers, which sums up
@@ -208,7 +395,8 @@ def generate_nonsample_tally(sample_tally, total_num_votes, seed):
     """
 
     rs = create_rs(seed)
-    nonsample_tally = dirichlet_multinomial(sample_tally, total_num_votes, rs)
+    nonsample_tally = dirichlet_multinomial(sample_tally, total_num_votes, rs,
+                                            approx, prior)
     return nonsample_tally
 
 def plurality_winner(candidate_names, tallies, vote_for_n):
@@ -228,7 +416,8 @@ def plurality_winner(candidate_names, tallies, vote_for_n):
     
 
 def compute_winner(sample_tallies, total_num_votes, vote_for_n,
-                   seed, candidate_names, voting_method = plurality_winner ,  pretty_print=False):
+                   seed, candidate_names, voting_method = plurality_winner ,  pretty_print=False,
+                   rng=None, approx=None, priors=None):
     """
     Given a list of sample tallies (one sample tally per county)
     a list giving the total number of votes cast in each county,
@@ -252,7 +441,8 @@ def compute_winner(sample_tallies, total_num_votes, vote_for_n,
     total number of votes in the entire election.
 
     -seed is an integer or None. Assuming that it isn't None, we
-    use it to seed the random state for the audit.
+    use it to seed the random state for the audit.  It is ignored if
+    rng is given.
 
     -vote_for_n is an integer, parsed from the command-line args. Its default
     value is 1, which means we only calculate a single winner for the election.
@@ -270,17 +460,59 @@ def compute_winner(sample_tallies, total_num_votes, vote_for_n,
     True, we print the winning candidate, the number of votes they have
     received and the final vote tally for all the candidates.
 
+    -rng is a numpy Generator (see create_trial_rng) or None.  If given,
+    the nonsample tallies of all counties are drawn in turn from this one
+    stream, so the counties are simulated independently of each other.
+    If None, a RandomState seeded with seed is created and likewise used
+    by all the counties in turn.  (Seeding every county's RandomState
+    with the same seed would correlate their draws.)
+
+    -approx is None, "scaled" or "gaussian" (see dirichlet_multinomial).
+
+    -priors is None, or a list of lists of pseudocounts, shaped like
+    sample_tallies (see dirichlet_multinomial).  None means a pseudocount
+    of one for every entry.
+
     Returns:
 
     -winners is a list of integers, representing the indices of the candidate
     who won the election. It's size equals the vote_for_n parameter, which
     defaults to 1.
     """
- 
+
+    final_tallies = compute_final_tally(sample_tallies, total_num_votes,
+                                        seed, rng=rng, approx=approx,
+                                        priors=priors)
+    final_tallies = [(k, final_tallies[k]) for k in range(len(final_tallies))]
+    
+    winners = voting_method(candidate_names, final_tallies, vote_for_n)
+    return winners
+
+
+def compute_final_tally(sample_tallies, total_num_votes, seed, rng=None,
+                        approx=None, priors=None):
+    """
+    Simulate the nonsample tally of every county, and return the sum over
+    all counties of the sample and nonsample tallies.
+
+    Input Parameters:
+
+    -sample_tallies, total_num_votes, seed, rng, approx and priors are as
+    for compute_winner.
+
+    Returns:
+
+    -final_tallies is a list giving, for each candidate (or ballot type),
+    its simulated total over all the counties.
+    """
+
+    if rng is None:
+        rng = create_rs(seed)
     final_tallies = None
     for i, sample_tally in enumerate(sample_tallies):   # loop over counties
-        nonsample_tally = generate_nonsample_tally(
-            sample_tally, total_num_votes[i], seed)
+        prior = None if priors is None else priors[i]
+        nonsample_tally = dirichlet_multinomial(
+            sample_tally, total_num_votes[i], rng, approx, prior)
         final_county_tally = [sum(k)
                               for k in zip(sample_tally, nonsample_tally)]
         if final_tallies is None:
@@ -288,10 +520,756 @@ def compute_winner(sample_tallies, total_num_votes, vote_for_n,
         else:
             final_tallies = [sum(k)
                            for k in zip(final_tallies, final_county_tally)]
-    final_tallies = [(k, final_tallies[k]) for k in range(len(final_tallies))]
-    
-    winners = voting_method(candidate_names, final_tallies, vote_for_n)
-    return winners
+    return final_tallies
+
+
+def compute_trial_winner(sample_tallies, total_num_votes, vote_for_n,
+                         seed, trial_index, candidate_names,
+                         voting_method=plurality_winner, approx=None,
+                         priors=None):
+    """
+    Compute the winner(s) of trial number trial_index of the simulation
+    with the given seed.
+
+    The trial draws from its own stream create_trial_rng(seed, trial_index),
+    so any single trial can be replayed without running the trials
+    before it, and it gives the same answer as it does inside
+    compute_win_probs or compute_win_probs_rcv.
+
+    Input Parameters:
+
+    -sample_tallies, total_num_votes, vote_for_n, candidate_names,
+    voting_method, approx and priors are as for compute_winner.
+
+    -seed is a nonnegative integer, the seed of the whole simulation.
+
+    -trial_index is a nonnegative integer, the number of the trial.
+
+    Returns:
+
+    -whatever voting_method returns for the simulated final tally.
+    """
+
+    rng = create_trial_rng(seed, trial_index)
+    return compute_winner(sample_tallies, total_num_votes, vote_for_n,
+                          None, candidate_names,
+                          voting_method=voting_method, rng=rng,
+                          approx=approx, priors=priors)
+
+
+##############################################################################
+## Running trials, serially or in parallel
+##############################################################################
+
+def count_wins(sample_tallies, total_num_votes, vote_for_n, seed,
+               candidate_names, voting_method, first_trial, last_trial,
+               approx=None, priors=None, certificate=None, stats=None):
+    """
+    Run trials first_trial, ..., last_trial-1 and count how often each
+    winner occurs.
+
+    If a certificate is given, or voting_method is a voting model (see
+    voting_models), the trials are run in batches: the final tallies of a
+    batch are simulated, the certificate is checked for all of them at
+    once, and the rest are tabulated by voting_method, one call per trial
+    for an old-style voting method, or one call per batch for a model.
+
+    Input Parameters:
+
+    -sample_tallies, total_num_votes, vote_for_n, candidate_names,
+    approx and priors are as for compute_winner.
+
+    -voting_method is as for compute_winner, or a voting_models.VotingModel
+    for candidate_names, or a subclass of VotingModel, which is compiled
+    for candidate_names and vote_for_n.
+
+    -seed is a nonnegative integer, the seed of the whole simulation.
+
+    -first_trial and last_trial are integers giving the half-open range
+    of trial indices to run.
+
+    -certificate is None or an rcv_certificate.IRVCertificate for
+    candidate_names (the ballot types); its winner is the winner of every
+    trial for which it holds.
+
+    -stats is None or a trial_stats.TrialStats, to which the outcome of
+    every trial is added; voting_method must then be an IRVModel (or the
+    class), and the certificate is not used, since every trial has to be
+    tabulated in full.
+
+    Returns:
+
+    -win_count is a dict mapping each winner returned by voting_method
+    to the number of trials it won.  If voting_method returns a list of
+    winners (as plurality_winner does), each winner in the list is counted.
+    """
+
+    win_count = {}
+
+    def record(winners):
+        if not isinstance(winners, list):
+            winners = [winners]
+        for winner in winners:
+            win_count[winner] = win_count.get(winner, 0) + 1
+
+    model = voting_models.as_model(voting_method, candidate_names,
+                                   vote_for_n)
+    if stats is not None:
+        if not isinstance(model, voting_models.IRVModel):
+            raise ValueError("count_wins: stats need an IRVModel.")
+        certificate = None
+    if certificate is None and model is None:
+        for i in range(first_trial, last_trial):
+            record(compute_trial_winner(sample_tallies,
+                                        total_num_votes,
+                                        vote_for_n,
+                                        seed, i, candidate_names,
+                                        voting_method=voting_method,
+                                        approx=approx, priors=priors))
+        return win_count
+
+    for batch_first in range(first_trial, last_trial, CERTIFICATE_BATCH_SIZE):
+        batch = range(batch_first,
+                      min(batch_first + CERTIFICATE_BATCH_SIZE, last_trial))
+        final_tallies = [compute_final_tally(sample_tallies,
+                                             total_num_votes, None,
+                                             rng=create_trial_rng(seed, i),
+                                             approx=approx, priors=priors)
+                         for i in batch]
+        if certificate is None:
+            certified = np.zeros(len(final_tallies), dtype=bool)
+        else:
+            certified = certificate.holds(final_tallies)
+            if certified.any():
+                win_count[certificate.winner] = \
+                    win_count.get(certificate.winner, 0) + int(certified.sum())
+        if stats is not None:
+            outcome = model.tabulate(np.array(final_tallies, dtype=float))
+            add_model_wins(win_count, model, outcome["winners"])
+            stats.add(model, outcome)
+            continue
+        if model is not None:
+            if not certified.all():
+                add_model_wins(win_count, model,
+                               model.winners(np.array(final_tallies)
+                                             [~certified]))
+            continue
+        for final_tally, holds in zip(final_tallies, certified):
+            if not holds:
+                final_tally = [(k, final_tally[k])
+                               for k in range(len(final_tally))]
+                record(voting_method(candidate_names, final_tally,
+                                     vote_for_n))
+    return win_count
+
+
+# Number of trials simulated together when checking a certificate or
+# tabulating with a voting model.
+CERTIFICATE_BATCH_SIZE = 256
+
+
+# Inputs and options shared by all trials, set once per worker process
+# by _init_trial_worker so they are not pickled again for every shard.
+_worker_inputs = None
+_worker_options = None
+
+
+def _init_trial_worker(inputs, options):
+    global _worker_inputs, _worker_options
+    _worker_inputs = inputs
+    _worker_options = options
+
+
+def _count_wins_in_worker(first_trial, last_trial):
+    return _count_wins_with_stats(*_worker_inputs, first_trial, last_trial,
+                                  **_worker_options)
+
+
+def _count_wins_with_stats(*args, stats=None, **options):
+    """
+    Return (win_count, stats) for the trials of count_wins(*args), with
+    the trials' outcomes in a fresh copy of stats (None if stats is None),
+    so that shards run concurrently each fill their own.
+    """
+
+    if stats is not None:
+        stats = stats.empty()
+    return count_wins(*args, stats=stats, **options), stats
+
+
+def gil_enabled():
+    """
+    Return True unless this is a free-threaded (no-GIL) CPython build
+    running with the GIL disabled.
+    """
+
+    is_gil_enabled = getattr(sys, "_is_gil_enabled", None)
+    return True if is_gil_enabled is None else is_gil_enabled()
+
+
+def split_trials(num_trials, num_shards, first_trial=0):
+    """
+    Split range(first_trial, first_trial+num_trials) into at most
+    num_shards contiguous, nearly equal (first, last) ranges, in order.
+    """
+
+    num_shards = max(1, min(num_shards, num_trials))
+    bounds = [first_trial + num_trials * k // num_shards
+              for k in range(num_shards + 1)]
+    return [(bounds[k], bounds[k+1]) for k in range(num_shards)
+            if bounds[k] < bounds[k+1]]
+
+
+def run_trials(sample_tallies, total_num_votes, vote_for_n, seed,
+               num_trials, candidate_names, voting_method=plurality_winner,
+               workers=None, backend="process", first_trial=0,
+               approx=None, priors=None, certificate=None, stats=None):
+    """
+    Run trials first_trial, ..., first_trial+num_trials-1 (by default
+    0, ..., num_trials-1) and return the combined win counts,
+    using a pool of worker processes or threads if workers > 1.
+
+    The trials are sharded into contiguous ranges of trial indices.
+    Each process worker receives the shared inputs (sample tallies, totals,
+    candidate names or ballot types, voting method) once, when it starts,
+    and thereafter only the (first, last) bounds of each shard.  Thread
+    workers share the inputs directly, read-only; each shard counts its
+    wins in its own dict, and nothing at module level is modified.  Since
+    every trial regenerates its own stream from seed and its index, and
+    the per-shard counts are summed, the result is identical for every
+    number of workers and either backend.
+
+    The thread backend only runs trials concurrently on a free-threaded
+    CPython build.  With the GIL present, it gives each thread a single
+    large shard, to keep the switching overhead down.
+
+    Input Parameters:
+
+    -sample_tallies, total_num_votes, vote_for_n, candidate_names and
+    voting_method are as for compute_winner.  When workers > 1,
+    voting_method must be picklable (e.g. a module-level function).
+
+    -seed is a nonnegative integer, the seed of the whole simulation.
+
+    -num_trials is the number of trials to run.
+
+    -workers is None or a positive integer, the number of worker
+    processes or threads.  None or 1 runs the trials in this thread.
+
+    -backend is "process" or "thread".
+
+    -first_trial is the index of the first trial to run.
+
+    -approx is None, "scaled" or "gaussian" (see dirichlet_multinomial).
+
+    -priors is None or a list of lists of pseudocounts (see compute_winner).
+
+    -certificate is None or an rcv_certificate.IRVCertificate (see
+    count_wins).
+
+    -stats is None or a trial_stats.TrialStats (see count_wins).  Each
+    shard fills its own, and they are merged into stats in the order of
+    the shards.
+
+    Returns:
+
+    -win_count is a dict as returned by count_wins.
+    """
+
+    if backend not in ("process", "thread"):
+        raise ValueError("run_trials: unknown backend {}.".format(backend))
+    inputs = (sample_tallies, total_num_votes, vote_for_n, seed,
+              candidate_names, voting_method)
+    options = {"approx": approx, "priors": priors,
+               "certificate": certificate}
+    if workers is None or workers <= 1 or num_trials <= 1:
+        return count_wins(*inputs, first_trial, first_trial + num_trials,
+                          stats=stats, **options)
+    options["stats"] = stats
+    with _trial_executor(inputs, options, workers, backend) as executor:
+        return _run_trial_shards(executor, inputs, options, workers,
+                                 backend, num_trials, first_trial, stats)
+
+
+def _trial_executor(inputs, options, workers, backend):
+    """
+    Return a new executor of workers processes (each given inputs and
+    options once, when it starts) or threads, for _run_trial_shards.
+    """
+
+    if backend == "thread":
+        return ThreadPoolExecutor(max_workers=workers)
+    return ProcessPoolExecutor(max_workers=workers,
+                               initializer=_init_trial_worker,
+                               initargs=(inputs, options))
+
+
+def _run_trial_shards(executor, inputs, options, workers, backend,
+                      num_trials, first_trial, stats):
+    """
+    Run trials first_trial, ..., first_trial+num_trials-1 on executor
+    (from _trial_executor, with the same inputs and options), in shards,
+    and return the combined win counts, as run_trials does.
+    """
+
+    if backend == "thread":
+        shards_per_worker = 1 if gil_enabled() else 4
+        shards = split_trials(num_trials, shards_per_worker * workers,
+                              first_trial)
+        futures = [executor.submit(_count_wins_with_stats, *inputs,
+                                   first, last, **options)
+                   for first, last in shards]
+    else:
+        # A few shards per worker keeps the pool busy if trials vary in cost.
+        shards = split_trials(num_trials, 4 * workers, first_trial)
+        futures = [executor.submit(_count_wins_in_worker, first, last)
+                   for first, last in shards]
+    win_count = {}
+    for future in futures:
+        shard_win_count, shard_stats = future.result()
+        for winner, count in shard_win_count.items():
+            win_count[winner] = win_count.get(winner, 0) + count
+        if stats is not None:
+            stats.merge(shard_stats)
+    return win_count
+
+
+def compare_approximation(sample_tallies, total_num_votes, vote_for_n, seed,
+                          num_trials, candidate_names,
+                          voting_method=plurality_winner, approx="scaled",
+                          workers=None, backend="process"):
+    """
+    Run the same trials exactly and with the given approximation, and
+    report how far apart the estimated win probabilities are.
+
+    With a Generator stream per trial, both runs draw the same Dirichlet
+    proportions in every trial, so the comparison is paired and its
+    differences come from the approximation alone.
+
+    Input Parameters:
+
+    -the parameters are as for run_trials; approx is "scaled" or
+    "gaussian".
+
+    Returns:
+
+    -a dict with keys "max_abs_difference" (the largest difference over
+    all winners of the two estimated win probabilities) and
+    "error_bound" (as returned by approximation_error_bound).
+    """
+
+    exact = run_trials(sample_tallies, total_num_votes, vote_for_n, seed,
+                       num_trials, candidate_names, voting_method,
+                       workers=workers, backend=backend)
+    approximate = run_trials(sample_tallies, total_num_votes, vote_for_n,
+                             seed, num_trials, candidate_names,
+                             voting_method, workers=workers,
+                             backend=backend, approx=approx)
+    winners = set(exact) | set(approximate)
+    max_abs_difference = max(
+        [abs(exact.get(w, 0) - approximate.get(w, 0)) / float(num_trials)
+         for w in winners] + [0.0])
+    return {"max_abs_difference": max_abs_difference,
+            "error_bound": approximation_error_bound(sample_tallies,
+                                                     total_num_votes,
+                                                     approx)}
+
+
+def wilson_interval(successes, num_trials, confidence=0.95):
+    """
+    Return the Wilson score interval (low, high) for a binomial
+    proportion, given successes out of num_trials.  Unlike the plain
+    normal interval it is sensible when successes is 0 or num_trials,
+    which is the usual case for win probabilities in our sweeps.
+    """
+
+    if num_trials == 0:
+        return (0.0, 1.0)
+    z = NormalDist().inv_cdf(0.5 + confidence / 2)
+    p = successes / num_trials
+    denominator = 1 + z * z / num_trials
+    center = (p + z * z / (2 * num_trials)) / denominator
+    half_width = (z / denominator) * \
+        ((p * (1 - p) / num_trials + z * z / (4 * num_trials ** 2)) ** 0.5)
+    return (max(0.0, center - half_width), min(1.0, center + half_width))
+
+
+def run_trials_sequential(sample_tallies, total_num_votes, vote_for_n, seed,
+                          max_trials, candidate_names,
+                          voting_method=plurality_winner,
+                          batch_size=100, half_width=0.01, risk_limit=None,
+                          time_budget=None, confidence=0.95,
+                          workers=None, backend="process", approx=None,
+                          priors=None, certificate=None):
+    """
+    Run trials in batches of batch_size, stopping as soon as the
+    probability that the leading winner wins is known well enough.
+
+    After each batch we compute a Wilson interval for the leading
+    winner's probability, and stop if:
+        the interval's half-width is at most half_width ("precision"), or
+        risk_limit is given and the interval lies entirely above or
+        entirely below 1 - risk_limit ("risk_limit"), or
+        time_budget seconds have elapsed ("time_budget"), or
+        max_trials trials have been run ("max_trials").
+    Trials are numbered consecutively from 0, so stopping after t trials
+    gives exactly the counts that a fixed run of t trials would give.
+    With workers > 1, one pool of workers serves all the batches.
+
+    The interval is recomputed after every batch, and these repeated
+    looks are not corrected for optional stopping: the chance that some
+    interval along the way misses the true probability is larger than
+    1 - confidence.  The rules bound the Monte Carlo error of the
+    estimate, not the risk of the audit itself; a smaller batch_size
+    means more looks, and a wider margin may be wanted.
+
+    Input Parameters:
+
+    -sample_tallies, total_num_votes, vote_for_n, seed, candidate_names,
+    voting_method, workers, backend, approx, priors and certificate are
+    as for run_trials.
+
+    -max_trials is the largest number of trials to run (at least 1).
+
+    -batch_size is the number of trials run between checks (at least 1).
+
+    -half_width is the target half-width of the interval, or None.
+
+    -risk_limit is the risk limit of the audit (e.g. 0.05), or None.
+
+    -time_budget is a wall-clock limit in seconds, or None.
+
+    -confidence is the confidence level of the interval.
+
+    Returns:
+
+    -(win_count, stats) where win_count is a dict as returned by
+    count_wins, and stats is a dict with keys "num_trials",
+    "leader" (the winner with the highest count), "interval"
+    (the Wilson interval for the leader's win probability) and
+    "stop_reason".
+    """
+
+    if max_trials < 1 or batch_size < 1:
+        raise ValueError("run_trials_sequential: max_trials and batch_size "
+                         "must be at least 1.")
+    if backend not in ("process", "thread"):
+        raise ValueError("run_trials_sequential: unknown backend {}."
+                         .format(backend))
+    inputs = (sample_tallies, total_num_votes, vote_for_n, seed,
+              candidate_names, voting_method)
+    options = {"approx": approx, "priors": priors,
+               "certificate": certificate, "stats": None}
+    if workers is None or workers <= 1:
+        return _run_batches_sequential(
+            inputs, options, None, workers, backend, max_trials,
+            batch_size, half_width, risk_limit, time_budget, confidence)
+    with _trial_executor(inputs, options, workers, backend) as executor:
+        return _run_batches_sequential(
+            inputs, options, executor, workers, backend, max_trials,
+            batch_size, half_width, risk_limit, time_budget, confidence)
+
+
+def _run_batches_sequential(inputs, options, executor, workers, backend,
+                            max_trials, batch_size, half_width, risk_limit,
+                            time_budget, confidence):
+    """
+    The stopping loop of run_trials_sequential, running each batch on
+    executor (None to run it in this thread).
+    """
+
+    start = time.time()
+    win_count = {}
+    num_trials = 0
+    while True:
+        batch = min(batch_size, max_trials - num_trials)
+        if executor is None:
+            batch_win_count = count_wins(*inputs, num_trials,
+                                         num_trials + batch, **options)
+        else:
+            batch_win_count = _run_trial_shards(
+                executor, inputs, options, workers, backend, batch,
+                num_trials, None)
+        for winner, count in batch_win_count.items():
+            win_count[winner] = win_count.get(winner, 0) + count
+        num_trials += batch
+
+        leader = max(win_count, key=win_count.get)
+        interval = wilson_interval(win_count[leader], num_trials, confidence)
+        if half_width is not None \
+           and (interval[1] - interval[0]) / 2 <= half_width:
+            stop_reason = "precision"
+        elif risk_limit is not None \
+             and (interval[0] > 1 - risk_limit
+                  or interval[1] < 1 - risk_limit):
+            stop_reason = "risk_limit"
+        elif time_budget is not None and time.time() - start >= time_budget:
+            stop_reason = "time_budget"
+        elif num_trials >= max_trials:
+            stop_reason = "max_trials"
+        else:
+            continue
+        stats = {"num_trials": num_trials,
+                 "leader": leader,
+                 "interval": interval,
+                 "stop_reason": stop_reason}
+        return win_count, stats
+
+
+def benchmark_backends(sample_tallies, total_num_votes, vote_for_n, seed,
+                       num_trials, candidate_names,
+                       voting_method=plurality_winner, workers=2,
+                       printing_wanted=True):
+    """
+    Time run_trials serially, with the process backend and with the
+    thread backend, and check that all three give the same win counts.
+
+    Input Parameters:
+
+    -the parameters are as for run_trials; workers is the pool size used
+    for both parallel backends.
+
+    -printing_wanted is a Boolean; if True, a summary line is printed for
+    each mode.
+
+    Returns:
+
+    -timings is a dict mapping "serial", "process" and "thread" to the
+    elapsed wall-clock time in seconds.
+    """
+
+    modes = [("serial", None, "process"),
+             ("process", workers, "process"),
+             ("thread", workers, "thread")]
+    timings = {}
+    results = {}
+    for mode, mode_workers, backend in modes:
+        start = time.time()
+        results[mode] = run_trials(sample_tallies, total_num_votes,
+                                   vote_for_n, seed, num_trials,
+                                   candidate_names, voting_method,
+                                   workers=mode_workers, backend=backend)
+        timings[mode] = time.time() - start
+        if printing_wanted:
+            print("{:<8s} {:8.3f} s  {:10.1f} trials/s"
+                  .format(mode, timings[mode],
+                          num_trials / max(timings[mode], 1e-9)))
+    assert results["process"] == results["serial"]
+    assert results["thread"] == results["serial"]
+    if printing_wanted:
+        print("GIL enabled: {}".format(gil_enabled()))
+    return timings
+
+
+##############################################################################
+## Vectorized trials
+##############################################################################
+
+# Spawn-key prefix of the batch streams of the vectorized trials, kept
+# apart from the per-trial streams SeedSequence(seed, spawn_key=(i,)).
+BATCH_SPAWN_KEY = 2**32 - 1
+
+# Spawn-key prefix of the streams of staged_posterior, likewise kept
+# apart from the per-trial and batch streams.
+STAGE_SPAWN_KEY = 2**32 - 2
+
+# Spawn-key prefix of the streams of variance_reduction.
+VARIANCE_REDUCTION_SPAWN_KEY = 2**32 - 3
+
+# Spawn-key prefix of the streams of importance_sampling.
+IMPORTANCE_SPAWN_KEY = 2**32 - 4
+
+# Largest number of (trial, county, candidate) entries simulated at once.
+VECTORIZED_BATCH_ENTRIES = 2**22
+
+
+def create_batch_rng(seed, batch_index):
+    """
+    Create and return a numpy Generator giving the random stream for
+    batch number batch_index of the vectorized trials (see
+    count_wins_vectorized), seeded by
+    SeedSequence(seed, spawn_key=(BATCH_SPAWN_KEY, batch_index)).
+    """
+
+    seed_seq = np.random.SeedSequence(seed,
+                                      spawn_key=(BATCH_SPAWN_KEY, batch_index))
+    return np.random.Generator(np.random.PCG64(seed_seq))
+
+
+def simulate_final_tallies(sample_tallies, total_num_votes, rng, num_trials,
+                           approx=None, priors=None):
+    """
+    Simulate num_trials final tallies at once, as arrays of shape
+    trials x counties x candidates, and return their sums over counties.
+
+    Each trial draws, for every county, Dirichlet proportions (as
+    normalized gamma variates) and a multinomial nonsample tally, as
+    dirichlet_multinomial does (including its clipping and rescaling for
+    "gaussian"), but all from rng in a few array calls.
+
+    Input Parameters:
+
+    -sample_tallies, total_num_votes, approx and priors are as for
+    compute_winner.
+
+    -rng is a numpy Generator.
+
+    -num_trials is the number of trials to simulate.
+
+    Returns:
+
+    -final_tallies is an array with one row per trial and one column per
+    candidate (integers, or reals if approx is given).
+    """
+
+    sample_tallies = np.asarray(sample_tallies)
+    nonsample_sizes = np.asarray(total_num_votes) - sample_tallies.sum(axis=1)
+    for i in np.flatnonzero(nonsample_sizes < 0):
+        raise ValueError("total_num_votes {} less than sample_size {}."
+                         .format(total_num_votes[i], sample_tallies[i].sum()))
+    prior = 1 if priors is None else np.asarray(priors, dtype=float)
+    gammas = rng.gamma(sample_tallies + prior,
+                       size=(num_trials,) + sample_tallies.shape)
+    proportions = gammas / gammas.sum(axis=2, keepdims=True)
+    sizes = nonsample_sizes[:, None]
+    if approx is None:
+        nonsample = rng.multinomial(nonsample_sizes, proportions)
+    elif approx == "scaled":
+        nonsample = sizes * proportions
+    elif approx == "gaussian":
+        # as in dirichlet_multinomial, for every trial and county at once
+        y = np.sqrt(proportions) * rng.standard_normal(proportions.shape)
+        nonsample = sizes * proportions + np.sqrt(sizes) \
+            * (y - proportions * y.sum(axis=2, keepdims=True))
+        nonsample = np.maximum(nonsample, 0.0)
+        clipped_sums = nonsample.sum(axis=2, keepdims=True)
+        nonsample *= np.divide(sizes, clipped_sums,
+                               out=np.ones_like(clipped_sums),
+                               where=clipped_sums > 0)
+    else:
+        raise ValueError("simulate_final_tallies: unknown approx {}."
+                         .format(approx))
+    return sample_tallies.sum(axis=0) + nonsample.sum(axis=1)
+
+
+def count_wins_vectorized(sample_tallies, total_num_votes, vote_for_n, seed,
+                          num_trials, approx=None, priors=None, model=None):
+    """
+    Run num_trials trials in array form, and count how often each
+    candidate is among the vote_for_n winners.
+
+    The trials are run in batches of at most VECTORIZED_BATCH_ENTRIES
+    (trial, county, candidate) entries; batch b draws from the stream
+    create_batch_rng(seed, b).  So the result depends on seed, not on
+    anything else, but it is not the same as that of run_trials, whose
+    trials each draw from their own stream.
+
+    Input Parameters:
+
+    -sample_tallies, total_num_votes, vote_for_n, approx and priors are
+    as for compute_winner.
+
+    -seed is a nonnegative integer, the seed of the whole simulation.
+
+    -num_trials is the number of trials to run.
+
+    -model is a voting_models.VotingModel for the columns of
+    sample_tallies, or None for plurality (voting_models.PluralityModel).
+
+    Returns:
+
+    -win_count is a dict mapping each of model.outcomes to the number of
+    trials it won; for plurality, candidate indices (from 0), as
+    count_wins gives for plurality_winner.
+    """
+
+    num_counties = len(sample_tallies)
+    num_candidates = len(sample_tallies[0])
+    if model is None:
+        model = voting_models.PluralityModel(range(num_candidates),
+                                             vote_for_n)
+    batch_size = max(1, VECTORIZED_BATCH_ENTRIES
+                     // (num_counties * num_candidates))
+    win_count = {}
+    for batch_index, first in enumerate(range(0, num_trials, batch_size)):
+        final_tallies = simulate_final_tallies(
+            sample_tallies, total_num_votes,
+            create_batch_rng(seed, batch_index),
+            min(batch_size, num_trials - first), approx, priors)
+        add_model_wins(win_count, model, model.winners(final_tallies))
+    return win_count
+
+
+def add_model_wins(win_count, model, winners):
+    """
+    Add to the dict win_count the wins in winners, an array of indices
+    into model.outcomes as returned by model.winners.
+    """
+
+    counts = np.bincount(winners.ravel(), minlength=len(model.outcomes))
+    for i in np.flatnonzero(counts):
+        outcome = model.outcomes[i]
+        win_count[outcome] = win_count.get(outcome, 0) + int(counts[i])
+
+
+# Number of trials simulated together by compute_win_probs_rcv_stratified.
+STRATIFIED_BATCH_SIZE = 1000
+
+
+def create_stratum_rng(seed, batch_index, stratum):
+    """
+    Create and return a numpy Generator giving the random stream of
+    stratum number stratum in batch number batch_index of a stratified
+    simulation, seeded by
+    SeedSequence(seed, spawn_key=(BATCH_SPAWN_KEY, batch_index, stratum)).
+    """
+
+    seed_seq = np.random.SeedSequence(
+        seed, spawn_key=(BATCH_SPAWN_KEY, batch_index, stratum))
+    return np.random.Generator(np.random.PCG64(seed_seq))
+
+
+def simulate_stratified_final_tallies(sample_tallies, total_num_votes, seed,
+                                      batch_index, num_trials, approx=None,
+                                      priors=None):
+    """
+    Simulate num_trials final tallies of a stratified contest, and return
+    their sums over strata, as an array with one row per trial.
+
+    Each stratum is simulated for all num_trials trials at once (see
+    simulate_final_tallies), from its own stream
+    create_stratum_rng(seed, batch_index, stratum), so the strata are
+    independent, and the draws of one stratum do not depend on how many
+    other strata there are.  Fully sampled strata just add their sample
+    tallies.
+
+    Input Parameters:
+
+    -sample_tallies, total_num_votes, approx and priors are as for
+    compute_winner, with one entry per stratum.
+
+    -seed is a nonnegative integer, the seed of the whole simulation.
+
+    -batch_index is the number of this batch of trials.
+
+    -num_trials is the number of trials in the batch.
+
+    Returns:
+
+    -an array of shape (num_trials, number of ballot types).
+    """
+
+    final_tallies = np.zeros((num_trials, len(sample_tallies[0])),
+                             dtype=float if approx else np.int64)
+    for stratum, sample_tally in enumerate(sample_tallies):
+        if total_num_votes[stratum] == sum(sample_tally):
+            final_tallies += np.asarray(sample_tally)
+            continue
+        final_tallies += simulate_final_tallies(
+            [sample_tally], [total_num_votes[stratum]],
+            create_stratum_rng(seed, batch_index, stratum), num_trials,
+            approx, None if priors is None else [priors[stratum]])
+    return final_tallies
 
 
 def compute_win_probs(sample_tallies,
@@ -299,7 +1277,12 @@ def compute_win_probs(sample_tallies,
                       seed,
                       num_trials,
                       candidate_names,
-                      vote_for_n):
+                      vote_for_n,
+                      workers=None,
+                      backend="process",
+                      approx=None,
+                      exact=True,
+                      vectorized=False):
     """
 
     Runs num_trials simulations of the Bayesian audit to estimate
@@ -323,8 +1306,8 @@ def compute_win_probs(sample_tallies,
     the total votes for county i. The sum of all total_num_votes[i] is the
     total number of votes in the entire election.
 
-    -seed is an integer or None. Assuming that it isn't None, we
-    use it to seed the random state for the audit.
+    -seed is an integer or None. Trial i draws from the stream
+    create_trial_rng(seed, i); a seed of None is replaced by a random one.
 
     -num_trials is an integer which represents how many simulations
     of the Bayesian audit we run, to estimate the win probabilities
@@ -339,6 +1322,26 @@ def compute_win_probs(sample_tallies,
     for candidate i as any time they are in the top n candidates in the final
     tally.
 
+    -workers is None or a positive integer, the number of worker
+    processes or threads to spread the trials over (see run_trials).
+    The result does not depend on it.
+
+    -backend is "process" or "thread" (see run_trials).
+
+    -approx is None for the exact posterior simulation, or "scaled" or
+    "gaussian" for a faster approximation (see dirichlet_multinomial).
+
+    -exact is a Boolean.  If True, a two-candidate contest with
+    vote_for_n = 1 and at most one county with unsampled ballots has its
+    win probabilities computed exactly instead (see exact_win_probs),
+    and no trials are run.
+
+    -vectorized is a Boolean.  If True, the trials are run in array form
+    by count_wins_vectorized, in this thread (workers and backend are
+    ignored).  This is much faster for contests with many counties, but
+    gives different (equally valid) trials than the default, which runs
+    each trial from its own stream.
+
     Returns:
 
     -win_probs is a list of pairs (i, p) where p is the fractional
@@ -346,30 +1349,142 @@ def compute_win_probs(sample_tallies,
     out of the num_trials simulations.
     """
 
-    num_candidates = len(candidate_names)
-    win_count = [0]*(1+num_candidates)
-    for i in range(num_trials):
-        # We want a different seed per trial.
-        # Adding i to seed caused correlations, as numpy apparently
-        # adds one per trial, so we multiply i by 314...
-        seed_i = seed + i*314159265
-        winners = compute_winner(sample_tallies,
-                                total_num_votes,
-                                vote_for_n,
-                                seed_i, candidate_names)
-        for winner in winners:
-            win_count[winner+1] += 1
-    win_probs = [(i, win_count[i]/float(num_trials))
-                 for i in range(1, len(win_count))]
+    if exact and vote_for_n == 1:
+        win_probs = exact_win_probs.plurality_win_probs(sample_tallies,
+                                                        total_num_votes)
+        if win_probs is not None:
+            return win_probs
+    seed = resolve_seed(seed)
+    if vectorized:
+        win_count = count_wins_vectorized(sample_tallies, total_num_votes,
+                                          vote_for_n, seed, num_trials,
+                                          approx=approx)
+    else:
+        win_count = run_trials(sample_tallies,
+                               total_num_votes,
+                               vote_for_n,
+                               seed, num_trials, candidate_names,
+                               workers=workers, backend=backend,
+                               approx=approx)
+    win_probs = [(i, win_count.get(i-1, 0)/float(num_trials))
+                 for i in range(1, len(candidate_names)+1)]
     return win_probs
 
+def certificate_is_exact(voting_method, vote_for_n=1):
+    """
+    Return True if an rcv_certificate.IRVCertificate of the sample's
+    elimination order is known to give the winner of voting_method for
+    every tally it holds for.
+
+    The certificate's inequalities are strict, so they do not depend on
+    how ties are broken, but they do assume IRV with a single winner, as
+    tabulated by voting_models.IRVModel (the class or any instance) and
+    by old-style voting methods marked tabulates_like_rcv_winner (see
+    reduction_is_exact).  For any other voting method the certificate
+    would give certified trials the IRV winner instead of its own.
+    """
+
+    if vote_for_n != 1:
+        return False
+    if voting_method is voting_models.IRVModel \
+       or isinstance(voting_method, voting_models.IRVModel):
+        return True
+    return bool(getattr(voting_method, "tabulates_like_rcv_winner", False))
+
+
+def reduction_is_exact(voting_method, vote_for_n=1):
+    """
+    Return True if pruning and merging ballot types (see rcv_reduction)
+    are known to leave the outcome of voting_method unchanged.
+
+    The projections of rcv_reduction keep the single winner under the
+    elimination rules of rcv.rcv_winner with an empty tie_breaker.  That
+    holds for voting_models.IRVModel (the class, or an instance with the
+    default tie order) and for old-style voting methods that say so by a
+    true attribute tabulates_like_rcv_winner (e.g. audit_me.rcv_wrapper).
+    """
+
+    if vote_for_n != 1:
+        return False
+    if voting_method is voting_models.IRVModel:
+        return True
+    if isinstance(voting_method, voting_models.IRVModel):
+        return np.array_equal(voting_method.tie_order,
+                              np.arange(len(voting_method.outcomes)))
+    return bool(getattr(voting_method, "tabulates_like_rcv_winner", False))
+
+
+def check_reduction(voting_method, vote_for_n, prune_epsilon, merge_types,
+                    caller):
+    """
+    Raise ValueError if ballot types are to be pruned (prune_epsilon not
+    None) or merged (merge_types) for a voting method for which that is
+    not known to be exact (see reduction_is_exact).  caller names the
+    function, for the message.
+    """
+
+    if (merge_types or prune_epsilon is not None) \
+       and not reduction_is_exact(voting_method, vote_for_n):
+        raise ValueError("{}: prune_epsilon and merge_types need a voting "
+                         "method tabulating by rcv.rcv_winner's rules with "
+                         "an empty tie_breaker, and vote_for_n 1."
+                         .format(caller))
+
+
+def prepare_rcv_trials(unique_ballots, sample_tallies, total_num_votes,
+                       priors=None, prune_epsilon=None, merge_types=False,
+                       use_certificate=True):
+    """
+    Reduce the ballot types of an RCV contest and build the certificate
+    of the sample's elimination order, as compute_win_probs_rcv does
+    before running its trials.
+
+    Input Parameters:
+
+    -unique_ballots, sample_tallies, total_num_votes, priors,
+    prune_epsilon, merge_types and use_certificate are as for
+    compute_win_probs_rcv.
+
+    Returns:
+
+    -(unique_ballots, sample_tallies, priors, certificate): the reduced
+    ballot types with their sample tallies and priors, and an
+    rcv_certificate.IRVCertificate for them (None unless use_certificate).
+    """
+
+    if merge_types:
+        unique_ballots, sample_tallies, priors, _ = \
+            rcv_reduction.reduce_ballot_types(unique_ballots, sample_tallies,
+                                              total_num_votes, prune_epsilon,
+                                              priors)
+    elif prune_epsilon is not None:
+        unique_ballots, sample_tallies, priors, _ = \
+            rcv_reduction.prune_ballot_types(unique_ballots, sample_tallies,
+                                             total_num_votes, prune_epsilon,
+                                             priors)
+    certificate = None
+    if use_certificate:
+        certificate = rcv_certificate.build_certificate(
+            unique_ballots, [sum(k) for k in zip(*sample_tallies)])
+    return unique_ballots, sample_tallies, priors, certificate
+
+
 def compute_win_probs_rcv(sample_tallies,
                       total_num_votes,
                       seed,
                       num_trials,
                       unique_ballots,
                       real_names,
-                      vote_for_n, rcv_wrapper):
+                      vote_for_n, rcv_wrapper,
+                      workers=None,
+                      backend="process",
+                      approx=None,
+                      priors=None,
+                      prune_epsilon=None,
+                      merge_types=False,
+                      use_certificate=True,
+                      exact=True,
+                      stats=None):
     """
 
     Runs num_trials simulations of the Bayesian audit to estimate
@@ -393,8 +1508,8 @@ def compute_win_probs_rcv(sample_tallies,
     the total votes for county i. The sum of all total_num_votes[i] is the
     total number of votes in the entire election.
 
-    -seed is an integer or None. Assuming that it isn't None, we
-    use it to seed the random state for the audit.
+    -seed is an integer or None. Trial i draws from the stream
+    create_trial_rng(seed, i); a seed of None is replaced by a random one.
 
     -num_trials is an integer which represents how many simulations
     of the Bayesian audit we run, to estimate the win probabilities
@@ -411,7 +1526,60 @@ def compute_win_probs_rcv(sample_tallies,
     for candidate i as any time they are in the top n candidates in the final
     tally.
 
-    -- rcv voting method
+    -- rcv voting method; or voting_models.IRVModel (the class), which is
+    compiled for the (reduced) ballot types and tabulates whole batches
+    of trials at once
+
+    -workers is None or a positive integer, the number of worker
+    processes or threads to spread the trials over (see run_trials).
+    The result does not depend on it.
+
+    -backend is "process" or "thread" (see run_trials).
+
+    -approx is None for the exact posterior simulation, or "scaled" or
+    "gaussian" for a faster approximation (see dirichlet_multinomial).
+
+    -priors is None or a list of lists of pseudocounts, shaped like
+    sample_tallies (see compute_winner).  None means one per ballot type.
+
+    -prune_epsilon is None, or a small probability.  If given, candidates
+    who are eliminated before all others with posterior probability at
+    least 1 - prune_epsilon are deleted from the ballot types before the
+    trials, and identical types merged (see rcv_reduction).  They are
+    reported with win probability 0.
+
+    -merge_types is a Boolean (False by default).  If True, each ballot
+    type is first replaced by the part of it that can affect the IRV
+    winner, and types that become identical are merged, with summed
+    priors (see rcv_reduction.reduce_ballot_types).  This gives exactly
+    the same distribution of winners over far fewer types, but the trials
+    draw different numbers, so results for a given seed change.  Both
+    prune_epsilon and merge_types raise ValueError unless rcv_wrapper is
+    known to tabulate by rcv.rcv_winner's rules with an empty tie_breaker
+    (see reduction_is_exact).
+
+    -use_certificate is a Boolean.  If True, a certificate of the
+    elimination order of the sample tally is built once, and rcv_wrapper
+    is only called for trials that do not follow that order (see
+    rcv_certificate).  The results are the same either way.  It is
+    ignored unless rcv_wrapper is known to tabulate IRV as the
+    certificate assumes (see certificate_is_exact).
+
+    -exact is a Boolean.  If True, and the reduced ballot types mention
+    only two candidates (e.g. once hopeless candidates are pruned), with
+    at most one county having unsampled ballots, the win probabilities
+    are computed exactly instead, and no trials are run (see
+    exact_win_probs; ties go to the later name, as in rcv.rcv_winner with
+    an empty tie_breaker).  It is ignored unless rcv_wrapper is known to
+    tabulate like rcv.rcv_winner (see reduction_is_exact).
+
+    -stats is None or a trial_stats.TrialStats, to which the outcome of
+    every trial (final-round margin, exhausted votes, elimination
+    rounds and order) is added.  rcv_wrapper must then be an IRVModel,
+    and the trials are run even if exact is True.  The statistics are
+    those of the ballot types as given, so stats may not be combined
+    with prune_epsilon or merge_types, which drop candidates and cut
+    ballots short (ValueError).
 
     Returns:
 
@@ -420,18 +1588,37 @@ def compute_win_probs_rcv(sample_tallies,
     out of the num_trials simulations.
     """
 
-    num_candidates = len(unique_ballots)
+    seed = resolve_seed(seed)
+    check_reduction(rcv_wrapper, vote_for_n, prune_epsilon, merge_types,
+                    "compute_win_probs_rcv")
+    if stats is not None and (merge_types or prune_epsilon is not None):
+        raise ValueError("compute_win_probs_rcv: stats need the ballot types "
+                         "unreduced (no prune_epsilon or merge_types).")
+    use_certificate = use_certificate \
+        and certificate_is_exact(rcv_wrapper, vote_for_n)
+    unique_ballots, sample_tallies, priors, certificate = \
+        prepare_rcv_trials(unique_ballots, sample_tallies, total_num_votes,
+                           priors, prune_epsilon, merge_types,
+                           use_certificate)
+    if exact and stats is None and reduction_is_exact(rcv_wrapper,
+                                                      vote_for_n):
+        win_probs = exact_win_probs.rcv_win_probs(unique_ballots,
+                                                  sample_tallies,
+                                                  total_num_votes,
+                                                  real_names, priors)
+        if win_probs is not None:
+            return win_probs
     win_count =  {name : 0 for name in real_names} 
-    for i in range(num_trials):
-        # We want a different seed per trial.
-        # Adding i to seed caused correlations, as numpy apparently
-        # adds one per trial, so we multiply i by 314...
-        seed_i = seed + i*314159265
-        winner = compute_winner(sample_tallies,
-                                total_num_votes,
-                                vote_for_n,
-                                seed_i, unique_ballots, voting_method=rcv_wrapper)
-        win_count[winner] = win_count[winner] + 1
+    trial_win_count = run_trials(sample_tallies,
+                                 total_num_votes,
+                                 vote_for_n,
+                                 seed, num_trials, unique_ballots,
+                                 voting_method=rcv_wrapper,
+                                 workers=workers, backend=backend,
+                                 approx=approx, priors=priors,
+                                 certificate=certificate, stats=stats)
+    for winner, count in trial_win_count.items():
+        win_count[winner] = win_count[winner] + count
     total_count = float(sum(win_count.values()))
     name_map = {}
     for i, name in enumerate(real_names):
@@ -441,6 +1628,224 @@ def compute_win_probs_rcv(sample_tallies,
     return win_probs
 
 
+def exact_stats(win_probs):
+    """
+    Return the stats that compute_win_probs_sequential and
+    compute_win_probs_rcv_sequential report for exactly computed
+    win_probs.
+    """
+
+    leader, p = max(win_probs, key=lambda pair: pair[1])
+    return {"num_trials": 0,
+            "leader": leader,
+            "interval": (p, p),
+            "stop_reason": "exact"}
+
+
+def compute_win_probs_rcv_stratified(sample_tallies,
+                                     total_num_votes,
+                                     seed,
+                                     num_trials,
+                                     unique_ballots,
+                                     real_names,
+                                     tie_breaker=None,
+                                     approx=None,
+                                     priors=None,
+                                     prune_epsilon=None,
+                                     merge_types=False,
+                                     use_certificate=True):
+    """
+    Estimate RCV win probabilities for a contest tabulated as a whole
+    but sampled separately in each of many strata (e.g. the
+    municipalities of a statewide contest).
+
+    The strata share one index of ballot types, unique_ballots.  The
+    trials are run in batches of STRATIFIED_BATCH_SIZE: each stratum's
+    nonsample is simulated for the whole batch from its own stream (see
+    simulate_stratified_final_tallies), the strata are summed, and the
+    batch is tabulated at once, by the certificate of the sample's
+    elimination order and by a voting_models.IRVModel.  So the cost per
+    stratum is a few numpy calls per batch, not per trial.
+
+    Note that the default prior, one pseudocount per ballot type in every
+    stratum, adds as many pseudo-ballots to each stratum as there are
+    ballot types; with many thinly sampled strata it can outweigh the
+    sample, and smaller pseudocounts (through priors) may be wanted.
+
+    Input Parameters:
+
+    -sample_tallies is a list with one list per stratum, giving the
+    number of sampled ballots of each type in unique_ballots (zero for
+    types not seen in that stratum).
+
+    -total_num_votes is a list giving the number of ballots cast in each
+    stratum.
+
+    -tie_breaker is as for rcv.rcv_winner (None for an empty list).
+
+    -seed, num_trials, unique_ballots, real_names, approx, priors,
+    prune_epsilon, merge_types and use_certificate are as for
+    compute_win_probs_rcv.  (The reductions and the certificate assume
+    an empty tie_breaker: with a tie_breaker, the certificate is not
+    used, and prune_epsilon or merge_types raise ValueError.)
+
+    Returns:
+
+    -win_probs is a list of pairs (i, p), with p the fraction of the
+    trials won by real_names[i].
+    """
+
+    seed = resolve_seed(seed)
+    if tie_breaker:
+        if merge_types or prune_epsilon is not None:
+            raise ValueError("compute_win_probs_rcv_stratified: "
+                             "prune_epsilon and merge_types need an empty "
+                             "tie_breaker.")
+        use_certificate = False
+    unique_ballots, sample_tallies, priors, certificate = \
+        prepare_rcv_trials(unique_ballots, sample_tallies, total_num_votes,
+                           priors, prune_epsilon, merge_types,
+                           use_certificate)
+    model = voting_models.IRVModel(unique_ballots, tie_breaker=tie_breaker)
+    win_count = {}
+    for batch_index, first in enumerate(range(0, num_trials,
+                                              STRATIFIED_BATCH_SIZE)):
+        final_tallies = simulate_stratified_final_tallies(
+            sample_tallies, total_num_votes, seed, batch_index,
+            min(STRATIFIED_BATCH_SIZE, num_trials - first), approx, priors)
+        if certificate is None:
+            certified = np.zeros(len(final_tallies), dtype=bool)
+        else:
+            certified = certificate.holds(final_tallies)
+            win_count[certificate.winner] = \
+                win_count.get(certificate.winner, 0) + int(certified.sum())
+        if not certified.all():
+            add_model_wins(win_count, model,
+                           model.winners(final_tallies[~certified]))
+    return [(i, win_count.get(name, 0) / float(num_trials))
+            for i, name in enumerate(real_names)]
+
+
+def compute_win_probs_sequential(sample_tallies,
+                                 total_num_votes,
+                                 seed,
+                                 max_trials,
+                                 candidate_names,
+                                 vote_for_n,
+                                 batch_size=100,
+                                 half_width=0.01,
+                                 risk_limit=None,
+                                 time_budget=None,
+                                 workers=None,
+                                 backend="process",
+                                 approx=None,
+                                 exact=True):
+    """
+    Like compute_win_probs, but runs trials in batches and stops early
+    once the leading candidate's win probability is known well enough
+    (see run_trials_sequential for the stopping rules).
+
+    Input Parameters:
+
+    -the parameters are as for compute_win_probs and
+    run_trials_sequential; max_trials plays the role of num_trials.
+
+    Returns:
+
+    -(win_probs, stats) where win_probs is as for compute_win_probs,
+    computed from the trials actually run, and stats is as for
+    run_trials_sequential, except that "leader" is the index i used
+    in win_probs.  When the win probabilities are computed exactly (see
+    exact in compute_win_probs), stats has "num_trials" 0, an interval of
+    zero width, and "stop_reason" "exact".
+    """
+
+    if exact and vote_for_n == 1:
+        win_probs = exact_win_probs.plurality_win_probs(sample_tallies,
+                                                        total_num_votes)
+        if win_probs is not None:
+            return win_probs, exact_stats(win_probs)
+    seed = resolve_seed(seed)
+    win_count, stats = run_trials_sequential(
+        sample_tallies, total_num_votes, vote_for_n, seed, max_trials,
+        candidate_names, batch_size=batch_size, half_width=half_width,
+        risk_limit=risk_limit, time_budget=time_budget,
+        workers=workers, backend=backend, approx=approx)
+    num_trials = stats["num_trials"]
+    win_probs = [(i, win_count.get(i-1, 0)/float(num_trials))
+                 for i in range(1, len(candidate_names)+1)]
+    stats["leader"] = stats["leader"] + 1
+    return win_probs, stats
+
+
+def compute_win_probs_rcv_sequential(sample_tallies,
+                                     total_num_votes,
+                                     seed,
+                                     max_trials,
+                                     unique_ballots,
+                                     real_names,
+                                     vote_for_n, rcv_wrapper,
+                                     batch_size=100,
+                                     half_width=0.01,
+                                     risk_limit=None,
+                                     time_budget=None,
+                                     workers=None,
+                                     backend="process",
+                                     approx=None,
+                                     priors=None,
+                                     prune_epsilon=None,
+                                     merge_types=False,
+                                     use_certificate=True,
+                                     exact=True):
+    """
+    Like compute_win_probs_rcv, but runs trials in batches and stops
+    early once the leading candidate's win probability is known well
+    enough (see run_trials_sequential for the stopping rules).
+
+    Input Parameters:
+
+    -the parameters are as for compute_win_probs_rcv and
+    run_trials_sequential; max_trials plays the role of num_trials.
+
+    Returns:
+
+    -(win_probs, stats) where win_probs is as for compute_win_probs_rcv,
+    computed from the trials actually run, and stats is as for
+    run_trials_sequential, except that "leader" is the index into
+    real_names used in win_probs.  When the win probabilities are
+    computed exactly (see exact in compute_win_probs_rcv), stats has
+    "num_trials" 0, an interval of zero width, and "stop_reason" "exact".
+    """
+
+    seed = resolve_seed(seed)
+    check_reduction(rcv_wrapper, vote_for_n, prune_epsilon, merge_types,
+                    "compute_win_probs_rcv_sequential")
+    use_certificate = use_certificate \
+        and certificate_is_exact(rcv_wrapper, vote_for_n)
+    unique_ballots, sample_tallies, priors, certificate = \
+        prepare_rcv_trials(unique_ballots, sample_tallies, total_num_votes,
+                           priors, prune_epsilon, merge_types,
+                           use_certificate)
+    if exact and reduction_is_exact(rcv_wrapper, vote_for_n):
+        win_probs = exact_win_probs.rcv_win_probs(unique_ballots,
+                                                  sample_tallies,
+                                                  total_num_votes,
+                                                  real_names, priors)
+        if win_probs is not None:
+            return win_probs, exact_stats(win_probs)
+    win_count, stats = run_trials_sequential(
+        sample_tallies, total_num_votes, vote_for_n, seed, max_trials,
+        unique_ballots, rcv_wrapper, batch_size=batch_size,
+        half_width=half_width, risk_limit=risk_limit,
+        time_budget=time_budget, workers=workers, backend=backend,
+        approx=approx, priors=priors, certificate=certificate)
+    num_trials = float(stats["num_trials"])
+    win_probs = [(i, win_count.get(name, 0)/num_trials)
+                 for i, name in enumerate(real_names)]
+    stats["leader"] = real_names.index(stats["leader"])
+    return win_probs, stats
+
+
 ##############################################################################
 ## Routines for command-line interface and file (csv) input
 ##############################################################################
@@ -552,6 +1957,59 @@ def preprocess_csv(path_to_csv):
     return sample_tallies, total_num_votes, candidate_names
 
 
+def preprocess_rcv_ballots(path_to_ballots):
+    """
+    Read a file of sampled ranked ballots, one per line (see
+    rcv.read_ME_data, which also cleans them), and return their tally.
+
+    Input Parameters:
+
+    -path_to_ballots is a string, the path to the file.
+
+    Returns:
+
+    -(unique_ballots, sample_tally, candidate_names) where unique_ballots
+    is the list of distinct cleaned ballots, sample_tally the list of
+    their counts, and candidate_names the sorted list of the choices
+    appearing on them.
+    """
+
+    tally = rcv.read_ME_data(path_to_ballots)
+    unique_ballots = list(tally.keys())
+    sample_tally = [tally[ballot] for ballot in unique_ballots]
+    candidate_names = sorted(set(name for ballot in unique_ballots
+                                 for name in ballot))
+    return unique_ballots, sample_tally, candidate_names
+
+
+def print_rcv_statistics(stats, elapsed):
+    """
+    Print how many trials compute_win_probs_rcv_sequential ran, how fast,
+    and why it stopped.
+
+    Input Parameters:
+
+    -stats is the dict returned by compute_win_probs_rcv_sequential.
+
+    -elapsed is the wall-clock time taken, in seconds.
+
+    Returns:
+
+    -None.
+    """
+
+    if stats["stop_reason"] == "exact":
+        print("Computed exactly (two-candidate race) in {:.3f} s"
+              .format(elapsed))
+        return
+    print("Trials run: {} in {:.3f} s ({:.1f} trials/s)"
+          .format(stats["num_trials"], elapsed,
+                  stats["num_trials"] / max(elapsed, 1e-9)))
+    print("Stopped by: {}".format(stats["stop_reason"]))
+    print("Leader's win probability: {:.4f} to {:.4f} (Wilson interval)"
+          .format(*stats["interval"]))
+
+
 def main():
     """
     Parse command-line arguments, compute and print answers.
@@ -614,11 +2072,69 @@ def main():
                         type=int,
                         default=1)
 
+    parser.add_argument("--vectorized",
+                        help="Run the trials as arrays over trials, counties "
+                             "and candidates at once.  Much faster for "
+                             "audits with many counties; the results "
+                             "differ from the default (per-trial) "
+                             "simulation only by sampling noise.",
+                        action="store_true")
+
+    parser.add_argument("--rcv_ballots",
+                        help="Audit an RCV (instant-runoff) contest: the "
+                             "path of a file of sampled ranked ballots, one "
+                             "per line, choices in order of preference.  "
+                             "total_num_votes is then the number of ballots "
+                             "cast in the contest.")
+
+    parser.add_argument("--workers",
+                        help="Number of worker processes to spread the "
+                             "trials over (default: run in this process).",
+                        type=int,
+                        default=None)
+
+    parser.add_argument("--batch_size",
+                        help="(RCV only:) Number of trials run between "
+                             "checks of the stopping rule.",
+                        type=int,
+                        default=1000)
+
+    parser.add_argument("--half_width",
+                        help="(RCV only:) Stop once the leading candidate's "
+                             "win probability is known to within this "
+                             "half-width (95%% Wilson interval); "
+                             "--num_trials is the most trials run.",
+                        type=float,
+                        default=0.005)
+
     args = parser.parse_args()
     if args.path_to_csv is None and args.total_num_votes is None:
         parser.print_help()
         sys.exit()
 
+    if args.rcv_ballots:
+        unique_ballots, sample_tally, candidate_names = \
+            preprocess_rcv_ballots(args.rcv_ballots)
+        start = time.time()
+        win_probs, stats = compute_win_probs_rcv_sequential(
+            [sample_tally],
+            [int(args.total_num_votes)],
+            args.audit_seed,
+            args.num_trials,
+            unique_ballots,
+            candidate_names,
+            args.vote_for_n,
+            voting_models.IRVModel,
+            batch_size=args.batch_size,
+            half_width=args.half_width,
+            workers=args.workers)
+        elapsed = time.time() - start
+        print_results(candidate_names,
+                      [(i + 1, p) for i, p in win_probs],
+                      args.vote_for_n)
+        print_rcv_statistics(stats, elapsed)
+        return
+
     if args.path_to_csv:
         # if sample tallies are in CSV file read that
         sample_tallies, total_num_votes, candidate_names = \
@@ -637,7 +2153,9 @@ def main():
                     args.audit_seed,
                     args.num_trials,
                     candidate_names,
-                    vote_for_n)
+                    vote_for_n,
+                    workers=args.workers,
+                    vectorized=args.vectorized)
     print_results(candidate_names, win_probs, vote_for_n)
 
 
@@ -646,17 +2164,22 @@ def test_rcv():
     total_num_votes = [100]
     num_trials = 100
     seed = 1
-    candidate_names = [("a",),("a","b"),("a","b","c")]
+    unique_ballots = [("a",),("a","b"),("a","b","c")]
+    candidate_names = ["a", "b", "c"]
     vote_for_n = 1
-    win_probs = compute_win_probs(\
+    win_probs = compute_win_probs_rcv(\
                     sample_tallies,
                     total_num_votes,
                     seed,
                     num_trials,
+                    unique_ballots,
                     candidate_names,
-                    vote_for_n)
-    print_results(candidate_names, win_probs, vote_for_n)
+                    vote_for_n,
+                    voting_models.IRVModel)
+    print_results(candidate_names,
+                  [(i + 1, p) for i, p in win_probs],
+                  vote_for_n)
 
 if __name__ == '__main__':
 
-    test_rcv()
+    main()
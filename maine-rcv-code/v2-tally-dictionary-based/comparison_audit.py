@@ -0,0 +1,243 @@
+# comparison_audit.py
+# python3
+
+"""
+Bayesian ballot-level comparison audits of RCV contests, against the
+cast vote records (CVRs).
+
+A ballot-polling audit (bptool.compute_win_probs_rcv) learns the whole
+distribution of ballot types from the sample, and needs a large sample
+to pin down a close contest.  Maine and San Francisco also publish a CVR
+for every ballot, so the audit can instead compare each sampled paper
+ballot with its CVR row, and only has to learn how often, and how, the
+CVRs are wrong.
+
+For each reported ballot type r, the unsampled ballots reported as r
+are given actual types by a Dirichlet-multinomial over the categories
+
+    r -> r          the CVR is right,
+    r -> a          for each actual type a != r found on a sampled paper
+                    ballot reported as r,
+    r -> random     the CVR is wrong in a way not yet seen: the actual
+                    type is drawn like a random CVR (from the reported
+                    tally),
+
+with posterior parameters
+
+    match_prior + (number of sampled r -> r),
+    number of sampled r -> a,
+    error_prior.
+
+So a type nobody has found an error in is wrong with probability about
+error_prior / (match_prior + error_prior + its sample count), and the
+simulated final tallies stay close to the reported one until
+discrepancies turn up.  As in the polling audit, discrepancies of kinds
+never seen in the sample are otherwise not simulated.  Each trial's
+final tally, the sampled papers plus the simulated unsampled ballots, is
+tabulated by the rules of rcv.rcv_winner (voting_models.IRVModel by
+default), with the certificate of the reported outcome deciding every
+trial that follows the reported elimination order (see rcv_certificate).
+
+Example:
+    win_probs = compute_win_probs_comparison(cvr_tally, sample_pairs,
+                                             seed, 1000, real_names)
+"""
+
+import numpy as np
+
+import bptool
+import rcv_certificate
+import voting_models
+
+
+def count_pairs(sample_pairs):
+    """
+    Return a dict mapping (reported, actual) pairs of ballot types to
+    their counts, given such a dict or a list of pairs (one per sampled
+    ballot).
+
+    Example:
+        >>> count_pairs([(('a',), ('a',)), (('a',), ('b',)), (('a',), ('a',))])
+        {(('a',), ('a',)): 2, (('a',), ('b',)): 1}
+    """
+
+    if isinstance(sample_pairs, dict):
+        return dict(sample_pairs)
+    counts = {}
+    for pair in sample_pairs:
+        counts[pair] = counts.get(pair, 0) + 1
+    return counts
+
+
+class ComparisonPosterior:
+    """
+    The posterior of a comparison audit, and its trials.
+
+    Args:
+        cvr_tally (dict): maps each reported ballot type to its number of
+            CVRs, over the whole contest
+        sample_pairs (dict or list): the sampled ballots, as (reported,
+            actual) pairs or a dict counting them (see count_pairs)
+        match_prior, error_prior (float): prior pseudocounts of the
+            categories r -> r and r -> random (see the module docstring)
+
+    Attributes:
+        ballot_types (list): the reported types, in the order of
+            cvr_tally, then the actual types not reported on any CVR;
+            final tallies are indexed like it
+        sample_tally (numpy array): actual types of the sampled ballots
+        reported_counts (numpy array): number of CVRs of each type
+        unsampled (numpy array): number of unsampled ballots of each
+            reported type
+    """
+
+    def __init__(self, cvr_tally, sample_pairs, match_prior=1.0,
+                 error_prior=0.01):
+        pairs = count_pairs(sample_pairs)
+        self.ballot_types = list(cvr_tally)
+        index = {ballot: i for i, ballot in enumerate(self.ballot_types)}
+        for reported, actual in pairs:
+            if reported not in index:
+                raise ValueError("ComparisonPosterior: reported type {} "
+                                 "has no CVR.".format(reported))
+            if actual not in index:
+                index[actual] = len(self.ballot_types)
+                self.ballot_types.append(actual)
+        num_types = len(self.ballot_types)
+        num_reported = len(cvr_tally)
+
+        reported_counts = np.zeros(num_types)
+        reported_counts[:num_reported] = list(cvr_tally.values())
+        self.sample_tally = np.zeros(num_types)
+        sampled = np.zeros(num_types)
+        matches = np.zeros(num_reported)
+        errors = {}              # reported index -> {actual index: count}
+        for (reported, actual), count in pairs.items():
+            r, a = index[reported], index[actual]
+            self.sample_tally[a] += count
+            sampled[r] += count
+            if r == a:
+                matches[r] += count
+            else:
+                errors.setdefault(r, {})
+                errors[r][a] = errors[r].get(a, 0) + count
+        self.unsampled = (reported_counts - sampled)[:num_reported]
+        if (self.unsampled < 0).any():
+            raise ValueError("ComparisonPosterior: more ballots sampled "
+                             "than reported for some type.")
+        self.random_proportions = reported_counts[:num_reported] \
+            / reported_counts.sum()
+        self.match_alphas = match_prior + matches
+        self.error_prior = error_prior
+        # the reported types with discrepancies seen, done one at a time
+        self.errors = {r: (np.array(list(targets)),
+                           np.array(list(targets.values()), dtype=float))
+                       for r, targets in sorted(errors.items())}
+        self.simple = np.array([r not in errors
+                                for r in range(num_reported)])
+        self.reported_counts = reported_counts
+
+    def simulate_final_tallies(self, rng, num_trials):
+        """
+        Return array (num_trials x types) of simulated actual final
+        tallies, drawn from rng.
+        """
+
+        num_reported = len(self.unsampled)
+        final_tallies = np.tile(self.sample_tally, (num_trials, 1))
+        random_counts = np.zeros(num_trials, dtype=np.int64)
+
+        # reported types with no discrepancy seen: r -> r or r -> random
+        simple = np.flatnonzero(self.simple & (self.unsampled > 0))
+        match_gammas = rng.gamma(self.match_alphas[simple],
+                                 size=(num_trials, len(simple)))
+        error_gammas = rng.gamma(self.error_prior,
+                                 size=(num_trials, len(simple)))
+        error_rates = error_gammas / (match_gammas + error_gammas)
+        wrong = rng.binomial(self.unsampled[simple].astype(np.int64),
+                             error_rates)
+        final_tallies[:, simple] += self.unsampled[simple] - wrong
+        random_counts += wrong.sum(axis=1)
+
+        # the others: r -> r, r -> each a seen, r -> random
+        for r, (targets, counts) in self.errors.items():
+            if self.unsampled[r] == 0:
+                continue
+            alphas = np.concatenate([[self.match_alphas[r]], counts,
+                                     [self.error_prior]])
+            gammas = rng.gamma(alphas, size=(num_trials, len(alphas)))
+            proportions = gammas / gammas.sum(axis=1, keepdims=True)
+            drawn = rng.multinomial(int(self.unsampled[r]), proportions)
+            final_tallies[:, r] += drawn[:, 0]
+            final_tallies[:, targets] += drawn[:, 1:-1]
+            random_counts += drawn[:, -1]
+
+        final_tallies[:, :num_reported] += rng.multinomial(
+            random_counts, self.random_proportions)
+        return final_tallies
+
+
+def compute_win_probs_comparison(cvr_tally, sample_pairs, seed, num_trials,
+                                 real_names, vote_for_n=1,
+                                 voting_method=voting_models.IRVModel,
+                                 match_prior=1.0, error_prior=0.01,
+                                 use_certificate=True):
+    """
+    Estimate, by num_trials simulations of the comparison-audit
+    posterior, the probability that each candidate wins a full hand count.
+
+    Args:
+        cvr_tally, sample_pairs, match_prior, error_prior: as for
+            ComparisonPosterior
+        seed (int): seed of the simulation; batch b of trials draws from
+            bptool.create_batch_rng(seed, b)
+        num_trials (int): number of trials
+        real_names (list): the candidate names
+        vote_for_n (int): number of winners
+        voting_method: a voting model or model class (see
+            voting_models), or an old-style RCV voting method such as
+            audit_me.rcv_wrapper, for the ballot types
+        use_certificate (bool): whether trials that follow the reported
+            elimination order are decided by a certificate of it (only
+            if bptool.certificate_is_exact holds for voting_method)
+
+    Returns:
+        (list): pairs (i, p), as for bptool.compute_win_probs_rcv
+    """
+
+    seed = bptool.resolve_seed(seed)
+    posterior = ComparisonPosterior(cvr_tally, sample_pairs, match_prior,
+                                    error_prior)
+    ballot_types = posterior.ballot_types
+    model = voting_models.as_model(voting_method, ballot_types, vote_for_n)
+    if model is None:
+        model = voting_models.CallableModel(voting_method, ballot_types,
+                                            vote_for_n)
+    certificate = None
+    if use_certificate and bptool.certificate_is_exact(voting_method,
+                                                       vote_for_n):
+        certificate = rcv_certificate.build_certificate(
+            ballot_types, posterior.reported_counts.tolist())
+
+    win_count = {}
+    batch_size = bptool.CERTIFICATE_BATCH_SIZE
+    for batch, first in enumerate(range(0, num_trials, batch_size)):
+        size = min(batch_size, num_trials - first)
+        final_tallies = posterior.simulate_final_tallies(
+            bptool.create_batch_rng(seed, batch), size)
+        if certificate is None:
+            certified = np.zeros(size, dtype=bool)
+        else:
+            certified = certificate.holds(final_tallies)
+            win_count[certificate.winner] = \
+                win_count.get(certificate.winner, 0) + int(certified.sum())
+        if not certified.all():
+            bptool.add_model_wins(win_count, model,
+                                  model.winners(final_tallies[~certified]))
+    return [(i, win_count.get(name, 0) / float(num_trials))
+            for i, name in enumerate(real_names)]
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,217 @@
+# exact_win_probs.py
+# python3
+
+"""
+Exact win probabilities for contests that come down to two candidates.
+
+When only two candidates A and B can win, the Bayesian audit needs no
+simulation.  With Dirichlet parameters alpha_a, alpha_b, alpha_e for the
+ballots counting for A, for B, and for neither (exhausted RCV ballots),
+and M unsampled ballots, the number S of unsampled ballots counting for
+A or B is beta-binomial(M, alpha_a + alpha_b, alpha_e), and given S the
+number X of them for A is beta-binomial(S, alpha_a, alpha_b).  A wins if
+    a + X > b + S - X,
+where a and b are the sample counts, i.e. if X exceeds the threshold
+k_S = floor((b - a + S) / 2).  (If S = b - a + 2 X exactly, it is a tie.)
+
+The tail P(X > k_S | S) is needed for every S = 0, ..., M.  It follows
+from the Polya urn: going from S to S + 1 ballots, the next ballot is for
+A with probability (alpha_a + X) / (alpha_a + alpha_b + S), so
+
+    P(X_{S+1} <= k) = P(X_S <= k) - P(X_S = k) (alpha_a + k) / (alpha_a + alpha_b + S),
+
+and as S grows k_S grows by 0 or 1, adding one more pmf term.  Every step
+is a sum of pmf values, all computed at once from tables of log-gamma
+values, so the whole computation is a few numpy passes of length M.
+
+This covers two-candidate plurality contests (no exhausted ballots) and
+RCV contests whose ballot types, once pruned and reduced (see
+rcv_reduction), mention only two candidates.  Only one county may have
+unsampled ballots; the others just add their sample counts.  Ties go to
+the candidate that bptool.plurality_winner or rcv.rcv_winner (with an
+empty tie_breaker) would pick: the second candidate in plurality, and
+the alphabetically later name in RCV.
+"""
+
+import math
+
+import numpy as np
+
+import rcv_reduction
+
+
+def log_gamma_table(x0, size):
+    """
+    Return array of lgamma(x0 + m) for m = 0, ..., size.
+
+    Example:
+        >>> np.round(np.exp(log_gamma_table(1, 4)), 6).tolist()
+        [1.0, 1.0, 2.0, 6.0, 24.0]
+    """
+
+    return math.lgamma(x0) + np.concatenate(
+        [[0.0], np.cumsum(np.log(x0 + np.arange(size)))])
+
+
+def beta_binomial_pmf(n, k, alpha, beta, size):
+    """
+    Return the beta-binomial(n, alpha, beta) pmf at k, elementwise for
+    integer arrays n and k with 0 <= n <= size; it is 0 where k < 0 or
+    k > n.
+    """
+
+    n = np.asarray(n)
+    k = np.asarray(k)
+    inside = (k >= 0) & (k <= n)
+    k = np.clip(k, 0, n)
+    log_factorial = log_gamma_table(1, size)
+    log_beta = math.lgamma(alpha) + math.lgamma(beta) \
+        - math.lgamma(alpha + beta)
+    log_pmf = log_factorial[n] - log_factorial[k] - log_factorial[n - k] \
+        + log_gamma_table(alpha, size)[k] \
+        + log_gamma_table(beta, size)[n - k] \
+        - log_gamma_table(alpha + beta, size)[n] - log_beta
+    return np.where(inside, np.exp(log_pmf), 0.0)
+
+
+def pairwise_win_probability(margin, nonsample_size, alpha_a, alpha_b,
+                             alpha_e=0.0, a_wins_ties=False):
+    """
+    Return the posterior probability that A beats B.
+
+    Args:
+        margin (int): A's sample count minus B's
+        nonsample_size (int): number of unsampled ballots, M
+        alpha_a, alpha_b, alpha_e (float): Dirichlet parameters of the
+            ballots for A, for B and for neither; alpha_e may be 0
+        a_wins_ties (bool): whether A wins a tie
+
+    Returns:
+        (float): P(A wins)
+
+    Example:
+        >>> round(pairwise_win_probability(0, 101, 11, 11), 12)
+        0.5
+        >>> pairwise_win_probability(5, 3, 11, 20, 4)
+        1.0
+    """
+
+    m = nonsample_size
+    s = np.arange(m + 1)
+    k = (s - margin) // 2
+    pmf_k = beta_binomial_pmf(s, k, alpha_a, alpha_b, m)
+    # P(X_S <= k_S) for every S, by the Polya-urn recursion
+    steps = -pmf_k[:-1] * (alpha_a + k[:-1]) / (alpha_a + alpha_b + s[:-1]) \
+        + (k[1:] > k[:-1]) * pmf_k[1:]
+    cdf_k = (1.0 if k[0] >= 0 else 0.0) \
+        + np.concatenate([[0.0], np.cumsum(steps)])
+    cdf_k = np.clip(cdf_k, 0.0, 1.0)
+    win_given_s = 1.0 - cdf_k
+    if a_wins_ties:
+        win_given_s += np.where((s - margin) % 2 == 0, pmf_k, 0.0)
+    if alpha_e == 0:
+        return float(min(1.0, max(0.0, win_given_s[m])))
+    s_pmf = beta_binomial_pmf(np.full(m + 1, m), s, alpha_a + alpha_b,
+                              alpha_e, m)
+    return float(min(1.0, max(0.0, s_pmf @ win_given_s)))
+
+
+def _single_open_county(total_num_votes, sample_tallies):
+    """
+    Return the index of the one county with unsampled ballots, -1 if
+    there is none, and None if there are several.
+    """
+
+    open_counties = [i for i, sample_tally in enumerate(sample_tallies)
+                     if total_num_votes[i] > sum(sample_tally)]
+    if len(open_counties) > 1:
+        return None
+    return open_counties[0] if open_counties else -1
+
+
+def plurality_win_probs(sample_tallies, total_num_votes):
+    """
+    Return exact win probabilities of a two-candidate plurality contest
+    (with the +1 prior and vote_for_n = 1), as bptool.compute_win_probs
+    would estimate them, or None if the contest is not one this module
+    can handle.
+
+    Example:
+        >>> plurality_win_probs([[30, 10]], [40])
+        [(1, 1.0), (2, 0.0)]
+    """
+
+    if len(sample_tallies[0]) != 2:
+        return None
+    county = _single_open_county(total_num_votes, sample_tallies)
+    if county is None:
+        return None
+    a, b = [sum(k) for k in zip(*sample_tallies)]
+    if county < 0:
+        p = 1.0 if a > b else 0.0
+    else:
+        nonsample_size = total_num_votes[county] - sum(sample_tallies[county])
+        p = pairwise_win_probability(a - b, nonsample_size,
+                                     sample_tallies[county][0] + 1,
+                                     sample_tallies[county][1] + 1)
+    return [(1, p), (2, 1.0 - p)]
+
+
+def rcv_win_probs(unique_ballots, sample_tallies, total_num_votes,
+                  real_names, priors=None):
+    """
+    Return exact win probabilities of an RCV contest whose ballot types
+    mention only two candidates, as bptool.compute_win_probs_rcv would
+    estimate them, or None if the contest is not one this module can
+    handle.
+
+    Args:
+        as for bptool.compute_win_probs_rcv, after the ballot types have
+        been reduced (see bptool.prepare_rcv_trials)
+
+    Returns:
+        (list): pairs (i, p) as for bptool.compute_win_probs_rcv, with
+            probability 0 for candidates not on any ballot type
+
+    Example:
+        >>> rcv_win_probs([('a',), ('b',), ()], [[30, 10, 5]], [45],
+        ...               ['a', 'b', 'c'])
+        [(0, 1.0), (1, 0.0), (2, 0.0)]
+    """
+
+    candidates = sorted(rcv_reduction.candidates_of(unique_ballots))
+    if len(candidates) != 2:
+        return None
+    county = _single_open_county(total_num_votes, sample_tallies)
+    if county is None:
+        return None
+    name_a, name_b = candidates      # B is the later name, and wins ties
+    groups = np.array([[ballot[0] == name_a if ballot else False,
+                        ballot[0] == name_b if ballot else False,
+                        not ballot]
+                       for ballot in unique_ballots], dtype=float)
+    a, b, _ = np.array([sum(k) for k in zip(*sample_tallies)]) @ groups
+    if a + b == 0:
+        return None                  # the winner would depend on dict order
+    if county < 0:
+        p = 1.0 if a > b else 0.0
+    else:
+        prior = np.ones(len(unique_ballots)) if priors is None \
+            else np.asarray(priors[county], dtype=float)
+        alpha_a, alpha_b, alpha_e = \
+            (np.asarray(sample_tallies[county]) + prior) @ groups
+        nonsample_size = total_num_votes[county] - sum(sample_tallies[county])
+        if alpha_b == 0:
+            p = 1.0                  # no ballot type has B first
+        elif alpha_a == 0:
+            p = 0.0
+        else:
+            p = pairwise_win_probability(int(a - b), nonsample_size,
+                                         alpha_a, alpha_b, alpha_e)
+    probs = {name_a: p, name_b: 1.0 - p}
+    return [(i, probs.get(name, 0.0)) for i, name in enumerate(real_names)]
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
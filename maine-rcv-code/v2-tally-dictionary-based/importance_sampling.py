@@ -0,0 +1,292 @@
+# importance_sampling.py
+# python3
+
+"""
+Importance sampling for small upset probabilities in RCV audits.
+
+The probabilities that matter most at the end of an audit are small:
+the chance that the reported winner loses, or the 0.002 of a trailing
+candidate.  Plain Monte Carlo estimates a probability p with relative
+standard error sqrt((1-p) / (p T)), so p = 1e-3 to within 10% needs
+about 100,000 trials.
+
+Here, to estimate the chance that a losing candidate c wins, the
+posterior Dirichlet(a) of each county is replaced by a tilted
+Dirichlet(a') that favors c over the reported winner w:
+
+    a'_t  proportional to  a_t exp(theta s_t),   with sum(a') = sum(a),
+
+where s_t is +1 if ballot type t ranks c above w (or c but not w), -1
+if it ranks w above c (or w but not c), and 0 if it ranks neither.
+theta >= 0 is the smallest tilt for which c and w are expected to tie
+head-to-head in the final tally (no tilt if c is expected to beat w
+already).  Each trial is drawn from the tilted posterior, followed by
+the usual multinomial step, and weighted by the likelihood ratio
+
+    Dirichlet(p; a) / Dirichlet(p; a')
+        = prod_t exp(lgamma(a'_t) - lgamma(a_t)) p_t ** (a_t - a'_t)
+
+(the multinomial step is the same under both, so it cancels).  The mean
+of weight * [c wins] is an unbiased estimate of P(c wins), with a
+standard error estimated from the same trials.  The weights are
+computed relative to the largest of them (log-sum-exp), so they neither
+underflow nor overflow, however far the tilt moves the posterior.
+
+Each loser gets its own run of num_trials trials, the run of
+real_names[i] drawing from the stream
+    SeedSequence(seed, spawn_key=(bptool.IMPORTANCE_SPAWN_KEY, i)),
+apart from bptool's per-trial streams.  The reported winner's
+probability is one minus the sum of the others, with the standard errors
+combined accordingly.  The "reported winner" is the winner of the sample
+tally, which must be one of real_names.
+"""
+
+import math
+
+import numpy as np
+
+import bptool
+import variance_reduction
+
+# The tilt theta is searched for in [0, MAX_TILT].
+MAX_TILT = 20.0
+
+# A loser's run is reported as degenerate when its effective sample size
+# is below this fraction of its trials: a few trials then carry most of
+# the weight, and its standard error is not to be trusted.
+MIN_EFFECTIVE_FRACTION = 0.01
+
+
+def pairwise_scores(unique_ballots, challenger, winner):
+    """
+    Return array of +1 / -1 / 0 per ballot type: whether the type prefers
+    challenger to winner, winner to challenger, or ranks neither.
+
+    Example:
+        >>> pairwise_scores([('a', 'b'), ('b',), ('c',)], 'b', 'a').tolist()
+        [-1.0, 1.0, 0.0]
+    """
+
+    scores = np.zeros(len(unique_ballots))
+    for t, ballot in enumerate(unique_ballots):
+        for name in ballot:
+            if name == challenger:
+                scores[t] = 1.0
+                break
+            if name == winner:
+                scores[t] = -1.0
+                break
+    return scores
+
+
+def tilt(alphas, scores, theta):
+    """
+    Return the tilted parameters a_t exp(theta s_t), rescaled so each
+    county's parameters keep their sum (alphas is counties x types).
+    """
+
+    tilted = alphas * np.exp(theta * scores)
+    return tilted * (alphas.sum(axis=1, keepdims=True)
+                     / tilted.sum(axis=1, keepdims=True))
+
+
+def expected_margin(sample_tallies, total_num_votes, alphas, scores):
+    """
+    Return the expected head-to-head margin of the challenger over the
+    winner in the final tally, summed over counties, when each county's
+    unsampled ballots are drawn with mean proportions alphas / sum(alphas).
+    """
+
+    margin = 0.0
+    for i, sample_tally in enumerate(sample_tallies):
+        nonsample_size = total_num_votes[i] - sum(sample_tally)
+        margin += float(np.asarray(sample_tally) @ scores) \
+            + nonsample_size * float(alphas[i] @ scores) / alphas[i].sum()
+    return margin
+
+
+def tie_tilt(sample_tallies, total_num_votes, alphas, scores,
+             tolerance=1e-6):
+    """
+    Return the smallest theta in [0, MAX_TILT] at which expected_margin of
+    the tilted parameters is zero (0 if it is already nonnegative, and
+    MAX_TILT if no such theta exists).  The margin increases with theta,
+    so bisection finds it.
+    """
+
+    def margin(theta):
+        return expected_margin(sample_tallies, total_num_votes,
+                               tilt(alphas, scores, theta), scores)
+
+    if margin(0.0) >= 0:
+        return 0.0
+    if margin(MAX_TILT) < 0:
+        return MAX_TILT
+    low, high = 0.0, MAX_TILT
+    while high - low > tolerance:
+        middle = (low + high) / 2
+        if margin(middle) < 0:
+            low = middle
+        else:
+            high = middle
+    return high
+
+
+def simulate_tilted(sample_tallies, total_num_votes, alphas, tilted, rng,
+                    num_trials):
+    """
+    Draw num_trials final tallies from the posterior tilted to tilted,
+    and return (final_tallies, log_weights), where log_weights are the
+    log likelihood ratios of the posterior alphas to the tilted one.
+    """
+
+    num_counties, num_types = alphas.shape
+    gammas = rng.gamma(tilted, size=(num_trials, num_counties, num_types))
+    proportions = gammas / gammas.sum(axis=2, keepdims=True)
+    log_normalizer = sum(math.lgamma(b) - math.lgamma(a)
+                         for a, b in zip(alphas.ravel(), tilted.ravel()))
+    log_weights = log_normalizer + np.einsum("tck,ck->t",
+                                             np.log(proportions),
+                                             alphas - tilted)
+    final_tallies = np.zeros((num_trials, num_types))
+    for i, sample_tally in enumerate(sample_tallies):
+        nonsample_size = total_num_votes[i] - sum(sample_tally)
+        if nonsample_size < 0:
+            raise ValueError("total_num_votes {} less than sample_size {}."
+                             .format(total_num_votes[i], sum(sample_tally)))
+        final_tallies += np.asarray(sample_tally) \
+            + rng.multinomial(nonsample_size, proportions[:, i])
+    return final_tallies, log_weights
+
+
+def _rescale(x, log_scale):
+    """
+    Return x exp(log_scale), for x >= 0, computed in log space and capped
+    at 1 (x is a probability, or its standard error).
+    """
+
+    if x <= 0:
+        return 0.0
+    return math.exp(min(0.0, math.log(x) + log_scale))
+
+
+def compute_win_probs_rcv(sample_tallies,
+                          total_num_votes,
+                          seed,
+                          num_trials,
+                          unique_ballots,
+                          real_names,
+                          vote_for_n, rcv_wrapper,
+                          priors=None,
+                          prune_epsilon=None,
+                          merge_types=False,
+                          use_certificate=True):
+    """
+    Like bptool.compute_win_probs_rcv, but every losing candidate's win
+    probability is estimated by importance sampling (see the module
+    docstring).
+
+    Args:
+        num_trials (int): trials per losing candidate
+        real_names (list): the candidate names, which must include the
+            winner of the sample tally (ValueError otherwise)
+        the other parameters: as for bptool.compute_win_probs_rcv
+
+    Returns:
+        (win_probs, stats), where win_probs is as for
+        bptool.compute_win_probs_rcv, and stats is a dict with keys
+        "reported_winner" (an index into real_names), and "std_errors",
+        "tilts", "effective_sample_size" and "degenerate", lists of pairs
+        (i, x) indexed like win_probs.  The effective sample size of a
+        loser's run is Kish's (sum of weights)**2 / (sum of squared
+        weights); it is small when a few trials carry most of the weight.
+        A run is degenerate when its effective sample size is below
+        MIN_EFFECTIVE_FRACTION of num_trials (or every weight is zero);
+        its estimate and standard error are then unreliable, and a
+        plain bptool.compute_win_probs_rcv run is the safer choice.
+    """
+
+    seed = bptool.resolve_seed(seed)
+    bptool.check_reduction(rcv_wrapper, vote_for_n, prune_epsilon,
+                           merge_types,
+                           "importance_sampling.compute_win_probs_rcv")
+    use_certificate = use_certificate \
+        and bptool.certificate_is_exact(rcv_wrapper, vote_for_n)
+    unique_ballots, sample_tallies, priors, certificate = \
+        bptool.prepare_rcv_trials(unique_ballots, sample_tallies,
+                                  total_num_votes, priors, prune_epsilon,
+                                  merge_types, use_certificate)
+    sample_tally = [sum(k) for k in zip(*sample_tallies)]
+    reported_winner = variance_reduction.trial_winners(
+        unique_ballots, np.array([sample_tally]), [False], None,
+        rcv_wrapper, vote_for_n)[0]
+    if reported_winner not in real_names:
+        raise ValueError("compute_win_probs_rcv: the winner of the sample, "
+                         "{}, is not one of real_names."
+                         .format(reported_winner))
+    alphas = variance_reduction.posterior_parameters(sample_tallies, priors)
+    ranked = set(name for ballot in unique_ballots for name in ballot)
+
+    estimates = {}
+    for i, challenger in enumerate(real_names):
+        if challenger == reported_winner:
+            continue
+        if challenger not in ranked:
+            # pruned, or never ranked in the sample
+            estimates[i] = (0.0, 0.0, 0.0, float(num_trials), False)
+            continue
+        scores = pairwise_scores(unique_ballots, challenger, reported_winner)
+        theta = tie_tilt(sample_tallies, total_num_votes, alphas, scores)
+        rng = np.random.Generator(np.random.PCG64(np.random.SeedSequence(
+            seed, spawn_key=(bptool.IMPORTANCE_SPAWN_KEY, i))))
+        final_tallies, log_weights = simulate_tilted(
+            sample_tallies, total_num_votes, alphas,
+            tilt(alphas, scores, theta), rng, num_trials)
+
+        if certificate is not None:
+            certified = certificate.holds(final_tallies)
+        else:
+            certified = np.zeros(num_trials, dtype=bool)
+        winners = variance_reduction.trial_winners(
+            unique_ballots, final_tallies, certified, certificate,
+            rcv_wrapper, vote_for_n)
+        wins = np.array([winner == challenger for winner in winners],
+                        dtype=float)
+
+        # weights relative to the largest, exp(max_log_weight) apart
+        max_log_weight = float(log_weights.max())
+        if not math.isfinite(max_log_weight):
+            # every weight is zero (or the tilt overflowed)
+            estimates[i] = (0.0, 0.0, theta, 0.0, True)
+            continue
+        weights = np.exp(log_weights - max_log_weight)
+        weighted = weights * wins
+        p = _rescale(float(weighted.mean()), max_log_weight)
+        standard_error = _rescale(float(weighted.std(ddof=1))
+                                  / math.sqrt(num_trials), max_log_weight) \
+            if num_trials > 1 else 0.0
+        ess = float(weights.sum() ** 2 / (weights ** 2).sum())
+        estimates[i] = (p, standard_error, theta, ess,
+                        ess < MIN_EFFECTIVE_FRACTION * num_trials)
+
+    winner_index = real_names.index(reported_winner)
+    upset = sum(p for p, _, _, _, _ in estimates.values())
+    estimates[winner_index] = (
+        max(0.0, 1.0 - upset),
+        math.sqrt(sum(se ** 2 for _, se, _, _, _ in estimates.values())),
+        0.0, float(num_trials),
+        any(degenerate for _, _, _, _, degenerate in estimates.values()))
+    indices = range(len(real_names))
+    win_probs = [(i, estimates[i][0]) for i in indices]
+    stats = {"reported_winner": winner_index,
+             "std_errors": [(i, estimates[i][1]) for i in indices],
+             "tilts": [(i, estimates[i][2]) for i in indices],
+             "effective_sample_size": [(i, estimates[i][3])
+                                       for i in indices],
+             "degenerate": [(i, estimates[i][4]) for i in indices]}
+    return win_probs, stats
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,152 @@
+# rcv_certificate.py
+# python3
+
+"""
+Certificates that a tally over ballot types has a given IRV outcome.
+
+Almost every trial of a Bayesian RCV audit follows the same elimination
+order as the sample does.  Given the ballot types, that order is fixed by
+a set of linear inequalities over the ballot-type counts: in round r,
+every continuing candidate c other than the candidate e_r eliminated in
+that round must have strictly more first-choice votes than e_r, i.e.
+
+    sum over types t whose top continuing choice is c of x_t
+  - sum over types t whose top continuing choice is e_r of x_t  >  0.
+
+Which types count for whom in round r depends only on e_1, ..., e_{r-1},
+so each inequality is a fixed row of an integer matrix A, and a tally x
+follows the certified order if and only if A x > 0 componentwise.  With
+strict inequalities tie-breaking never comes into it.  (If only two
+candidates continue and e_r has no votes at all, rcv.rcv_round declares
+the other candidate the winner a round early; that is the same winner.)
+
+So for a whole batch of simulated tallies X (one row per trial), the
+trials following the certified order are those rows of X @ A.T that are
+all positive, and only the others need a full rcv.rcv_winner tabulation.
+"""
+
+import numpy as np
+
+import rcv
+
+
+class IRVCertificate:
+    """
+    Linear certificate of an IRV elimination order over fixed ballot types.
+
+    Attributes:
+        unique_ballots (list): the ballot types (tuples of choices)
+        elimination_order (list): candidates in order of elimination
+        winner (str): the certified winner
+        matrix (numpy array): one row per inequality, one column per
+            ballot type; the certificate holds for a tally x iff
+            matrix @ x > 0 in every row
+    """
+
+    def __init__(self, unique_ballots, elimination_order, winner, matrix):
+        self.unique_ballots = unique_ballots
+        self.elimination_order = elimination_order
+        self.winner = winner
+        self.matrix = matrix
+
+    def holds(self, tallies):
+        """
+        Return boolean array telling, for each row of tallies, whether
+        the certificate holds for it.
+
+        Args:
+            tallies (array-like): either one tally (a vector of counts
+                indexed like unique_ballots) or a 2-D array of tallies,
+                one per row
+
+        Returns:
+            (numpy array): booleans, one per tally (a scalar array for a
+                single tally)
+
+        Example:
+            >>> cert = build_certificate([('a',), ('b', 'a'), ('c', 'b')],
+            ...                          [6, 3, 2])
+            >>> cert.holds([[6, 3, 2], [6, 2, 3], [3, 3, 4]]).tolist()
+            [True, False, False]
+        """
+
+        tallies = np.asarray(tallies, dtype=float)
+        if len(self.matrix) == 0:
+            return np.ones(tallies.shape[:-1], dtype=bool)
+        margins = tallies @ self.matrix.T
+        return np.all(margins > 0, axis=-1)
+
+
+def top_choices(unique_ballots, eliminated):
+    """
+    Return list giving, for each ballot type, its top choice among the
+    candidates not in eliminated, or None if it has none.
+
+    Example:
+        >>> top_choices([('a', 'b'), ('b',), ('a',)], {'a'})
+        ['b', 'b', None]
+    """
+
+    tops = []
+    for ballot in unique_ballots:
+        top = None
+        for name in ballot:
+            if name not in eliminated:
+                top = name
+                break
+        tops.append(top)
+    return tops
+
+
+def build_certificate(unique_ballots, tally, tie_breaker=None):
+    """
+    Tabulate tally by IRV and return a certificate of its outcome.
+
+    Args:
+        unique_ballots (list): ballot types (tuples of choices)
+        tally (list): counts indexed like unique_ballots, e.g. the sample
+            tally, summed over counties
+        tie_breaker (list): as for rcv.rcv_winner; only used to tabulate
+            tally itself
+
+    Returns:
+        (IRVCertificate): certificate of the elimination order and
+            winner found for tally.  If tally is won "early", with other
+            candidates continuing but having no votes at all, no strict
+            inequalities describe it, and the certificate never holds.
+
+    Example:
+        >>> cert = build_certificate([('a',), ('b', 'a'), ('c', 'b')],
+        ...                          [6, 3, 2])
+        >>> cert.elimination_order, cert.winner
+        (['c', 'b'], 'a')
+        >>> cert.matrix.tolist()
+        [[1, 0, -1], [0, 1, -1], [1, -1, -1]]
+    """
+
+    if tie_breaker is None:
+        tie_breaker = []
+    current = {ballot: count for ballot, count in zip(unique_ballots, tally)}
+    elimination_order = []
+    rows = []
+    while True:
+        (w, d, e, LL) = rcv.rcv_round(current, tie_breaker)
+        if w is not None:
+            if len(d) > 1:
+                rows.append([0] * len(unique_ballots))
+            break
+        tops = top_choices(unique_ballots, set(elimination_order))
+        for c in sorted(d):
+            if c == e:
+                continue
+            rows.append([(top == c) - (top == e) for top in tops])
+        elimination_order.append(e)
+        current = rcv.delete_name(LL, e)
+    matrix = np.array(rows, dtype=np.int64).reshape(len(rows),
+                                                    len(unique_ballots))
+    return IRVCertificate(list(unique_ballots), elimination_order, w, matrix)
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,453 @@
+# rcv_reduction.py
+# python3
+
+"""
+Reduce the size of a Bayesian RCV audit simulation before running trials.
+
+In our Maine outputs, candidates like "Dion, Donna J." and Write-in have
+win probability 0.0 in essentially every cell, yet each trial tabulates
+them round by round.  This module finds candidates who (with posterior
+probability at least 1 - epsilon) are eliminated before any of the other
+candidates, removes them from every ballot type once, before the trials,
+and merges the ballot types that become identical.
+
+The elimination rule is the usual "batch elimination" rule: if the
+candidates in a set S together have fewer first-choice votes than each
+candidate outside S, then every member of S is eliminated, one by one,
+before anyone outside S (votes only move from S to S or out of S as they
+go), and the outcome is the same as for the ballots with S deleted.  The
+first-choice counts are not known, so we use posterior bounds on them:
+the share of ballot types in a group has a Beta posterior (aggregation
+of the Dirichlet), and the count given the share is binomial.  The bounds
+use exact Beta quantiles and Bernstein's inequality, with a union bound
+over all the comparisons made, so the total probability that a pruned
+candidate could in fact have survived is at most epsilon.
+
+Merging ballot types is exact: merged types get the sum of their sample
+counts and of their prior pseudocounts.  Besides deleting pruned
+candidates, two more projections of a ballot never change the IRV outcome:
+    -deleting repeated rankings of a candidate already ranked higher
+     (rcv.delete_name removes all occurrences at once), and
+    -deleting everything from the ballot's ranking of the last of the
+     candidates who could still win, since that ranking is reached only
+     when all the others have been eliminated, and the winner is then
+     already determined.
+Many ballot types become identical under these projections; see
+reduce_ballot_types.
+"""
+
+import math
+
+
+##############################################################################
+## Beta distribution
+##############################################################################
+
+def _beta_continued_fraction(x, a, b):
+    """
+    Continued fraction for the regularized incomplete beta function,
+    evaluated by the modified Lentz method.
+    """
+
+    tiny = 1e-300
+    c = 1.0
+    d = 1.0 - (a + b) * x / (a + 1)
+    d = 1.0 / (d if abs(d) > tiny else tiny)
+    h = d
+    for m in range(1, 10000):
+        m2 = 2 * m
+        aa = m * (b - m) * x / ((a + m2 - 1) * (a + m2))
+        d = 1.0 + aa * d
+        d = 1.0 / (d if abs(d) > tiny else tiny)
+        c = 1.0 + aa / c
+        c = c if abs(c) > tiny else tiny
+        h *= d * c
+        aa = -(a + m) * (a + b + m) * x / ((a + m2) * (a + m2 + 1))
+        d = 1.0 + aa * d
+        d = 1.0 / (d if abs(d) > tiny else tiny)
+        c = 1.0 + aa / c
+        c = c if abs(c) > tiny else tiny
+        delta = d * c
+        h *= delta
+        if abs(delta - 1.0) < 1e-15:
+            break
+    return h
+
+
+def beta_cdf(x, a, b):
+    """
+    Return the Beta(a, b) cumulative distribution function at x.
+
+    Args:
+        x (float): point in [0, 1]
+        a, b (float): positive parameters
+
+    Returns:
+        (float): P(X <= x) for X ~ Beta(a, b)
+
+    Example:
+        >>> round(beta_cdf(0.5, 3, 3), 12)
+        0.5
+        >>> round(beta_cdf(0.25, 1, 1), 12)
+        0.25
+    """
+
+    if x <= 0:
+        return 0.0
+    if x >= 1:
+        return 1.0
+    log_front = (math.lgamma(a + b) - math.lgamma(a) - math.lgamma(b)
+                 + a * math.log(x) + b * math.log1p(-x))
+    if x < (a + 1) / (a + b + 2):
+        return math.exp(log_front) * _beta_continued_fraction(x, a, b) / a
+    return 1.0 - (math.exp(log_front)
+                  * _beta_continued_fraction(1 - x, b, a) / b)
+
+
+def beta_quantile(q, a, b):
+    """
+    Return x such that beta_cdf(x, a, b) == q, found by bisection.
+
+    Example:
+        >>> round(beta_quantile(0.5, 3, 3), 9)
+        0.5
+    """
+
+    low, high = 0.0, 1.0
+    for _ in range(100):
+        middle = (low + high) / 2
+        if beta_cdf(middle, a, b) < q:
+            low = middle
+        else:
+            high = middle
+    return (low + high) / 2
+
+
+##############################################################################
+## Posterior bounds on counts
+##############################################################################
+
+def _bernstein_deviation(n, p, log_term):
+    """
+    Return t such that P(Bin(n, p) - n p >= t) <= exp(-log_term),
+    and likewise for the lower tail, by Bernstein's inequality.
+    """
+
+    return log_term / 3 + math.sqrt(log_term ** 2 / 9
+                                    + 2 * n * p * (1 - p) * log_term)
+
+
+def count_bounds(sample_count, prior_count, prior_total, nonsample_size,
+                 epsilon):
+    """
+    Return (low, high) bounds on the final count of a group of ballot
+    types, each of which fails with posterior probability at most epsilon.
+
+    The final count is sample_count + M, where M is Binomial(n, p) given
+    the group's share p, and p ~ Beta(a, A - a) with a the group's sample
+    count plus prior and A the same for all ballot types.  Since M is
+    stochastically increasing in p, it is enough to bound p by its
+    epsilon/2 quantile and M given that p by Bernstein's inequality at
+    epsilon/2.
+
+    Args:
+        sample_count (float): number of sampled ballots in the group
+        prior_count (float): sample_count plus the group's pseudocounts
+        prior_total (float): the same, summed over all ballot types
+        nonsample_size (int): number of unsampled ballots
+        epsilon (float): allowed failure probability of each bound
+
+    Returns:
+        (low, high): floats with low <= final count <= high, each with
+        probability at least 1 - epsilon.
+
+    Example:
+        >>> low, high = count_bounds(0, 0, 100, 1000, 0.01)
+        >>> (low, high)
+        (0, 0)
+    """
+
+    if prior_count <= 0 or nonsample_size <= 0:
+        return (sample_count, sample_count)
+    if prior_count >= prior_total:
+        return (sample_count + nonsample_size, sample_count + nonsample_size)
+    log_term = math.log(2 / epsilon)
+    p_low = beta_quantile(epsilon / 2, prior_count, prior_total - prior_count)
+    p_high = beta_quantile(1 - epsilon / 2, prior_count,
+                           prior_total - prior_count)
+    low = nonsample_size * p_low \
+        - _bernstein_deviation(nonsample_size, p_low, log_term)
+    high = nonsample_size * p_high \
+        + _bernstein_deviation(nonsample_size, p_high, log_term)
+    low = max(0.0, low)
+    high = min(float(nonsample_size), high)
+    return (sample_count + low, sample_count + high)
+
+
+##############################################################################
+## Pruning and merging
+##############################################################################
+
+def candidates_of(unique_ballots):
+    """
+    Return sorted list of all choices appearing on any of the ballots.
+
+    Example:
+        >>> candidates_of([('b', 'a'), ('c',), ()])
+        ['a', 'b', 'c']
+    """
+
+    return sorted({name for ballot in unique_ballots for name in ballot})
+
+
+def project_ballot(ballot, eliminated):
+    """
+    Return ballot with all choices in the set eliminated removed.
+
+    Example:
+        >>> project_ballot(('a', 'b', 'c'), {'b'})
+        ('a', 'c')
+    """
+
+    return tuple(name for name in ballot if name not in eliminated)
+
+
+def reduce_ballot(ballot, eliminated, possible_winners):
+    """
+    Return the projection of ballot that matters for the IRV outcome.
+
+    Deletes the choices in eliminated and repeated choices, and cuts the
+    ballot just before it ranks the last member of possible_winners it
+    has not yet ranked (the winner must be in possible_winners, so by the
+    time that ranking is reached the winner is determined).
+
+    Args:
+        ballot (tuple): a ballot
+        eliminated (set): choices known to be eliminated first
+        possible_winners (set): choices that could still win
+
+    Returns:
+        (tuple): the projected ballot
+
+    Examples:
+        >>> reduce_ballot(('a', 'x', 'b', 'a', 'c'), {'x'}, {'a', 'b', 'c'})
+        ('a', 'b')
+        >>> reduce_ballot(('c', 'a', 'b'), set(), {'a', 'b'})
+        ('c', 'a')
+    """
+
+    projected = []
+    unranked_winners = len(possible_winners)
+    for name in ballot:
+        if name in eliminated or name in projected:
+            continue
+        if name in possible_winners:
+            if unranked_winners == 1:
+                break
+            unranked_winners -= 1
+        projected.append(name)
+    return tuple(projected)
+
+
+def _group_bounds(unique_ballots, sample_tallies, priors, total_num_votes,
+                  eliminated, group, epsilon):
+    """
+    Return (low, high) bounds, summed over counties, on the number of
+    ballots whose first choice among the non-eliminated candidates is
+    in group.
+    """
+
+    low, high = 0.0, 0.0
+    county_epsilon = epsilon / len(sample_tallies)
+    for i, sample_tally in enumerate(sample_tallies):
+        sample_count = 0
+        prior_count = 0
+        for j, ballot in enumerate(unique_ballots):
+            projected = project_ballot(ballot, eliminated)
+            if len(projected) > 0 and projected[0] in group:
+                sample_count += sample_tally[j]
+                prior_count += sample_tally[j] + priors[i][j]
+        prior_total = sum(sample_tally) + sum(priors[i])
+        nonsample_size = total_num_votes[i] - sum(sample_tally)
+        county_low, county_high = count_bounds(sample_count, prior_count,
+                                               prior_total, nonsample_size,
+                                               county_epsilon)
+        low += county_low
+        high += county_high
+    return (low, high)
+
+
+def prune_hopeless_candidates(unique_ballots, sample_tallies,
+                              total_num_votes, epsilon=1e-4, priors=None):
+    """
+    Return list of candidates who are, with posterior probability at
+    least 1 - epsilon, eliminated before all the other candidates.
+
+    Works in stages.  At each stage, the remaining candidates are ordered
+    by their expected first-choice count, and the largest group S of
+    bottom candidates is found whose upper bound on combined first-choice
+    count is below the lower bound of every candidate outside S.  S is
+    then eliminated, the ballots projected, and the next stage begins.
+    At least one candidate is always kept.
+
+    The default epsilon of 1e-4 is well below the Monte Carlo error of
+    the trial counts we use, so pruning does not visibly change results.
+
+    Args:
+        unique_ballots (list): ballot types (tuples of choices)
+        sample_tallies (list): list (one per county) of lists of sample
+            counts, indexed like unique_ballots
+        total_num_votes (list): total number of ballots in each county
+        epsilon (float): allowed total failure probability
+        priors (list): None or list of lists of pseudocounts, shaped like
+            sample_tallies; None means one for every ballot type
+
+    Returns:
+        (list): pruned candidates, in the order they were found
+    """
+
+    if priors is None:
+        priors = [[1] * len(unique_ballots) for _ in sample_tallies]
+    remaining = candidates_of(unique_ballots)
+    pruned = []
+    # stage_epsilon covers at most len(remaining) - 1 stages; within a
+    # stage, at most 2 * len(remaining) bounds are computed.
+    stage_epsilon = epsilon / max(1, len(remaining) - 1)
+    while len(remaining) > 1:
+        bound_epsilon = stage_epsilon / (2 * len(remaining))
+        eliminated = set(pruned)
+        bounds = {name: _group_bounds(unique_ballots, sample_tallies, priors,
+                                      total_num_votes, eliminated, {name},
+                                      bound_epsilon)
+                  for name in remaining}
+        order = sorted(remaining,
+                       key=lambda name: (sum(bounds[name]), name))
+        best = 0
+        for k in range(1, len(order)):
+            group = set(order[:k])
+            _, group_high = _group_bounds(unique_ballots, sample_tallies,
+                                          priors, total_num_votes,
+                                          eliminated, group, bound_epsilon)
+            if group_high < min(bounds[name][0] for name in order[k:]):
+                best = k
+        if best == 0:
+            break
+        pruned.extend(order[:best])
+        remaining = order[best:]
+    return pruned
+
+
+def merge_ballot_types(unique_ballots, sample_tallies, priors, projection):
+    """
+    Merge ballot types that have the same image under projection.
+
+    Merging is exact for a Dirichlet posterior: the merged type's sample
+    count and prior pseudocount are the sums of those of the types merged.
+
+    Args:
+        unique_ballots (list): ballot types (tuples of choices)
+        sample_tallies (list): list (one per county) of lists of sample
+            counts, indexed like unique_ballots
+        priors (list): None or list of lists of pseudocounts, shaped like
+            sample_tallies; None means one for every ballot type
+        projection (function): maps a ballot type to its merged type
+
+    Returns:
+        (new_unique_ballots, new_sample_tallies, new_priors), in the same
+        formats, with the merged types in order of first appearance.
+
+    Example:
+        >>> merge_ballot_types([('a', 'b'), ('b',), ('a',)], [[1, 2, 3]],
+        ...                    None, lambda ballot: ballot[:1])
+        ([('a',), ('b',)], [[4, 2]], [[2, 1]])
+    """
+
+    if priors is None:
+        priors = [[1] * len(unique_ballots) for _ in sample_tallies]
+    index = {}
+    new_unique_ballots = []
+    type_map = []
+    for ballot in unique_ballots:
+        projected = projection(ballot)
+        if projected not in index:
+            index[projected] = len(new_unique_ballots)
+            new_unique_ballots.append(projected)
+        type_map.append(index[projected])
+    new_sample_tallies = []
+    new_priors = []
+    for sample_tally, prior in zip(sample_tallies, priors):
+        new_sample_tally = [0] * len(new_unique_ballots)
+        new_prior = [0] * len(new_unique_ballots)
+        for j, k in enumerate(type_map):
+            new_sample_tally[k] += sample_tally[j]
+            new_prior[k] += prior[j]
+        new_sample_tallies.append(new_sample_tally)
+        new_priors.append(new_prior)
+    return new_unique_ballots, new_sample_tallies, new_priors
+
+
+def prune_ballot_types(unique_ballots, sample_tallies, total_num_votes,
+                       epsilon=1e-4, priors=None):
+    """
+    Prune hopeless candidates (see prune_hopeless_candidates), delete them
+    from every ballot type, and merge the types that become identical.
+
+    Args:
+        as for prune_hopeless_candidates
+
+    Returns:
+        (new_unique_ballots, new_sample_tallies, new_priors, pruned)
+        where the first three are as for merge_ballot_types and pruned
+        is the list of pruned candidates.
+    """
+
+    pruned = prune_hopeless_candidates(unique_ballots, sample_tallies,
+                                       total_num_votes, epsilon, priors)
+    eliminated = set(pruned)
+    new_unique_ballots, new_sample_tallies, new_priors = \
+        merge_ballot_types(unique_ballots, sample_tallies, priors,
+                           lambda ballot: project_ballot(ballot, eliminated))
+    return new_unique_ballots, new_sample_tallies, new_priors, pruned
+
+
+def reduce_ballot_types(unique_ballots, sample_tallies, total_num_votes,
+                        epsilon=None, priors=None):
+    """
+    Replace every ballot type by its reduce_ballot projection and merge
+    the types that become identical.
+
+    If epsilon is given, hopeless candidates are pruned first (see
+    prune_hopeless_candidates), and only the remaining candidates are
+    counted as possible winners.  With epsilon None nothing is pruned and
+    the reduction does not change the distribution of outcomes at all.
+
+    Args:
+        as for prune_hopeless_candidates, except that epsilon may be None
+
+    Returns:
+        (new_unique_ballots, new_sample_tallies, new_priors, pruned)
+        as for prune_ballot_types.
+
+    Example:
+        >>> reduce_ballot_types([('a', 'b'), ('a',), ('b', 'a')], [[1, 2, 3]],
+        ...                     [100])
+        ([('a',), ('b',)], [[3, 3]], [[2, 1]], [])
+    """
+
+    if epsilon is None:
+        pruned = []
+    else:
+        pruned = prune_hopeless_candidates(unique_ballots, sample_tallies,
+                                           total_num_votes, epsilon, priors)
+    eliminated = set(pruned)
+    possible_winners = set(candidates_of(unique_ballots)) - eliminated
+    new_unique_ballots, new_sample_tallies, new_priors = \
+        merge_ballot_types(unique_ballots, sample_tallies, priors,
+                           lambda ballot: reduce_ballot(ballot, eliminated,
+                                                        possible_winners))
+    return new_unique_ballots, new_sample_tallies, new_priors, pruned
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
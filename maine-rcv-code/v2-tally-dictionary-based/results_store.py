@@ -0,0 +1,212 @@
+# results_store.py
+# python3
+
+"""
+An append-only store of the results of simulated audits.
+
+audit_me.audit keeps every row in memory and rewrites the whole CSV file
+every few seeds: quadratic I/O, and a crash loses the rows since the
+last rewrite.  A ResultsStore is an SQLite database (in WAL mode, so
+readers, e.g. a notebook, do not block the writer) with one row per
+cell, keyed and indexed by
+
+    (seed, sample_size, method, params),
+
+where params is the canonical JSON of the cell's other parameters
+(number of trials, risk limit, voting method, ...; see cell_params).
+Rows are only ever inserted, each once; a checkpoint costs time
+proportional to the new rows.  On restart, done_cells tells a sweep
+which cells it can skip.
+
+Example:
+    with ResultsStore("audit_simulations.sqlite") as store:
+        params = cell_params(1000, voting_method="rcv_wrapper")
+        done = store.done_cells("polling", params)
+        ...
+        store.add_rows(rows, "polling", params)
+        store.to_csv("audit_simulations_vs_2.csv")
+"""
+
+import json
+import sqlite3
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS cells (
+    seed INTEGER NOT NULL,
+    sample_size INTEGER NOT NULL,
+    method TEXT NOT NULL,
+    params TEXT NOT NULL,
+    time_delta REAL,
+    data TEXT NOT NULL,
+    PRIMARY KEY (seed, sample_size, method, params)
+);
+CREATE INDEX IF NOT EXISTS cells_by_method
+    ON cells (method, params, seed, sample_size);
+"""
+
+# Keys of a row that are stored in their own columns; the rest of the
+# row goes into data, as JSON.
+_KEY_COLUMNS = ("seed", "sample_size", "method", "params", "time_delta")
+
+
+def canonical_params(params):
+    """
+    Return the canonical JSON text of the dict params (sorted keys, no
+    spaces), as stored in the params column.
+
+    Example:
+        >>> canonical_params({"risk_limit": 0.05, "num_trials": 1000})
+        '{"num_trials":1000,"risk_limit":0.05}'
+    """
+
+    return json.dumps(params or {}, sort_keys=True, separators=(",", ":"))
+
+
+def cell_params(num_trials, risk_limit=None, voting_method=None,
+                vote_for_n=1, prune_epsilon=None, merge_types=False):
+    """
+    Return the params of a cell, as a dict with every setting, besides
+    the seed, the sample size and the method, that affects its result.
+    All of them are always included, so that runs with the same settings
+    share cells whichever function made them.  voting_method is a label
+    naming the voting method (e.g. "rcv_wrapper" or "IRVModel"), stored
+    as given: a function's qualified name would depend on whether its
+    module was run as a script ("__main__") or imported, so it is not
+    accepted (ValueError).
+
+    Example:
+        >>> params = cell_params(1000, None, "IRVModel")
+        >>> sorted(params)  # doctest: +NORMALIZE_WHITESPACE
+        ['merge_types', 'num_trials', 'prune_epsilon', 'risk_limit',
+         'vote_for_n', 'voting_method']
+        >>> params["voting_method"]
+        'IRVModel'
+    """
+
+    if voting_method is not None and not isinstance(voting_method, str):
+        raise ValueError("cell_params: voting_method must be a label (str), "
+                         "not {!r}.".format(voting_method))
+    return {"num_trials": num_trials,
+            "risk_limit": risk_limit,
+            "voting_method": voting_method,
+            "vote_for_n": vote_for_n,
+            "prune_epsilon": prune_epsilon,
+            "merge_types": merge_types}
+
+
+class ResultsStore:
+    """
+    Append-only SQLite store of audit-simulation rows; see the module
+    docstring.
+
+    Args:
+        path (str): the database file (created if need be), or
+            ":memory:"
+
+    A row is a dict like those of audit_me.audit and audit_sweep, with
+    "seed" and "sample_size", optionally "time_delta", and any other
+    JSON-serializable entries (the win probability of each candidate,
+    "num_trials", "ci_low", ...).
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.executescript(_SCHEMA)
+        self.connection.commit()
+
+    def add_rows(self, rows, method, params=None):
+        """
+        Insert the rows of cells computed by method with params, in one
+        transaction, and return the number of rows that were new (a cell
+        already stored is left as it is).
+        """
+
+        params = canonical_params(params)
+        records = []
+        for row in rows:
+            data = {key: value for key, value in row.items()
+                    if key not in _KEY_COLUMNS}
+            records.append((int(row["seed"]), int(row["sample_size"]),
+                            method, params, row.get("time_delta"),
+                            json.dumps(data)))
+        with self.connection:
+            before = self.connection.total_changes
+            self.connection.executemany(
+                "INSERT OR IGNORE INTO cells VALUES (?, ?, ?, ?, ?, ?)",
+                records)
+            return self.connection.total_changes - before
+
+    def done_cells(self, method, params=None):
+        """
+        Return the set of (seed, sample_size) cells stored for method
+        with params.
+        """
+
+        cursor = self.connection.execute(
+            "SELECT seed, sample_size FROM cells WHERE method = ? "
+            "AND params = ?", (method, canonical_params(params)))
+        return set(cursor.fetchall())
+
+    def rows(self, method=None, params=None):
+        """
+        Return the stored rows (of method with params, if given), as
+        dicts shaped like the rows added, with "method" and "params"
+        (a dict) included, ordered by seed and sample size.
+        """
+
+        query = "SELECT * FROM cells"
+        conditions = []
+        values = []
+        if method is not None:
+            conditions.append("method = ?")
+            values.append(method)
+        if params is not None:
+            conditions.append("params = ?")
+            values.append(canonical_params(params))
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        query += " ORDER BY method, params, seed, sample_size"
+        rows = []
+        for (seed, sample_size, row_method, row_params, time_delta,
+             data) in self.connection.execute(query, values):
+            row = json.loads(data)
+            row.update({"seed": seed, "sample_size": sample_size,
+                        "time_delta": time_delta, "method": row_method,
+                        "params": json.loads(row_params)})
+            rows.append(row)
+        return rows
+
+    def to_csv(self, path, method=None, params=None):
+        """
+        Write the stored rows (of method with params, if given) to the
+        CSV file path, in the layout of audit_me.audit's output.  Needs
+        pandas.
+        """
+
+        import pandas as pd
+
+        df = pd.DataFrame([{key: value for key, value in row.items()
+                            if key not in ("method", "params")}
+                           for row in self.rows(method, params)])
+        df.to_csv(path)
+
+    def close(self):
+        """
+        Close the database.
+        """
+
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
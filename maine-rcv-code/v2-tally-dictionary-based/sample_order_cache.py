@@ -0,0 +1,121 @@
+# sample_order_cache.py
+# python3
+
+"""
+An on-disk cache of the sample orders of consistent_sampler.
+
+audit_me draws each seed's sample order with
+    sampler(range(n), with_replacement=False, output='id', seed=seed),
+which computes a SHA-256 ticket number, as a decimal string, for every
+one of the n ballots and then heap-sorts them: seconds per seed, every
+run, though the order depends only on the population and the seed.
+
+A SampleOrderCache keeps each order in a .npy file of uint32 positions
+in the population, named by a fingerprint of the population and a hash
+of the seed.  Both are taken of the string forms of the ids and the
+seed, which are all that consistent_sampler looks at: seeds 1 and "1"
+give the same order, and share a file.  Only the longest prefix ever
+requested is kept: a request for a longer one recomputes it (drawing
+just that many tickets) and replaces the file.  Files are loaded
+memory-mapped, read-only, so a sweep or notebook rereading them costs
+next to nothing.
+
+Example:
+    cache = SampleOrderCache(".sample_order_cache")
+    order = cache.get(range(n), seed, 3000)     # first 3000 positions
+"""
+
+import hashlib
+import os
+import tempfile
+
+import numpy as np
+
+from consistent_sampler import sampler
+
+DEFAULT_DIRECTORY = ".sample_order_cache"
+
+
+def population_fingerprint(id_list):
+    """
+    Return a short hex digest identifying the population id_list (the
+    string forms of its ids, in order).  A range is identified by its
+    bounds, without listing it.
+
+    Example:
+        >>> fingerprint = population_fingerprint(range(5))
+        >>> fingerprint == population_fingerprint(range(5))
+        True
+        >>> fingerprint == population_fingerprint(range(6))
+        False
+    """
+
+    digest = hashlib.sha256()
+    if isinstance(id_list, range):
+        digest.update("range({},{},{})".format(
+            id_list.start, id_list.stop, id_list.step).encode("utf-8"))
+    else:
+        for id in id_list:
+            digest.update(str(id).encode("utf-8"))
+            digest.update(b"\n")
+    return digest.hexdigest()[:16]
+
+
+class SampleOrderCache:
+    """
+    Sample orders (without replacement) of populations, by seed, stored
+    in directory; see the module docstring.
+    """
+
+    def __init__(self, directory=DEFAULT_DIRECTORY):
+        self.directory = directory
+
+    def path(self, fingerprint, seed):
+        """
+        Return the path of the file for the population with the given
+        fingerprint and seed.
+        """
+
+        seed_hash = hashlib.sha256(str(seed).encode("utf-8")).hexdigest()
+        return os.path.join(self.directory,
+                            "{}-{}.npy".format(fingerprint, seed_hash[:16]))
+
+    def get(self, id_list, seed, length=None):
+        """
+        Return the positions in id_list of its first length ids (all of
+        them if length is None) in the sample order of seed, as a
+        read-only uint32 array (memory-mapped from the cache file).
+        """
+
+        num_ids = len(id_list)
+        length = num_ids if length is None else min(length, num_ids)
+        path = self.path(population_fingerprint(id_list), seed)
+        if os.path.exists(path):
+            order = np.load(path, mmap_mode="r")
+            if len(order) >= length:
+                return order[:length]
+
+        if isinstance(id_list, range) and id_list == range(num_ids):
+            position = None
+        else:
+            position = {id: i for i, id in enumerate(id_list)}
+        ids = sampler(id_list, seed=seed, with_replacement=False,
+                      take=length, output='id')
+        order = np.fromiter(ids if position is None
+                            else (position[id] for id in ids),
+                            dtype=np.uint32, count=length)
+
+        # write a temporary file and rename it, so readers never see a
+        # partial file
+        os.makedirs(self.directory, exist_ok=True)
+        handle, temporary = tempfile.mkstemp(suffix=".npy",
+                                             dir=self.directory)
+        with os.fdopen(handle, "wb") as f:
+            np.save(f, order)
+        os.replace(temporary, path)
+        return np.load(path, mmap_mode="r")
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
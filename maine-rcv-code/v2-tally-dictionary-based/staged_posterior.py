@@ -0,0 +1,194 @@
+# staged_posterior.py
+# python3
+
+"""
+Posterior simulation carried forward across the stages of an audit.
+
+audit_me.audit evaluates sample sizes 100, 200, ..., 3000 for each seed,
+and bptool draws a fresh posterior for every one of them.  But the
+Dirichlet posterior is simulated by normalizing independent gamma
+variates, and Gamma(a) + Gamma(b) ~ Gamma(a + b) for independent
+summands.  So when the sample grows by d ballots of some type, each
+trial's gamma variate for that type can be carried forward by adding a
+Gamma(d) variate, instead of being redrawn from scratch.  A type seen for
+the first time gets a Gamma(1 + count) variate, as it would in a fresh
+simulation with the usual +1 prior.
+
+At every stage the trials therefore have exactly the same distribution
+as a fresh simulation, but only the increments are drawn, and the
+estimates at successive stages are positively correlated, which makes
+the curves of win probability against sample size much smoother.
+
+The multinomial step for the unsampled ballots is redrawn at every
+stage, since the number of unsampled ballots changes.  The simulation is
+for a single county (as in audit_me).  Each stage draws its gamma
+increments from the stream
+    SeedSequence(seed, spawn_key=(bptool.STAGE_SPAWN_KEY, stage, 0))
+and its multinomial step from
+    SeedSequence(seed, spawn_key=(bptool.STAGE_SPAWN_KEY, stage, 1)),
+afresh on each call, so the results of a stage do not depend on how
+often they are asked for, and rerunning the stages reproduces them.
+
+Example:
+    staged = StagedPosterior(n, num_trials=1000, seed=1)
+    for sample_size in range(100, 3001, 100):
+        staged.add_ballots(sample_tally_for(sample_size))
+        win_probs = staged.win_probs(real_names, audit_me.rcv_wrapper)
+"""
+
+import numpy as np
+
+import bptool
+import rcv_certificate
+import voting_models
+
+
+class StagedPosterior:
+    """
+    Per-trial gamma state of a Bayesian audit, updated incrementally as
+    sampled ballots are added; see the module docstring.
+    """
+
+    def __init__(self, total_num_votes, num_trials, seed,
+                 pseudocount_for_prior=1):
+        """
+        Args:
+            total_num_votes (int): number of ballots cast in the contest
+            num_trials (int): number of trials carried from stage to stage
+            seed (int): seed of the whole simulation, or None
+            pseudocount_for_prior (float): prior pseudocount of each
+                ballot type seen in the sample
+        """
+
+        self.total_num_votes = total_num_votes
+        self.num_trials = num_trials
+        self.seed = bptool.resolve_seed(seed)
+        self.pseudocount_for_prior = pseudocount_for_prior
+        self.unique_ballots = []
+        self.type_index = {}
+        self.counts = np.zeros(0, dtype=np.int64)
+        self.gammas = np.zeros((num_trials, 0))
+        self.stage = 0
+
+    def _stage_rng(self, step):
+        seed_seq = np.random.SeedSequence(
+            self.seed, spawn_key=(bptool.STAGE_SPAWN_KEY, self.stage, step))
+        return np.random.Generator(np.random.PCG64(seed_seq))
+
+    def add_ballots(self, sample_tally):
+        """
+        Move to the next stage, whose sample tally is sample_tally.
+
+        Args:
+            sample_tally (dict): maps each ballot type in the sample so
+                far to its count; counts may only grow from one stage to
+                the next, and types never disappear
+
+        Returns:
+            None
+        """
+
+        self.stage += 1
+        rng = self._stage_rng(0)
+        new_ballots = [ballot for ballot in sample_tally
+                       if ballot not in self.type_index]
+        for ballot in new_ballots:
+            self.type_index[ballot] = len(self.unique_ballots)
+            self.unique_ballots.append(ballot)
+        old_counts = np.concatenate(
+            [self.counts, np.zeros(len(new_ballots), dtype=np.int64)])
+        new_counts = np.zeros(len(self.unique_ballots), dtype=np.int64)
+        for ballot, count in sample_tally.items():
+            new_counts[self.type_index[ballot]] = count
+        increments = new_counts - old_counts
+        if np.any(increments < 0):
+            raise ValueError("add_ballots: sample counts may not decrease.")
+
+        # Types seen before get Gamma(increment); new types get
+        # Gamma(prior + count), i.e. their first variate.
+        shapes = increments.astype(float)
+        shapes[len(self.counts):] += self.pseudocount_for_prior
+        gammas = np.zeros((self.num_trials, len(self.unique_ballots)))
+        gammas[:, :len(self.counts)] = self.gammas
+        grown = shapes > 0
+        gammas[:, grown] += rng.gamma(shapes[grown],
+                                      size=(self.num_trials, grown.sum()))
+        self.gammas = gammas
+        self.counts = new_counts
+
+    def final_tallies(self, approx=None):
+        """
+        Return array (num_trials x number of types) of simulated final
+        tallies, the sample counts plus simulated unsampled ballots.
+
+        Args:
+            approx: None for an exact multinomial, or "scaled" to use the
+                Dirichlet proportions times the nonsample size (see
+                bptool.dirichlet_multinomial)
+        """
+
+        if self.stage == 0:
+            raise ValueError("final_tallies: no ballots added yet.")
+        proportions = self.gammas / self.gammas.sum(axis=1, keepdims=True)
+        nonsample_size = self.total_num_votes - int(self.counts.sum())
+        if nonsample_size < 0:
+            raise ValueError("total_num_votes {} less than sample_size {}."
+                             .format(self.total_num_votes,
+                                     int(self.counts.sum())))
+        if approx is None:
+            nonsample = self._stage_rng(1).multinomial(nonsample_size,
+                                                       proportions)
+        elif approx == "scaled":
+            nonsample = nonsample_size * proportions
+        else:
+            raise ValueError("final_tallies: unknown approx {}."
+                             .format(approx))
+        return self.counts + nonsample
+
+    def win_probs(self, real_names, voting_method, vote_for_n=1,
+                  use_certificate=True, approx=None):
+        """
+        Return the estimated win probabilities at the current stage.
+
+        Args:
+            real_names (list): candidate names
+            voting_method: as for bptool.compute_win_probs_rcv, e.g.
+                audit_me.rcv_wrapper or voting_models.IRVModel
+            vote_for_n (int): number of winners
+            use_certificate (bool): if True, only trials violating the
+                certificate of the sample's elimination order are
+                tabulated by voting_method (see rcv_certificate); ignored
+                unless bptool.certificate_is_exact(voting_method)
+            approx: as for final_tallies
+
+        Returns:
+            (list): pairs (i, p), with p the fraction of trials won by
+                real_names[i]
+        """
+
+        final_tallies = self.final_tallies(approx)
+        model = voting_models.as_model(voting_method, self.unique_ballots,
+                                       vote_for_n)
+        use_certificate = use_certificate \
+            and bptool.certificate_is_exact(voting_method, vote_for_n)
+        if use_certificate:
+            certificate = rcv_certificate.build_certificate(
+                self.unique_ballots, self.counts.tolist())
+            certified = certificate.holds(final_tallies)
+        else:
+            certified = np.zeros(self.num_trials, dtype=bool)
+        win_count = {name: 0 for name in real_names}
+        if use_certificate:
+            win_count[certificate.winner] += int(certified.sum())
+        if model is not None:
+            if not certified.all():
+                bptool.add_model_wins(win_count, model,
+                                      model.winners(final_tallies[~certified]))
+        else:
+            for final_tally in final_tallies[~certified]:
+                final_tally = list(enumerate(final_tally.tolist()))
+                winner = voting_method(self.unique_ballots, final_tally,
+                                       vote_for_n)
+                win_count[winner] = win_count.get(winner, 0) + 1
+        return [(i, win_count[name] / float(self.num_trials))
+                for i, name in enumerate(real_names)]
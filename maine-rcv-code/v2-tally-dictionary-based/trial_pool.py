@@ -0,0 +1,260 @@
+# trial_pool.py
+# python3
+
+"""
+A long-lived pool of worker processes for the RCV trials of one election.
+
+bptool.run_trials starts a fresh process pool for every call, and pickles
+the ballot types and voting method to each worker again.  The audit_me
+sweep makes some 30,000 calls (seeds times sample sizes) against the same
+election, so that start-up is paid 30,000 times.  A TrialPool is instead
+created once per election:
+
+  - the election's ballot types are compiled once into an
+    voting_models.IRVModel, whose rank matrix is put in a
+    multiprocessing.shared_memory block that every worker maps (and the
+    ballot types themselves are sent to each worker once, at start-up);
+  - set_sample_order puts the ballot type of each ballot, in sampling
+    order, in a second shared block, once per seed;
+  - each call then sends the workers only a sample size (or a count
+    vector over the ballot types), the seed and their ranges of trials.
+
+Every worker tallies the sample prefix itself, restricts the shared model
+to the ballot types present in the sample, and runs its trials with
+bptool.count_wins, certificate included (see rcv_certificate).  Trial i
+draws from bptool.create_trial_rng(seed, i) as always, so the counts are
+exactly those of bptool.run_trials on the sample's ballot types, in the
+order of the election's types, without type merging, and do not depend
+on the number of workers.
+
+Example:
+    with TrialPool(unique_ballots, n, workers=4) as pool:
+        for seed in seeds:
+            pool.set_sample_order(type_indices_in_sample_order(seed))
+            for sample_size in range(100, 3001, 100):
+                win_probs = pool.compute_win_probs_rcv(
+                    n, seed, 1000, real_names, sample_size=sample_size)
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+
+import bptool
+import rcv_certificate
+import voting_models
+
+
+def _create_shared_array(array):
+    """
+    Return (block, view): a new shared memory block holding a copy of
+    array, and an array viewing it.
+    """
+
+    block = shared_memory.SharedMemory(create=True,
+                                       size=max(1, array.nbytes))
+    view = np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)
+    view[...] = array
+    return block, view
+
+
+def _attach_shared_array(name, shape, dtype):
+    """
+    Return (block, view) for the existing shared memory block name.
+    """
+
+    block = shared_memory.SharedMemory(name=name)
+    return block, np.ndarray(shape, dtype=dtype, buffer=block.buf)
+
+
+# Per-process state of a pool worker, set up by _init_pool_worker.
+_pool_state = None
+
+
+def _init_pool_worker(unique_ballots, rank_spec, order_spec, outcomes,
+                      tie_order, vote_for_n, use_certificate):
+    global _pool_state
+    rank_block, rank = _attach_shared_array(*rank_spec)
+    order_block, order = _attach_shared_array(*order_spec)
+    _pool_state = {
+        "blocks": (rank_block, order_block),
+        "model": voting_models.IRVModel.from_arrays(
+            unique_ballots, rank, outcomes, tie_order, vote_for_n),
+        "order": order,
+        "use_certificate": use_certificate,
+        "call": None,
+    }
+
+
+def _prepare_call(call_id, sample_size, counts):
+    """
+    Return (types, counts, model, certificate) for call call_id in this
+    worker: the ballot types present in the sample, their counts, and the
+    model and certificate restricted to them.  They are computed by the
+    first shard of the call that reaches the worker, and reused by the
+    rest.
+    """
+
+    state = _pool_state
+    if state["call"] is not None and state["call"][0] == call_id:
+        return state["call"][1]
+    model = state["model"]
+    if counts is None:
+        counts = np.bincount(state["order"][:sample_size],
+                             minlength=len(model.candidate_names))
+    types = np.flatnonzero(counts)
+    sample_model = model.restrict(types)
+    sample_counts = counts[types].tolist()
+    certificate = None
+    if state["use_certificate"]:
+        certificate = rcv_certificate.build_certificate(
+            sample_model.candidate_names, sample_counts)
+    prepared = (types, sample_counts, sample_model, certificate)
+    state["call"] = (call_id, prepared)
+    return prepared
+
+
+def _count_wins_in_pool(call_id, sample_size, counts, total_num_votes, seed,
+                        first_trial, last_trial, approx):
+    _, sample_counts, model, certificate = \
+        _prepare_call(call_id, sample_size, counts)
+    return bptool.count_wins([sample_counts], [total_num_votes],
+                             model.vote_for_n, seed, model.candidate_names,
+                             model, first_trial, last_trial, approx=approx,
+                             certificate=certificate)
+
+
+class TrialPool:
+    """
+    Worker processes, and shared memory, for the trials of one RCV
+    election (a single county); see the module docstring.
+
+    Args:
+        unique_ballots (list): all the ballot types of the election; the
+            count vectors and sample orders given to the pool index it
+        sample_capacity (int): the largest number of ballots in a sample
+            order (usually the number of ballots in the election)
+        workers (int): number of worker processes
+        vote_for_n (int): number of winners
+        tie_breaker (list): as for rcv.rcv_winner (None for empty)
+        use_certificate (bool): whether trials following the sample's
+            elimination order are decided by a certificate, as in
+            bptool.compute_win_probs_rcv
+
+    The pool should be closed when done with, to stop the workers and
+    free the shared memory; it is a context manager that does so.
+    """
+
+    def __init__(self, unique_ballots, sample_capacity, workers,
+                 vote_for_n=1, tie_breaker=None, use_certificate=True):
+        self.unique_ballots = list(unique_ballots)
+        self.model = voting_models.IRVModel(self.unique_ballots, vote_for_n,
+                                            tie_breaker)
+        self.workers = workers
+        self._rank_block, _ = _create_shared_array(self.model.rank)
+        self._order_block, self._order = _create_shared_array(
+            np.zeros(sample_capacity, dtype=np.uint32))
+        self._num_calls = 0
+        self._executor = ProcessPoolExecutor(
+            max_workers=workers, initializer=_init_pool_worker,
+            initargs=(self.unique_ballots,
+                      (self._rank_block.name, self.model.rank.shape,
+                       self.model.rank.dtype),
+                      (self._order_block.name, self._order.shape,
+                       self._order.dtype),
+                      self.model.outcomes, self.model.tie_order, vote_for_n,
+                      use_certificate and bptool.certificate_is_exact(
+                          self.model, vote_for_n)))
+
+    def set_sample_order(self, type_indices):
+        """
+        Store the sampling order of the ballots, as the index into
+        unique_ballots of each ballot's type, in sampling order.  Calls
+        given a sample_size then use its first sample_size entries.
+        """
+
+        type_indices = np.asarray(type_indices)
+        if len(type_indices) > len(self._order):
+            raise ValueError("set_sample_order: {} ballots, but capacity is {}."
+                             .format(len(type_indices), len(self._order)))
+        self._order[:len(type_indices)] = type_indices
+
+    def sample_counts(self, sample_size):
+        """
+        Return the count vector (over unique_ballots) of the first
+        sample_size ballots of the sample order.
+        """
+
+        return np.bincount(self._order[:sample_size],
+                           minlength=len(self.unique_ballots))
+
+    def count_wins(self, total_num_votes, seed, num_trials, sample_size=None,
+                   counts=None, approx=None):
+        """
+        Run trials 0, ..., num_trials-1 for one sample, and return the
+        combined win counts, as bptool.run_trials does.
+
+        Args:
+            total_num_votes (int): number of ballots in the election
+            seed (int): seed of the simulation (see bptool.resolve_seed)
+            num_trials (int): number of trials
+            sample_size (int): the sample is this prefix of the sample
+                order (see set_sample_order)
+            counts (list): or else, the sample's count vector over
+                unique_ballots
+            approx: as for bptool.dirichlet_multinomial
+
+        Returns:
+            (dict): maps each winning name to its number of wins
+        """
+
+        if (sample_size is None) == (counts is None):
+            raise ValueError("count_wins: give one of sample_size and counts.")
+        if counts is not None:
+            counts = np.asarray(counts, dtype=np.int64)
+        self._num_calls += 1
+        shards = bptool.split_trials(num_trials, 4 * self.workers)
+        futures = [self._executor.submit(_count_wins_in_pool, self._num_calls,
+                                         sample_size, counts, total_num_votes,
+                                         seed, first, last, approx)
+                   for first, last in shards]
+        win_count = {}
+        for future in futures:
+            for winner, count in future.result().items():
+                win_count[winner] = win_count.get(winner, 0) + count
+        return win_count
+
+    def compute_win_probs_rcv(self, total_num_votes, seed, num_trials,
+                              real_names, sample_size=None, counts=None,
+                              approx=None):
+        """
+        Return win_probs, pairs (i, p) for the candidates real_names, as
+        bptool.compute_win_probs_rcv does, from count_wins.
+        """
+
+        seed = bptool.resolve_seed(seed)
+        win_count = self.count_wins(total_num_votes, seed, num_trials,
+                                    sample_size, counts, approx)
+        return [(i, win_count.get(name, 0) / float(num_trials))
+                for i, name in enumerate(real_names)]
+
+    def close(self):
+        """
+        Stop the workers and free the shared memory.
+        """
+
+        if self._executor is None:
+            return
+        self._executor.shutdown()
+        self._executor = None
+        self._order = None
+        for block in (self._rank_block, self._order_block):
+            block.close()
+            block.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,338 @@
+# trial_stats.py
+# python3
+
+"""
+Streaming statistics of the outcomes of simulated RCV trials.
+
+bptool.compute_win_probs_rcv keeps only how often each candidate wins.
+Given a TrialStats, it also feeds every trial's IRV tabulation (see
+voting_models.IRVModel.tabulate) into bounded-memory accumulators:
+
+    QuantileSketch: quantiles of a nonnegative quantity, to within a
+        given relative accuracy, from logarithmically spaced buckets;
+    Histogram: counts of small integer values;
+    FrequencyTable: counts of the most frequent keys, with the rest
+        lumped together.
+
+TrialStats collects the final-round margin and the exhausted votes
+(sketches), the round in which each candidate was eliminated (one
+histogram per candidate) and the elimination order (a frequency table).
+Memory does not grow with the number of trials, and all of these can be
+merged (exactly, unless a frequency table overflows), so each worker can
+fill its own and the results be combined.
+
+Example:
+    stats = trial_stats.TrialStats()
+    bptool.compute_win_probs_rcv(sample_tallies, [n], seed, 100000,
+                                 unique_ballots, real_names, 1,
+                                 voting_models.IRVModel, stats=stats)
+    stats.summary()
+"""
+
+import math
+
+import numpy as np
+
+
+class QuantileSketch:
+    """
+    Mergeable sketch of the distribution of nonnegative values.
+
+    A value x >= min_value is counted in bucket ceil(log(x) / log(g)),
+    with g = (1 + relative_accuracy) / (1 - relative_accuracy), and
+    estimated by the bucket's midpoint 2 g**i / (g + 1), which is within
+    relative_accuracy of every value in the bucket; smaller values are
+    counted as zero.  So quantile(q) is within relative_accuracy of the
+    true q-quantile.  Values from 1 to 10**6 take at most 691 buckets at
+    the default 1% accuracy; if more than max_buckets are ever needed,
+    the lowest ones are merged, losing accuracy only at the low end.
+
+    Example:
+        >>> sketch = QuantileSketch()
+        >>> sketch.add(np.arange(1001))
+        >>> sketch.count, abs(sketch.quantile(0.5) - 500) <= 5
+        (1001, True)
+    """
+
+    def __init__(self, relative_accuracy=0.01, min_value=1e-9,
+                 max_buckets=2048):
+        self.relative_accuracy = relative_accuracy
+        self.min_value = min_value
+        self.max_buckets = max_buckets
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.buckets = {}
+        self.zero_count = 0
+        self.count = 0
+
+    def empty(self):
+        """
+        Return an empty sketch with the same parameters.
+        """
+
+        return QuantileSketch(self.relative_accuracy, self.min_value,
+                              self.max_buckets)
+
+    def add(self, values):
+        """
+        Count the values (a number or an array of them).
+        """
+
+        values = np.atleast_1d(np.asarray(values, dtype=float))
+        if (values < 0).any():
+            raise ValueError("QuantileSketch: negative value.")
+        positive = values[values >= self.min_value]
+        self.zero_count += len(values) - len(positive)
+        self.count += len(values)
+        indices, counts = np.unique(
+            np.ceil(np.log(positive) / math.log(self.gamma)).astype(np.int64),
+            return_counts=True)
+        for index, count in zip(indices.tolist(), counts.tolist()):
+            self.buckets[index] = self.buckets.get(index, 0) + count
+        self._collapse()
+
+    def merge(self, other):
+        """
+        Add the counts of other, a sketch with the same parameters.
+        """
+
+        for index, count in other.buckets.items():
+            self.buckets[index] = self.buckets.get(index, 0) + count
+        self.zero_count += other.zero_count
+        self.count += other.count
+        self._collapse()
+
+    def _collapse(self):
+        if len(self.buckets) <= self.max_buckets:
+            return
+        indices = sorted(self.buckets)
+        excess = indices[:len(indices) - self.max_buckets + 1]
+        self.buckets[excess[-1]] += sum(self.buckets.pop(index)
+                                        for index in excess[:-1])
+
+    def quantile(self, q):
+        """
+        Return the estimated q-quantile (0 <= q <= 1), or nan if no values
+        have been added.
+        """
+
+        if self.count == 0:
+            return math.nan
+        rank = q * (self.count - 1)
+        seen = self.zero_count
+        if rank < seen:
+            return 0.0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if rank < seen:
+                return 2 * self.gamma ** index / (self.gamma + 1)
+        return 2 * self.gamma ** max(self.buckets) / (self.gamma + 1)
+
+
+class Histogram:
+    """
+    Counts of the integer values 0, ..., num_bins-1 (larger values are
+    counted in the last bin).
+
+    Example:
+        >>> histogram = Histogram(3)
+        >>> histogram.add([0, 2, 2, 7])
+        >>> histogram.counts.tolist()
+        [1, 0, 3]
+    """
+
+    def __init__(self, num_bins):
+        self.counts = np.zeros(num_bins, dtype=np.int64)
+
+    def empty(self):
+        """
+        Return an empty histogram with the same bins.
+        """
+
+        return Histogram(len(self.counts))
+
+    def add(self, values):
+        """
+        Count the values (an integer or an array of them).
+        """
+
+        values = np.minimum(np.atleast_1d(values), len(self.counts) - 1)
+        self.counts += np.bincount(values, minlength=len(self.counts))
+
+    def merge(self, other):
+        """
+        Add the counts of other, a histogram with the same bins.
+        """
+
+        self.counts += other.counts
+
+
+class FrequencyTable:
+    """
+    Counts of hashable keys, keeping at most max_entries of them.  When
+    the table would grow beyond that, the least frequent keys are dropped
+    and their counts added to other_count.  (With fewer than max_entries
+    distinct keys, e.g. the 120 elimination orders of five candidates,
+    all counts are exact.)
+
+    Example:
+        >>> table = FrequencyTable(2)
+        >>> table.add(['x', 'y', 'x', 'z', 'x', 'y'])
+        >>> table.most_common(), table.other_count
+        ([('x', 3), ('y', 2)], 1)
+    """
+
+    def __init__(self, max_entries=1000):
+        self.max_entries = max_entries
+        self.counts = {}
+        self.other_count = 0
+
+    def empty(self):
+        """
+        Return an empty table with the same max_entries.
+        """
+
+        return FrequencyTable(self.max_entries)
+
+    def add(self, keys, counts=None):
+        """
+        Count keys (a list), each once or the corresponding number of
+        times in counts.
+        """
+
+        if counts is None:
+            counts = [1] * len(keys)
+        for key, count in zip(keys, counts):
+            self.counts[key] = self.counts.get(key, 0) + count
+        self._trim()
+
+    def merge(self, other):
+        """
+        Add the counts of other.
+        """
+
+        self.add(list(other.counts), list(other.counts.values()))
+        self.other_count += other.other_count
+
+    def _trim(self):
+        if len(self.counts) <= self.max_entries:
+            return
+        for key, count in self.most_common()[self.max_entries:]:
+            del self.counts[key]
+            self.other_count += count
+
+    def most_common(self, n=None):
+        """
+        Return the n (default all) most frequent (key, count) pairs, most
+        frequent first.
+        """
+
+        pairs = sorted(self.counts.items(), key=lambda pair: -pair[1])
+        return pairs if n is None else pairs[:n]
+
+
+class TrialStats:
+    """
+    Outcome statistics of IRV trials; see the module docstring.
+
+    Attributes:
+        num_trials (int): number of trials added
+        margin (QuantileSketch): the final-round margin of each trial
+        exhausted (QuantileSketch): the exhausted votes of each trial
+        elimination_rounds (dict): maps each candidate name to a
+            Histogram of the round in which it was eliminated (bin 0 for
+            trials in which it was not)
+        elimination_orders (FrequencyTable): counts of the tuples of
+            candidate names in order of elimination, the winner last
+
+    (See voting_models.IRVModel.tabulate for the definitions.)
+
+    Example:
+        >>> import voting_models
+        >>> model = voting_models.IRVModel([('a', 'b'), ('b',), ('c', 'a')])
+        >>> stats = TrialStats()
+        >>> stats.add(model, model.tabulate([[4, 5, 2], [1, 5, 2]]))
+        >>> sorted(stats.elimination_orders.most_common())
+        [(('a', 'c', 'b'), 1), (('c', 'b', 'a'), 1)]
+    """
+
+    def __init__(self, relative_accuracy=0.01, max_rounds=32,
+                 max_orders=1000):
+        self.relative_accuracy = relative_accuracy
+        self.max_rounds = max_rounds
+        self.num_trials = 0
+        self.margin = QuantileSketch(relative_accuracy)
+        self.exhausted = QuantileSketch(relative_accuracy)
+        self.elimination_rounds = {}
+        self.elimination_orders = FrequencyTable(max_orders)
+
+    def empty(self):
+        """
+        Return empty TrialStats with the same parameters.
+        """
+
+        return TrialStats(self.relative_accuracy, self.max_rounds,
+                          self.elimination_orders.max_entries)
+
+    def add(self, model, outcome):
+        """
+        Add the trials tabulated by model, an IRVModel, as returned by
+        model.tabulate.
+        """
+
+        self.num_trials += len(outcome["winners"])
+        self.margin.add(outcome["margin"])
+        self.exhausted.add(outcome["exhausted"])
+        rounds = outcome["elimination_round"]
+        for c, name in enumerate(model.outcomes):
+            if name not in self.elimination_rounds:
+                self.elimination_rounds[name] = Histogram(self.max_rounds)
+            self.elimination_rounds[name].add(rounds[:, c])
+
+        # one key per distinct row of rounds, winner last
+        with_winner = rounds.copy()
+        with_winner[np.arange(len(rounds)), outcome["winners"]] = \
+            np.iinfo(np.int64).max
+        rows, counts = np.unique(with_winner, axis=0, return_counts=True)
+        orders = []
+        for row in rows:
+            order = sorted((r, c) for c, r in enumerate(row.tolist()) if r > 0)
+            orders.append(tuple(model.outcomes[c] for _, c in order))
+        self.elimination_orders.add(orders, counts.tolist())
+
+    def merge(self, other):
+        """
+        Add the trials of other, TrialStats with the same parameters.
+        """
+
+        self.num_trials += other.num_trials
+        self.margin.merge(other.margin)
+        self.exhausted.merge(other.exhausted)
+        for name, histogram in other.elimination_rounds.items():
+            if name not in self.elimination_rounds:
+                self.elimination_rounds[name] = histogram.empty()
+            self.elimination_rounds[name].merge(histogram)
+        self.elimination_orders.merge(other.elimination_orders)
+
+    def summary(self, quantiles=(0.05, 0.25, 0.5, 0.75, 0.95)):
+        """
+        Return a dict summarizing the trials: "num_trials"; "margin" and
+        "exhausted", each a dict mapping q to the estimated q-quantile;
+        "elimination_rounds", mapping each candidate to its list of
+        round counts; and "elimination_orders", the (order, count) pairs,
+        most frequent first.
+        """
+
+        return {
+            "num_trials": self.num_trials,
+            "margin": {q: self.margin.quantile(q) for q in quantiles},
+            "exhausted": {q: self.exhausted.quantile(q) for q in quantiles},
+            "elimination_rounds": {
+                name: histogram.counts.tolist()
+                for name, histogram in sorted(self.elimination_rounds.items())},
+            "elimination_orders": self.elimination_orders.most_common(),
+        }
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,350 @@
+# variance_reduction.py
+# python3
+
+"""
+Variance-reduced estimates of RCV win probabilities.
+
+bptool.compute_win_probs_rcv estimates each win probability p by plain
+Monte Carlo, whose standard error is sqrt(p (1-p) / T) for T trials.
+Getting a probability near a 5% risk limit to within +-0.5% that way
+takes thousands of trials per sample size.  This module offers three
+estimators that usually need fewer trials for the same precision:
+
+    "antithetic": trials come in pairs.  The Dirichlet step of the first
+        trial of a pair draws its gamma variates by inversion from
+        uniforms u, and the second from 1 - u, so a pair's two posterior
+        draws lie on opposite sides of the posterior mean.
+    "qmc": the uniforms are taken from a scrambled Sobol sequence instead
+        of a pseudorandom stream (randomized quasi-Monte Carlo).  The
+        trials are split into independently scrambled replicates, so
+        the variance can be estimated from the spread of the replicate
+        means.
+    "control": plain trials, with each candidate's share of the
+        first-round vote as a control variate.  Its posterior mean is
+        known exactly, so the linear regression of the win indicator on
+        the first-round shares can be subtracted out.
+
+("plain" gives the ordinary estimate, for comparison.)  In every case the
+multinomial step for the unsampled ballots is drawn from an ordinary
+pseudorandom stream; when the nonsample is much larger than the sample,
+the posterior (Dirichlet) step accounts for almost all of the variance.
+The uniforms and the pseudorandom stream are seeded by
+    SeedSequence(seed, spawn_key=(bptool.VARIANCE_REDUCTION_SPAWN_KEY, k))
+for k = 0 and 1, apart from bptool's per-trial streams.
+
+Each estimate comes with its standard error and its effective sample
+size, the number of plain Monte Carlo trials that would give the same
+variance, p (1-p) / standard_error**2.  A method is worthwhile where the
+effective sample size is larger than the number of trials actually run.
+
+The inversion used by "antithetic" and "qmc" needs scipy (for
+scipy.special.gammaincinv and scipy.stats.qmc.Sobol); "plain" and
+"control" need only numpy.
+
+Example:
+    win_probs, stats = compute_win_probs_rcv(sample_tallies, [n], seed,
+                                             1000, unique_ballots,
+                                             real_names, 1,
+                                             audit_me.rcv_wrapper,
+                                             method="qmc")
+    stats["effective_sample_size"]
+"""
+
+import math
+
+import numpy as np
+
+try:
+    import scipy.special
+    import scipy.stats.qmc
+except ImportError:
+    scipy = None
+
+import bptool
+import rcv_certificate
+import voting_models
+
+METHODS = ("plain", "antithetic", "qmc", "control")
+
+# Number of independently scrambled Sobol sequences for method "qmc".
+QMC_REPLICATES = 8
+
+# Uniforms are kept this far from 0 and 1 before inversion.
+_UNIFORM_EPSILON = 1e-12
+
+
+def posterior_parameters(sample_tallies, priors=None):
+    """
+    Return array (counties x types) of Dirichlet posterior parameters,
+    sample counts plus prior pseudocounts (one each if priors is None).
+    """
+
+    sample_tallies = np.asarray(sample_tallies, dtype=float)
+    if priors is None:
+        return sample_tallies + 1.0
+    return sample_tallies + np.asarray(priors, dtype=float)
+
+
+def _require_scipy(method):
+    if scipy is None:
+        raise ImportError("method {!r} needs scipy, which is not installed."
+                          .format(method))
+
+
+def trial_uniforms(method, num_trials, dimension, seed):
+    """
+    Return array (num_trials x dimension) of uniforms driving the
+    Dirichlet step, for method "antithetic" or "qmc".
+
+    For "antithetic", rows 2k and 2k+1 are u and 1 - u.  For "qmc", the
+    rows are QMC_REPLICATES consecutive blocks, each the first
+    num_trials / QMC_REPLICATES points of its own scrambled Sobol
+    sequence; num_trials must be QMC_REPLICATES times a power of two
+    (see round_num_trials).
+    """
+
+    seed_seq = np.random.SeedSequence(
+        seed, spawn_key=(bptool.VARIANCE_REDUCTION_SPAWN_KEY, 0))
+    if method == "antithetic":
+        rng = np.random.Generator(np.random.PCG64(seed_seq))
+        u = rng.random((num_trials // 2, dimension))
+        uniforms = np.empty((num_trials, dimension))
+        uniforms[0::2] = u
+        uniforms[1::2] = 1.0 - u
+    elif method == "qmc":
+        _require_scipy(method)
+        block = num_trials // QMC_REPLICATES
+        uniforms = np.vstack([
+            scipy.stats.qmc.Sobol(dimension, scramble=True,
+                                  seed=np.random.Generator(
+                                      np.random.PCG64(child))
+                                  ).random_base2(int(math.log2(block)))
+            for child in seed_seq.spawn(QMC_REPLICATES)])
+    else:
+        raise ValueError("trial_uniforms: unknown method {}.".format(method))
+    return np.clip(uniforms, _UNIFORM_EPSILON, 1.0 - _UNIFORM_EPSILON)
+
+
+def round_num_trials(method, num_trials):
+    """
+    Return the number of trials actually run by method for a requested
+    num_trials: even for "antithetic", QMC_REPLICATES times a power of two
+    (at least num_trials) for "qmc", and num_trials otherwise.
+    """
+
+    if method == "antithetic":
+        return max(2, num_trials + num_trials % 2)
+    if method == "qmc":
+        block = max(1, math.ceil(num_trials / QMC_REPLICATES))
+        return QMC_REPLICATES * 2 ** math.ceil(math.log2(block))
+    return num_trials
+
+
+def simulate_final_tallies(sample_tallies, total_num_votes, seed, num_trials,
+                           method="plain", priors=None):
+    """
+    Return array (num_trials x types) of simulated final tallies, summed
+    over counties, with the Dirichlet step driven as method prescribes.
+
+    Args:
+        sample_tallies, total_num_votes, priors: as for
+            bptool.compute_winner
+        seed (int): seed of the whole simulation
+        num_trials (int): number of trials, already rounded by
+            round_num_trials
+        method (str): one of METHODS
+
+    Returns:
+        (numpy array): one final tally per row
+    """
+
+    alphas = posterior_parameters(sample_tallies, priors)
+    num_counties, num_types = alphas.shape
+    multinomial_rng = np.random.Generator(np.random.PCG64(
+        np.random.SeedSequence(
+            seed, spawn_key=(bptool.VARIANCE_REDUCTION_SPAWN_KEY, 1))))
+    if method in ("antithetic", "qmc"):
+        _require_scipy(method)
+        uniforms = trial_uniforms(method, num_trials,
+                                  num_counties * num_types, seed)
+        gammas = scipy.special.gammaincinv(alphas.ravel(), uniforms)
+        gammas = gammas.reshape(num_trials, num_counties, num_types)
+    else:
+        gammas = multinomial_rng.gamma(alphas,
+                                       size=(num_trials,) + alphas.shape)
+    proportions = gammas / gammas.sum(axis=2, keepdims=True)
+
+    final_tallies = np.zeros((num_trials, num_types))
+    for i, sample_tally in enumerate(sample_tallies):
+        nonsample_size = total_num_votes[i] - sum(sample_tally)
+        if nonsample_size < 0:
+            raise ValueError("total_num_votes {} less than sample_size {}."
+                             .format(total_num_votes[i], sum(sample_tally)))
+        final_tallies += np.asarray(sample_tally) \
+            + multinomial_rng.multinomial(nonsample_size, proportions[:, i])
+    return final_tallies
+
+
+def first_round_controls(unique_ballots, sample_tallies, total_num_votes,
+                         final_tallies, candidates, priors=None):
+    """
+    Return (controls, means): each candidate's first-round vote in every
+    trial (an array, trials x candidates), and its exact posterior mean.
+
+    The mean of a type's final count is its sample count plus the
+    nonsample size times its posterior mean proportion, in every county.
+    """
+
+    tops = rcv_certificate.top_choices(unique_ballots, set())
+    indicator = np.array([[top == c for c in candidates] for top in tops],
+                         dtype=float)
+    alphas = posterior_parameters(sample_tallies, priors)
+    mean_tally = np.zeros(len(unique_ballots))
+    for i, sample_tally in enumerate(sample_tallies):
+        nonsample_size = total_num_votes[i] - sum(sample_tally)
+        mean_tally += np.asarray(sample_tally) \
+            + nonsample_size * alphas[i] / alphas[i].sum()
+    return final_tallies @ indicator, mean_tally @ indicator
+
+
+def estimate(wins, method, controls=None, control_means=None):
+    """
+    Return (p, standard_error) for the win indicators wins (one per
+    trial) of one candidate, as method prescribes.  controls and
+    control_means are needed for "control".
+    """
+
+    num_trials = len(wins)
+    if method == "antithetic":
+        groups = wins.reshape(-1, 2).mean(axis=1)
+    elif method == "qmc":
+        groups = wins.reshape(QMC_REPLICATES, -1).mean(axis=1)
+    elif method == "control":
+        centered = controls - controls.mean(axis=0)
+        beta = np.linalg.lstsq(centered, wins - wins.mean(), rcond=None)[0]
+        p = wins.mean() - (controls.mean(axis=0) - control_means) @ beta
+        residuals = wins - wins.mean() - centered @ beta
+        dof = max(1, num_trials - np.linalg.matrix_rank(centered) - 1)
+        return (min(1.0, max(0.0, float(p))),
+                math.sqrt(float(residuals @ residuals) / dof / num_trials))
+    else:
+        groups = wins
+    p = float(groups.mean())
+    variance = float(groups.var(ddof=1)) / len(groups) \
+        if len(groups) > 1 else 0.0
+    return p, math.sqrt(variance)
+
+
+def effective_sample_size(p, standard_error, num_trials):
+    """
+    Return p (1-p) / standard_error**2, the number of plain Monte Carlo
+    trials with the same variance; num_trials if there is no variance at
+    all, and infinity if only the plain estimate would have any.
+    """
+
+    if standard_error > 0:
+        return p * (1 - p) / standard_error ** 2
+    return float(num_trials) if p * (1 - p) == 0 else math.inf
+
+
+def trial_winners(unique_ballots, final_tallies, certified, certificate,
+                  voting_method, vote_for_n=1):
+    """
+    Return the list of the winners of the trials final_tallies: the
+    certificate's winner where certified is True, and otherwise the
+    winner by voting_method (a voting model or model class, tabulating
+    the trials as one batch, or an old-style voting method).
+    """
+
+    winners = [certificate.winner if c else None for c in certified]
+    uncertified = np.flatnonzero(~np.asarray(certified))
+    if len(uncertified) == 0:
+        return winners
+    model = voting_models.as_model(voting_method, unique_ballots, vote_for_n)
+    if model is not None:
+        indices = model.winners(final_tallies[uncertified])[:, 0]
+        for t, i in zip(uncertified, indices):
+            winners[t] = model.outcomes[i]
+    else:
+        for t in uncertified:
+            final_tally = list(enumerate(final_tallies[t].tolist()))
+            winners[t] = voting_method(unique_ballots, final_tally,
+                                       vote_for_n)
+    return winners
+
+
+def compute_win_probs_rcv(sample_tallies,
+                          total_num_votes,
+                          seed,
+                          num_trials,
+                          unique_ballots,
+                          real_names,
+                          vote_for_n, rcv_wrapper,
+                          method="antithetic",
+                          priors=None,
+                          prune_epsilon=None,
+                          merge_types=False,
+                          use_certificate=True):
+    """
+    Like bptool.compute_win_probs_rcv, but with a variance-reduced
+    estimator.
+
+    Args:
+        method (str): one of METHODS; see the module docstring
+        the other parameters: as for bptool.compute_win_probs_rcv
+
+    Returns:
+        (win_probs, stats), where win_probs is as for
+        bptool.compute_win_probs_rcv, and stats is a dict with keys
+        "method", "num_trials" (the number actually run, see
+        round_num_trials), and "std_errors" and "effective_sample_size",
+        lists of pairs (i, x) indexed like win_probs.
+    """
+
+    if method not in METHODS:
+        raise ValueError("compute_win_probs_rcv: unknown method {}."
+                         .format(method))
+    seed = bptool.resolve_seed(seed)
+    bptool.check_reduction(rcv_wrapper, vote_for_n, prune_epsilon,
+                           merge_types,
+                           "variance_reduction.compute_win_probs_rcv")
+    use_certificate = use_certificate \
+        and bptool.certificate_is_exact(rcv_wrapper, vote_for_n)
+    unique_ballots, sample_tallies, priors, certificate = \
+        bptool.prepare_rcv_trials(unique_ballots, sample_tallies,
+                                  total_num_votes, priors, prune_epsilon,
+                                  merge_types, use_certificate)
+    num_trials = round_num_trials(method, num_trials)
+    final_tallies = simulate_final_tallies(sample_tallies, total_num_votes,
+                                           seed, num_trials, method, priors)
+
+    if certificate is not None:
+        certified = certificate.holds(final_tallies)
+    else:
+        certified = np.zeros(num_trials, dtype=bool)
+    winners = trial_winners(unique_ballots, final_tallies, certified,
+                            certificate, rcv_wrapper, vote_for_n)
+    name_index = {name: i for i, name in enumerate(real_names)}
+    wins = np.zeros((num_trials, len(real_names)))
+    for t, winner in enumerate(winners):
+        wins[t, name_index[winner]] = 1.0
+
+    controls = control_means = None
+    if method == "control":
+        controls, control_means = first_round_controls(
+            unique_ballots, sample_tallies, total_num_votes, final_tallies,
+            real_names, priors)
+    win_probs = []
+    std_errors = []
+    ess = []
+    for i in range(len(real_names)):
+        p, standard_error = estimate(wins[:, i], method, controls,
+                                     control_means)
+        win_probs.append((i, p))
+        std_errors.append((i, standard_error))
+        ess.append((i, effective_sample_size(p, standard_error, num_trials)))
+    stats = {"method": method,
+             "num_trials": num_trials,
+             "std_errors": std_errors,
+             "effective_sample_size": ess}
+    return win_probs, stats
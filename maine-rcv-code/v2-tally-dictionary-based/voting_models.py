@@ -0,0 +1,349 @@
+# voting_models.py
+# python3
+
+"""
+Voting methods compiled into array-native "models".
+
+bptool calls a voting method once per trial, as
+    voting_method(candidate_names, [(index, count), ...], vote_for_n),
+and audit_me.rcv_wrapper then rebuilds a dict of ballots from that list
+on every trial.  A model is instead built once, for fixed candidate
+names (or ballot types), and tabulates a whole batch of tallies at once:
+
+    model.winners(tallies)
+
+takes a count vector, or an array with one count vector per row, and
+returns the indices into model.outcomes of the winners, as an integer
+array with one row of winners per tally.  model.outcomes lists what the
+old-style voting method would have returned for each winner (candidate
+indices for plurality, names for IRV).
+
+    PluralityModel: the vote_for_n candidates with the most votes, ties
+        broken as bptool.plurality_winner breaks them.
+    IRVModel: instant-runoff over ballot types, with exactly the
+        elimination and tie-breaking rules of rcv.rcv_winner, run for
+        all tallies at once.
+    CallableModel: an adapter turning any old-style voting method into
+        a model (one call per tally, as before).
+
+Every model is also callable in the old style, so it can be passed
+wherever a voting method is expected.  bptool.count_wins runs its trials
+in batches when given a model, or a model class, which it compiles
+against the candidate names (or ballot types) of the trials:
+
+    bptool.compute_win_probs_rcv(sample_tallies, [n], seed, num_trials,
+                                 unique_ballots, real_names, 1,
+                                 voting_models.IRVModel)
+"""
+
+import numpy as np
+
+
+class VotingModel:
+    """
+    Base class of voting models; see the module docstring.
+
+    Attributes:
+        candidate_names (list): the candidate names, or ballot types,
+            indexing the count vectors
+        vote_for_n (int): number of winners wanted
+        outcomes (list): the possible winners, indexed by the results of
+            winners
+    """
+
+    # Whether the old-style voting method returns a list of winners.
+    returns_list = True
+
+    def __init__(self, candidate_names, vote_for_n=1):
+        self.candidate_names = list(candidate_names)
+        self.vote_for_n = vote_for_n
+        self.outcomes = []
+
+    def winners(self, tallies):
+        """
+        Return integer array of indices into self.outcomes of the winners
+        of each tally: shape (number of tallies, number of winners), or
+        (number of winners,) for a single count vector.
+        """
+
+        raise NotImplementedError
+
+    def __call__(self, candidate_names, tallies, vote_for_n):
+        counts = [0] * len(self.candidate_names)
+        for index, count in tallies:
+            counts[index] = count
+        winners = [self.outcomes[i] for i in self.winners(np.array(counts))]
+        return winners if self.returns_list else winners[0]
+
+
+def as_model(voting_method, candidate_names, vote_for_n=1):
+    """
+    Return voting_method as a model for candidate_names: itself if it is
+    a model, an instance compiled for candidate_names and vote_for_n if it
+    is a model class, and None if it is an old-style voting method.
+    """
+
+    if isinstance(voting_method, VotingModel):
+        return voting_method
+    if isinstance(voting_method, type) \
+       and issubclass(voting_method, VotingModel):
+        return voting_method(candidate_names, vote_for_n)
+    return None
+
+
+class PluralityModel(VotingModel):
+    """
+    Plurality with vote_for_n winners.  outcomes are the candidate
+    indices 0, 1, ..., as bptool.plurality_winner returns them.
+
+    Example:
+        >>> model = PluralityModel(['a', 'b', 'c'], 2)
+        >>> np.sort(model.winners([[5, 5, 5], [1, 7, 7], [3, 2, 1]])).tolist()
+        [[1, 2], [1, 2], [0, 1]]
+    """
+
+    def __init__(self, candidate_names, vote_for_n=1):
+        super().__init__(candidate_names, vote_for_n)
+        self.outcomes = list(range(len(self.candidate_names)))
+
+    def winners(self, tallies):
+        """
+        Return the indices of the vote_for_n candidates with the most
+        votes in each tally, in no particular order.
+
+        Ties are broken as in bptool.plurality_winner, in favor of the
+        candidate with the higher index: for integer tallies the
+        candidates are ranked by count * (number of candidates) + index.
+        (Real-valued tallies, from an approximation, are ranked by count
+        alone.)
+        """
+
+        tallies = np.asarray(tallies)
+        if tallies.ndim == 1:
+            return self.winners(tallies[None])[0]
+        num_candidates = tallies.shape[1]
+        vote_for_n = min(self.vote_for_n, num_candidates)
+        if np.issubdtype(tallies.dtype, np.integer):
+            keys = tallies * num_candidates + np.arange(num_candidates)
+        else:
+            keys = tallies
+        if vote_for_n == num_candidates:
+            return np.tile(np.arange(num_candidates), (len(keys), 1))
+        return np.argpartition(-keys, vote_for_n - 1, axis=1)[:, :vote_for_n]
+
+
+class IRVModel(VotingModel):
+    """
+    Instant-runoff voting over fixed ballot types, tabulated for a batch
+    of tallies at once.  outcomes are the candidate names, sorted.
+
+    Each round, every ballot type counts for its highest-ranked
+    continuing candidate.  As in rcv.rcv_round, only candidates that are
+    the top choice of some ballot type take part in the round.  The
+    round has a winner if one of them has all the first-choice votes (the
+    first in order of ballot types, if none has any); otherwise the one
+    with the fewest votes is eliminated, ties going against the candidate
+    latest in tie_breaker (or absent from it), then against the earliest
+    name.
+
+    Example:
+        >>> model = IRVModel([('a', 'b'), ('b', 'a'), ('c', 'b')])
+        >>> [model.outcomes[i] for i in model.winners([[4, 3, 2],
+        ...                                            [4, 2, 3],
+        ...                                            [2, 3, 3]])[:, 0]]
+        ['b', 'a', 'b']
+    """
+
+    returns_list = False
+
+    def __init__(self, unique_ballots, vote_for_n=1, tie_breaker=None):
+        super().__init__(unique_ballots, vote_for_n)
+        if tie_breaker is None:
+            tie_breaker = []
+        names = sorted(set(name for ballot in unique_ballots
+                           for name in ballot))
+        self.outcomes = names
+        index = {name: i for i, name in enumerate(names)}
+        # rank[t, c]: position of candidate c on ballot type t
+        self.rank = np.full((len(unique_ballots), len(names)), np.inf)
+        for t, ballot in enumerate(unique_ballots):
+            for position, name in reversed(list(enumerate(ballot))):
+                self.rank[t, index[name]] = position
+
+        def tie_breaker_index(name):
+            if name in tie_breaker:
+                return tie_breaker.index(name)
+            return len(tie_breaker)
+
+        # tie_order[c]: position of c in the elimination order among
+        # candidates with equal counts, as in rcv.rcv_round
+        order = sorted(names, key=lambda name: (-tie_breaker_index(name),
+                                                name))
+        self.tie_order = np.array([order.index(name) for name in names])
+
+    @classmethod
+    def from_arrays(cls, unique_ballots, rank, outcomes, tie_order,
+                    vote_for_n=1):
+        """
+        Return an IRVModel with the given (already compiled) rank matrix,
+        outcomes and tie order, e.g. a rank matrix held in shared memory
+        (see trial_pool).
+        """
+
+        model = cls.__new__(cls)
+        VotingModel.__init__(model, unique_ballots, vote_for_n)
+        model.outcomes = list(outcomes)
+        model.rank = rank
+        model.tie_order = np.asarray(tie_order)
+        return model
+
+    def restrict(self, type_indices):
+        """
+        Return the model for the ballot types numbered type_indices only
+        (in that order), with the same candidates and tie order.
+        """
+
+        return IRVModel.from_arrays(
+            [self.candidate_names[t] for t in type_indices],
+            self.rank[type_indices], self.outcomes, self.tie_order,
+            self.vote_for_n)
+
+    def winners(self, tallies):
+        """
+        Return the index of the IRV winner of each tally, in an array of
+        shape (number of tallies, 1).
+        """
+
+        tallies = np.asarray(tallies, dtype=float)
+        if tallies.ndim == 1:
+            return self.winners(tallies[None])[0]
+        return self.tabulate(tallies, details=False)["winners"][:, None]
+
+    def tabulate(self, tallies, details=True):
+        """
+        Run IRV on each row of tallies, and return a dict of arrays, one
+        entry per tally:
+
+            "winners": index into outcomes of the winner;
+            "elimination_round": (number of tallies, number of candidates)
+                array of the round (1, 2, ...) in which each candidate was
+                eliminated, 0 for candidates never eliminated;
+            "margin": the lead of the top candidate over the runner-up in
+                the last round in which a candidate was eliminated (in the
+                deciding round, if there was none);
+            "exhausted": the number of votes in the deciding round that
+                count for no continuing candidate.
+
+        Only "winners" is computed if details is False.
+
+        Example:
+            >>> model = IRVModel([('a', 'b'), ('b',), ('c', 'a')])
+            >>> outcome = model.tabulate([[4, 5, 2]])
+            >>> outcome["elimination_round"].tolist(), outcome["margin"]
+            ([[0, 2, 1]], array([1.]))
+            >>> outcome["exhausted"]
+            array([5.])
+        """
+
+        tallies = np.asarray(tallies, dtype=float)
+        num_tallies = len(tallies)
+        num_types, num_candidates = self.rank.shape
+        candidates = np.arange(num_candidates)
+        type_numbers = np.arange(num_types)[None, :, None]
+        continuing = np.ones((num_tallies, num_candidates), dtype=bool)
+        winners = np.full(num_tallies, -1)
+        if details:
+            elimination_round = np.zeros((num_tallies, num_candidates),
+                                         dtype=np.int64)
+            margin = np.full(num_tallies, np.nan)
+            exhausted = np.zeros(num_tallies)
+        undecided = np.arange(num_tallies)
+        round_number = 0
+        while len(undecided) > 0:
+            round_number += 1
+            rank = np.where(continuing[undecided][:, None, :], self.rank,
+                            np.inf)
+            top = np.where(np.isfinite(rank.min(axis=2)),
+                           rank.argmin(axis=2), -1)
+            tops = top[:, :, None] == candidates
+            counts = np.einsum("tk,tkc->tc", tallies[undecided], tops)
+            in_round = tops.any(axis=1)
+            if not in_round.any(axis=1).all():
+                raise ValueError("IRVModel: all candidates eliminated.")
+
+            has_all = in_round & (counts == counts.sum(axis=1)[:, None])
+            decided = has_all.any(axis=1)
+            first_type = np.where(tops, type_numbers, num_types).min(axis=1)
+            winners[undecided[decided]] = \
+                np.where(has_all, first_type, num_types + 1)[decided] \
+                  .argmin(axis=1)
+
+            keys = (np.broadcast_to(self.tie_order, counts.shape),
+                    np.where(in_round, counts, np.inf))
+            eliminated = np.lexsort(keys, axis=1)[:, 0]
+            undecided_rows = np.flatnonzero(~decided)
+            if details:
+                leading = np.sort(np.where(in_round, counts, 0.0), axis=1)
+                lead = leading[:, -1] - leading[:, -2] \
+                    if num_candidates > 1 else leading[:, -1]
+                first_decided = decided & np.isnan(margin[undecided])
+                margin[undecided[first_decided]] = lead[first_decided]
+                margin[undecided[undecided_rows]] = lead[undecided_rows]
+                exhausted[undecided[decided]] = \
+                    (tallies[undecided].sum(axis=1)
+                     - counts.sum(axis=1))[decided]
+                elimination_round[undecided[undecided_rows],
+                                  eliminated[undecided_rows]] = round_number
+            continuing[undecided[undecided_rows],
+                       eliminated[undecided_rows]] = False
+            undecided = undecided[undecided_rows]
+        if not details:
+            return {"winners": winners}
+        return {"winners": winners,
+                "elimination_round": elimination_round,
+                "margin": margin,
+                "exhausted": exhausted}
+
+
+class CallableModel(VotingModel):
+    """
+    Adapter giving an old-style voting method the model interface.
+    Each tally is passed to voting_method as a list of (index, count)
+    pairs, and outcomes collects the winners in order of appearance.
+
+    Example:
+        >>> model = CallableModel(lambda names, tallies, n: names[0],
+        ...                       ['x', 'y'])
+        >>> model.winners([[1, 2], [3, 4]]).tolist(), model.outcomes
+        ([[0], [0]], ['x'])
+    """
+
+    def __init__(self, voting_method, candidate_names, vote_for_n=1):
+        super().__init__(candidate_names, vote_for_n)
+        self.voting_method = voting_method
+        self._outcome_index = {}
+
+    def winners(self, tallies):
+        tallies = np.asarray(tallies)
+        if tallies.ndim == 1:
+            return self.winners(tallies[None])[0]
+        rows = []
+        for tally in tallies.tolist():
+            result = self.voting_method(self.candidate_names,
+                                        list(enumerate(tally)),
+                                        self.vote_for_n)
+            if not isinstance(result, list):
+                result = [result]
+            row = []
+            for outcome in result:
+                if outcome not in self._outcome_index:
+                    self._outcome_index[outcome] = len(self.outcomes)
+                    self.outcomes.append(outcome)
+                row.append(self._outcome_index[outcome])
+            rows.append(row)
+        return np.array(rows, dtype=np.int64).reshape(len(rows), -1)
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
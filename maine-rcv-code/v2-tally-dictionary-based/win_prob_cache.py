@@ -0,0 +1,320 @@
+# win_prob_cache.py
+# python3
+
+"""
+A persistent, content-addressed cache of win-probability results.
+
+The same (sample tally, totals, seed, num_trials, method) combinations
+get recomputed across notebook sessions, reruns of audit_me.audit and
+regenerations of the audit_simulations_*.csv files.  A WinProbCache wraps
+    bptool.compute_win_probs
+    bptool.compute_win_probs_rcv
+and keys each result by a SHA-256 hash of a canonical JSON encoding of
+the inputs together with a "code version", which is a hash of the source
+of bptool.py, of every module of this directory that it imports
+(directly or not: rcv, rcv_reduction, rcv_certificate, exact_win_probs,
+voting_models, ...), and of the module defining the voting method.
+Editing any of those files therefore invalidates the old entries.
+
+Results are stored one per file (as JSON) under the cache directory.
+Each file is written to a temporary file and renamed into place, so
+concurrent writers never leave a partial entry, and two writers of the
+same key write the same value.  When the store grows past max_bytes, the
+least recently used entries are evicted, down to EVICTION_FRACTION of
+max_bytes.  A WinProbCache keeps a running total of the size of the
+store, so the store is only walked when that total goes over max_bytes.
+
+Options that do not change the result (workers, backend) are not part
+of the key; all other options are.  A seed of None is never cached,
+since each such call is meant to use fresh randomness.  Nor are calls
+with stats (a trial_stats.TrialStats to be filled by the trials): they
+are passed straight through.
+
+Example:
+    cache = WinProbCache()
+    win_probs = cache.compute_win_probs_rcv(sample_tallies, [n], seed,
+                                            num_trials, unique_ballots,
+                                            real_names, 1,
+                                            audit_me.rcv_wrapper)
+"""
+
+import hashlib
+import inspect
+import json
+import os
+import sys
+import tempfile
+
+import numpy as np
+
+import bptool
+
+DEFAULT_CACHE_DIR = os.environ.get("RCV_AUDIT_CACHE_DIR", ".win_prob_cache")
+DEFAULT_MAX_BYTES = 256 * 2**20
+
+# When the store grows past max_bytes, it is evicted down to this
+# fraction of it, so that the walks of the store are spread out.
+EVICTION_FRACTION = 0.9
+
+# Options of the wrapped functions that do not change their results.
+_RESULT_INDEPENDENT_OPTIONS = ("workers", "backend")
+
+_source_hashes = {}
+_computation_modules = []
+
+
+def source_hash(module_name):
+    """
+    Return the SHA-256 hex digest of the source file of the named
+    (already imported) module, or of its name if it has no source file.
+    """
+
+    if module_name not in _source_hashes:
+        module = sys.modules.get(module_name)
+        try:
+            with open(inspect.getsourcefile(module), "rb") as source_file:
+                digest = hashlib.sha256(source_file.read()).hexdigest()
+        except (TypeError, OSError):
+            digest = hashlib.sha256(module_name.encode("utf-8")).hexdigest()
+        _source_hashes[module_name] = digest
+    return _source_hashes[module_name]
+
+
+def _local_source_file(module):
+    try:
+        return inspect.getsourcefile(module)
+    except TypeError:
+        return None         # a built-in module
+
+
+def computation_modules():
+    """
+    Return the sorted names of bptool and of the modules of its
+    directory that it imports, directly or through one another.
+    """
+
+    if _computation_modules:
+        return list(_computation_modules)
+    directory = os.path.dirname(os.path.abspath(_local_source_file(bptool)))
+    names = set()
+    pending = [bptool]
+    while pending:
+        module = pending.pop()
+        if module.__name__ in names:
+            continue
+        names.add(module.__name__)
+        for value in vars(module).values():
+            if not inspect.ismodule(value):
+                value = inspect.getmodule(value)    # a name imported from it
+            if value is None:
+                continue
+            source_file = _local_source_file(value)
+            if source_file is not None and \
+                    os.path.dirname(os.path.abspath(source_file)) == directory:
+                pending.append(value)
+    _computation_modules.extend(sorted(names))
+    return list(_computation_modules)
+
+
+def code_version(voting_method=None):
+    """
+    Return a string identifying the version of the code that computes
+    win probabilities: bptool and the modules it uses (see
+    computation_modules), and the module of voting_method.
+    """
+
+    module_names = computation_modules()
+    if voting_method is not None and \
+            voting_method.__module__ not in module_names:
+        module_names.append(voting_method.__module__)
+    return ",".join(source_hash(name) for name in module_names
+                    if name in sys.modules)
+
+
+def _json_default(x):
+    if isinstance(x, np.integer):
+        return int(x)
+    if isinstance(x, np.floating):
+        return float(x)
+    if isinstance(x, np.ndarray):
+        return x.tolist()
+    if callable(x):
+        return "{}.{}".format(x.__module__, x.__qualname__)
+    raise TypeError("cannot encode {!r} in a cache key".format(x))
+
+
+def canonical_key(function_name, inputs):
+    """
+    Return the SHA-256 hex digest of a canonical JSON encoding of
+    function_name and the dict inputs.  Tuples and lists encode alike,
+    as do numpy and python numbers; a callable encodes as its
+    qualified name.
+    """
+
+    encoding = json.dumps([function_name, inputs], sort_keys=True,
+                          separators=(",", ":"), default=_json_default)
+    return hashlib.sha256(encoding.encode("utf-8")).hexdigest()
+
+
+class WinProbCache:
+    """
+    On-disk cache of the results of bptool.compute_win_probs and
+    bptool.compute_win_probs_rcv; see the module docstring.
+    """
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR,
+                 max_bytes=DEFAULT_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        # running total of the entries' sizes, found by walking the store
+        # on the first put; other processes' writes only show up in it
+        # at the next walk
+        self._size = None
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + ".json")
+
+    def get(self, key):
+        """
+        Return the cached value for key, or None if there is none.
+        A hit marks the entry as recently used.
+        """
+
+        path = self._path(key)
+        try:
+            with open(path) as entry_file:
+                value = json.load(entry_file)
+        except (OSError, ValueError):
+            return None
+        try:
+            os.utime(path)
+        except OSError:
+            pass            # removed by a concurrent evictor
+        return value
+
+    def put(self, key, value):
+        """
+        Store the JSON-encodable value under key, atomically, then
+        evict old entries if the store is over max_bytes.  The store is
+        only walked when the running total of sizes goes over max_bytes
+        (and on the first put).
+        """
+
+        if self._size is None:
+            self._size = sum(size for _, size, _ in self.entries())
+        path = self._path(key)
+        try:
+            old_size = os.path.getsize(path)
+        except OSError:
+            old_size = 0
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path),
+                                         suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as temp_file:
+                json.dump(value, temp_file, default=_json_default)
+            os.replace(temp_path, path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        self._size += os.path.getsize(path) - old_size
+        if self._size > self.max_bytes:
+            self.evict(EVICTION_FRACTION * self.max_bytes)
+
+    def entries(self):
+        """
+        Return a list of (last_used_time, size, path) for every entry.
+        """
+
+        entries = []
+        for dirpath, _, filenames in os.walk(self.cache_dir):
+            for filename in filenames:
+                if not filename.endswith(".json"):
+                    continue
+                path = os.path.join(dirpath, filename)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue    # removed by a concurrent evictor
+                entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
+
+    def evict(self, target_bytes=None):
+        """
+        Remove least recently used entries until the store is no larger
+        than target_bytes (by default, max_bytes).
+        """
+
+        if target_bytes is None:
+            target_bytes = self.max_bytes
+        entries = self.entries()
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total_size <= target_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass        # removed by a concurrent evictor
+            total_size -= size
+        self._size = total_size
+
+    def _cached_call(self, function_name, function, inputs, voting_method,
+                     kwargs):
+        if inputs["seed"] is None or kwargs.get("stats") is not None:
+            return function(*inputs.values(), **kwargs)
+        key_inputs = dict(inputs)
+        key_inputs.update((name, value) for name, value in kwargs.items()
+                          if name not in _RESULT_INDEPENDENT_OPTIONS)
+        key_inputs["code_version"] = code_version(voting_method)
+        key = canonical_key(function_name, key_inputs)
+        value = self.get(key)
+        if value is not None:
+            self.hits += 1
+            return [tuple(pair) for pair in value]
+        self.misses += 1
+        win_probs = function(*inputs.values(), **kwargs)
+        self.put(key, [list(pair) for pair in win_probs])
+        return win_probs
+
+    def compute_win_probs(self, sample_tallies, total_num_votes, seed,
+                          num_trials, candidate_names, vote_for_n,
+                          **kwargs):
+        """
+        Cached version of bptool.compute_win_probs, with the same
+        parameters and result.
+        """
+
+        inputs = {"sample_tallies": sample_tallies,
+                  "total_num_votes": total_num_votes,
+                  "seed": seed,
+                  "num_trials": num_trials,
+                  "candidate_names": candidate_names,
+                  "vote_for_n": vote_for_n}
+        return self._cached_call("compute_win_probs",
+                                 bptool.compute_win_probs,
+                                 inputs, None, kwargs)
+
+    def compute_win_probs_rcv(self, sample_tallies, total_num_votes, seed,
+                              num_trials, unique_ballots, real_names,
+                              vote_for_n, rcv_wrapper, **kwargs):
+        """
+        Cached version of bptool.compute_win_probs_rcv, with the same
+        parameters and result.
+        """
+
+        inputs = {"sample_tallies": sample_tallies,
+                  "total_num_votes": total_num_votes,
+                  "seed": seed,
+                  "num_trials": num_trials,
+                  "unique_ballots": unique_ballots,
+                  "real_names": real_names,
+                  "vote_for_n": vote_for_n,
+                  "rcv_wrapper": rcv_wrapper}
+        return self._cached_call("compute_win_probs_rcv",
+                                 bptool.compute_win_probs_rcv,
+                                 inputs, rcv_wrapper, kwargs)